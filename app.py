@@ -1,24 +1,114 @@
 import os
 import sys
-from flask import Flask, request, abort, json, jsonify, render_template, url_for, flash, redirect
+from flask import Flask, request, abort, json, jsonify, render_template, url_for, flash, redirect, make_response, Response, stream_with_context, send_file, session
 from flask_cors import CORS
 import traceback
-from models import SpatialConstants, setup_db, SampleLocation, User, Pet, db, db_drop_and_create_all
+import base64
+import hashlib
+import hmac
+import re
+import threading
+import time
+import click
+from datetime import datetime
+from models import SpatialConstants, setup_db, get_engines, setup_spatial_index, setup_result_cache, setup_archive, SampleLocation, User, Pet, db, db_drop_and_create_all
+from models import ChangeLog, within_box, read_session, get_changes, get_changes_within_radius, stable_version, prune_change_log, PetMatch, archive_pets, backfill_description_hash, normalize_pet_status
+from ingest import ingest_locations
+from matching import PetMatcher
+from photos import PhotoStore, VARIANTS
+from hashing import PasswordHasher, HashingBusy, calibrate, max_pending_for
+from tiles import tile_bounds, is_valid_tile, encode_binary
+from metrics import setup_metrics, record_rows
+from assets import setup_assets
 from forms import NewLocationForm, RegistrationForm, LoginForm, LostPetForm, FoundPetForm
 from flask_wtf.csrf import CSRFProtect
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager, login_user, current_user, logout_user, login_required
 
+# continuation tokens of the radius API: the (distance, id) of the last item of a page
+# (the (relevance, id) of it for the search API)
+def encode_cursor(item, key='distance'):
+    return base64.urlsafe_b64encode(json.dumps([item[key], item['id']]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        distance, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(distance), int(item_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+# streamed responses: the items are serialized and sent one by one as they come
+# from the DB, as NDJSON (one item per line) or as a {"success", "results"} JSON document
+def stream_items(items, format):
+    def generate_ndjson():
+        for item in items:
+            record_rows(1)
+            yield json.dumps(item) + '\n'
+
+    def generate_json():
+        yield '{"success": true, "results": ['
+        separator = ''
+        for item in items:
+            record_rows(1)
+            yield separator + json.dumps(item)
+            separator = ','
+        yield ']}'
+
+    if format == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
+
 # create the app
 def create_app(test_config=None):
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.update(test_config)
     
     #configure the app
     setup_db(app)
-    CORS(app)
+    metrics = setup_metrics(app, *get_engines(app))
+    app.config.setdefault('RADIUS_PAGE_SIZE', int(os.getenv('RADIUS_PAGE_SIZE', 100)))
+    app.config.setdefault('RADIUS_MAX_PAGE_SIZE', int(os.getenv('RADIUS_MAX_PAGE_SIZE', 500)))
+    app.config.setdefault('TILE_MAX_ITEMS', int(os.getenv('TILE_MAX_ITEMS', 1000)))
+    app.config.setdefault('TILE_MAX_AGE', int(os.getenv('TILE_MAX_AGE', 60)))
+    app.config.setdefault('INGEST_TOKEN', os.getenv('INGEST_TOKEN', ''))
+    app.config.setdefault('GOOGLE_MAPS_API_KEY', os.getenv('GOOGLE_MAPS_API_KEY', 'GOOGLE_MAPS_API_KEY_WAS_NOT_SET?!'))
+    app.config.setdefault('INGEST_CHUNK_SIZE', int(os.getenv('INGEST_CHUNK_SIZE', 1000)))
+    # rows per INSERT a ?chunk_size= may ask for: a chunk is held in memory and is one statement
+    app.config.setdefault('INGEST_MAX_CHUNK_SIZE', int(os.getenv('INGEST_MAX_CHUNK_SIZE', 10000)))
+    app.config.setdefault('PHOTO_STORAGE', os.getenv('PHOTO_STORAGE', os.path.join(app.instance_path, 'photos')))
+    app.config.setdefault('PHOTO_WORKERS', int(os.getenv('PHOTO_WORKERS', 2)))
+    app.config.setdefault('MAX_CONTENT_LENGTH', int(os.getenv('MAX_CONTENT_LENGTH', 10 * 1024 * 1024)))
+    # bcrypt cost, see `flask calibrate-bcrypt`. Existing hashes are upgraded at login
+    app.config.setdefault('BCRYPT_LOG_ROUNDS', int(os.getenv('BCRYPT_LOG_ROUNDS', 12)))
+    app.config.setdefault('BCRYPT_WORKERS', int(os.getenv('BCRYPT_WORKERS', 2)))
+    # below the threads of a worker (GUNICORN_THREADS), checked at startup, see hashing.max_pending_for
+    app.config.setdefault('GUNICORN_THREADS', max(1, int(os.getenv('GUNICORN_THREADS', 4))))
+    app.config.setdefault('BCRYPT_MAX_PENDING', int(os.getenv('BCRYPT_MAX_PENDING', 0)) or None)
+    # change versions and ?since= (see ChangeLog), and the pet event streams
+    app.config.setdefault('CHANGES_SETTLE_SECONDS', float(os.getenv('CHANGES_SETTLE_SECONDS', 2)))
+    app.config.setdefault('CHANGES_MAX', int(os.getenv('CHANGES_MAX', 1000)))
+    app.config.setdefault('STREAM_POLL_SECONDS', float(os.getenv('STREAM_POLL_SECONDS', 1)))
+    app.config.setdefault('STREAM_KEEPALIVE_SECONDS', float(os.getenv('STREAM_KEEPALIVE_SECONDS', 15)))
+    app.config.setdefault('STREAM_MAX_SECONDS', float(os.getenv('STREAM_MAX_SECONDS', 300)))
+    # every open stream holds a thread of the worker (see GUNICORN_THREADS in the Procfile)
+    app.config.setdefault('STREAM_MAX_OPEN', int(os.getenv('STREAM_MAX_OPEN', 2)))
+    # lost vs found matching (see matching.py): pets of the other status within
+    # MATCH_RADIUS meters and MATCH_WINDOW_DAYS days, keeping the MATCH_MAX best ones
+    app.config.setdefault('MATCH_RADIUS', float(os.getenv('MATCH_RADIUS', 5000)))
+    app.config.setdefault('MATCH_WINDOW_DAYS', float(os.getenv('MATCH_WINDOW_DAYS', 30)))
+    app.config.setdefault('MATCH_MAX', int(os.getenv('MATCH_MAX', 10)))
+    app.config.setdefault('MATCH_WORKERS', int(os.getenv('MATCH_WORKERS', 1)))
+    CORS(app, expose_headers=['X-Tile-Truncated'])
      
     """ uncomment at the first time running the app """
     #db_drop_and_create_all()
+
+    # the active window first: the cluster grids only keep the active pets
+    setup_archive(app)
+    setup_spatial_index(app)
+    setup_result_cache(app)
+    setup_assets(app)
     
     csrf = CSRFProtect(app)
     SECRET_KEY = os.urandom(32)
@@ -26,6 +116,15 @@ def create_app(test_config=None):
     csrf.init_app(app)
     
     bcrypt= Bcrypt(app)
+    app.config['BCRYPT_MAX_PENDING'] = max_pending_for(app.config['GUNICORN_THREADS'], app.config['BCRYPT_MAX_PENDING'])
+    hasher = app.extensions['password_hasher'] = PasswordHasher(bcrypt, app.config['BCRYPT_LOG_ROUNDS'],
+        workers=app.config['BCRYPT_WORKERS'], max_pending=app.config['BCRYPT_MAX_PENDING'])
+
+    photo_store = app.extensions['photo_store'] = PhotoStore(app.config['PHOTO_STORAGE'], app.config['PHOTO_WORKERS'])
+
+    open_streams = threading.BoundedSemaphore(app.config['STREAM_MAX_OPEN'])
+
+    matcher = app.extensions['pet_matcher'] = PetMatcher(app, app.config['MATCH_WORKERS'])
    
     
     login_manager= LoginManager(app)
@@ -37,14 +136,48 @@ def create_app(test_config=None):
     def load_user(user_id):
        return User.query.get(int(user_id))
     
+    # pages that are the same for every user are rendered once per worker, then
+    # only revalidated with their ETag. Not while there are flashed messages to show
+    # (the layout renders them), nor with TEMPLATES_AUTO_RELOAD (debug)
+    rendered_pages = {}
+
+    def render_page(template, **context):
+        if '_flashes' in session or app.templates_auto_reload:
+            return render_template(template, **context)
+        response = rendered_pages.get(template)
+        if response is None:
+            body = render_template(template, **context)
+            response = rendered_pages[template] = (body, hashlib.sha1(body.encode('utf-8')).hexdigest())
+        body, etag = response
+        response = make_response(body)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
     #templates 
     #define the basic route and its corresponding request handler
     @app.route('/', methods=['GET'])
     #modify the main method to return the rendered template
     def index():
-        return render_template(
+        return render_page(
             'index.html')
     
+    # the password hashing pool is full: ask to retry instead of queueing the request
+    def too_busy(template, **context):
+        flash('We are very busy right now, please try again in a few seconds.', 'danger')
+        response = make_response(render_template(template, **context), 503)
+        response.headers['Retry-After'] = '5'
+        return response
+
+    @app.cli.command('calibrate-bcrypt')
+    @click.option('--target-ms', type=int, default=250, help='Longest time one hash may take')
+    def calibrate_bcrypt_command(target_ms):
+        """Pick the bcrypt cost (BCRYPT_LOG_ROUNDS) for a target hashing time on this host"""
+        rounds, timings = calibrate(target_ms / 1000.0)
+        for cost, seconds in timings:
+            click.echo('cost %2d: %7.1f ms' % (cost, seconds * 1000))
+        click.echo('BCRYPT_LOG_ROUNDS=%d' % rounds)
+
     #register page: add method 'register' to render the register page once a request comes to /register 
     @app.route('/register', methods=['GET', 'POST'])
     def register ():
@@ -52,7 +185,11 @@ def create_app(test_config=None):
             return redirect(url_for('index'))
         form = RegistrationForm()
         if form.validate_on_submit():
-            hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+            try:
+                hashed_password = hasher.hash(form.password.data)
+            except HashingBusy:
+                return too_busy('register.html', title= 'Register', 
+                  form= form, map_key=app.config['GOOGLE_MAPS_API_KEY'])
             user= User(username=form.username.data, email=form.email.data, password= hashed_password)
             #area=form.lookup_address.data, 
             #pet_lostorfound=form.pet_lostorfound.data,
@@ -64,7 +201,7 @@ def create_app(test_config=None):
             flash(f'Account created for {form.username.data}. Pease log in.', 'success')
             return redirect(url_for('login'))
         return render_template('register.html', title= 'Register', 
-          form= form, map_key=os.getenv('GOOGLE_MAPS_API_KEY', 'GOOGLE_MAPS_API_KEY_WAS_NOT_SET?!'))
+          form= form, map_key=app.config['GOOGLE_MAPS_API_KEY'])
           
           
     #login page
@@ -75,7 +212,19 @@ def create_app(test_config=None):
         form = LoginForm()
         if form.validate_on_submit():
             user= User.query.filter_by(email=form.email.data).first()
-            if user and bcrypt.check_password_hash(user.password, form.password.data):
+            try:
+                valid = user and hasher.check(user.password, form.password.data)
+            except HashingBusy:
+                return too_busy('login.html', title= 'Log In', form= form)
+            if valid and hasher.needs_rehash(user.password):
+                # the configured cost changed since this hash was made. The password
+                # is already checked: when the pool is busy, upgrade at the next login
+                try:
+                    user.password = hasher.hash(form.password.data)
+                    db.session.commit()
+                except HashingBusy:
+                    app.logger.info('hashing pool busy, password hash of user %s not upgraded', user.id)
+            if valid:
                 login_user(user, remember=form.remember.data)
                 return redirect(url_for('index'))
             else:    
@@ -97,10 +246,10 @@ def create_app(test_config=None):
         if form.validate_on_submit(): 
             pet = Pet (petname=form.petname.data,
             status_lostorfound=form.status_lostorfound.data,
-            image_file=form.image_file.data,
-            date_lostorfound=form.date_lostorfound.data,
+            image_file=photo_store.save(form.image_file.data) if form.image_file.data else None,
+            date_lostorfound=datetime.combine(form.date_lostorfound.data, datetime.min.time()),
             description=form.description.data,
-            pet_custodian=current_user, 
+            pet_custodian=current_user.id, 
             geom=SpatialConstants.point_representation(
                 form.coord_latitude.data,form.coord_longitude.data))    
             #latitude = float(form.coord_latitude.data)
@@ -111,8 +260,8 @@ def create_app(test_config=None):
                  #geom=SampleLocation.point_representation(latitude=latitude, longitude=longitude))   
             #location.insert()
             
-            db.session.add(pet)
-            db.session.commit()
+            pet.insert()
+            matcher.submit(pet.id)
 
             flash(f'Entry for {form.petname.data} created!', 'success')
             return redirect(url_for('index'))
@@ -120,9 +269,27 @@ def create_app(test_config=None):
         return render_template(
             'lost.html', title= 'Lost',
              form=form,
-             map_key=os.getenv('GOOGLE_MAPS_API_KEY', 'GOOGLE_MAPS_API_KEY_WAS_NOT_SET?!')
+             map_key=app.config['GOOGLE_MAPS_API_KEY']
          ) 
 
+    #pet photos, stored by content so they never change once served
+    @app.route("/photos/<digest>/<variant>")
+    def photo(digest, variant):
+        if not re.fullmatch('[0-9a-f]{64}', digest) or (variant not in VARIANTS and variant != 'original'):
+            abort(404)
+        path, final = photo_store.find(digest, variant)
+        mimetype = PhotoStore.mimetype(path) if path is not None else None
+        # files stored before the uploads were verified may not be photos
+        if mimetype is None:
+            abort(404)
+        # a variant still being made is answered with the original for now,
+        # which must not be cached for long
+        response = send_file(path, mimetype=mimetype, conditional=True,
+                             max_age=365 * 24 * 3600 if final else 60)
+        response.cache_control.public = True
+        response.cache_control.immutable = final or None
+        return response
+
     #found pet entry page
     def found ():
         form = FoundPetForm()
@@ -144,16 +311,16 @@ def create_app(test_config=None):
         return render_template(
             'found.html',
             form=form,
-            map_key=os.getenv('GOOGLE_MAPS_API_KEY', 'GOOGLE_MAPS_API_KEY_WAS_NOT_SET?!')
+            map_key=app.config['GOOGLE_MAPS_API_KEY']
         )
        
     @app.route("/map", methods=['GET'])
     @login_required
     #change def home to map
     def map ():
-        return render_template(
+        return render_page(
             'map.html', 
-            map_key=os.getenv('GOOGLE_MAPS_API_KEY', 'GOOGLE_MAPS_API_KEY_WAS_NOT_SET?!')
+            map_key=app.config['GOOGLE_MAPS_API_KEY']
         )    
         
     @app.route("/api/store_item")
@@ -164,7 +331,7 @@ def create_app(test_config=None):
             describe = request.args.get('describe')
 
             location = SampleLocation(
-                decrsibe=ddescribe,
+                describe=describe,
                 geom=SampleLocation.point_representation(latitude=latitude, longitude=longitude)
             )   
             location.insert()
@@ -180,18 +347,218 @@ def create_app(test_config=None):
             app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
             abort(500)
 
+    @app.route("/api/bulk_ingest", methods=['POST'])
+    @csrf.exempt
+    def bulk_ingest():
+        # streamed NDJSON (default) or CSV (?format=csv) body of {lat, lng, describe}
+        # records, written chunk_size rows per INSERT. Needs the INGEST_TOKEN as
+        # 'Authorization: Bearer <token>', disabled when INGEST_TOKEN is not set
+        token = app.config['INGEST_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        if not token or not hmac.compare_digest(authorization, 'Bearer ' + token):
+            abort(403)
+        format = request.args.get('format', 'ndjson')
+        if format not in ('ndjson', 'csv'):
+            abort(400)
+        try:
+            chunk_size = min(int(request.args.get('chunk_size', app.config['INGEST_CHUNK_SIZE'])),
+                             app.config['INGEST_MAX_CHUNK_SIZE'])
+        except ValueError:
+            abort(400)
+        if chunk_size < 1:
+            abort(400)
+
+        try:
+            report = ingest_locations(request.stream, format, chunk_size)
+            return jsonify(
+                {
+                    "success": True,
+                    "report": report.to_dict()
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    @app.cli.command('ingest-locations')
+    @click.argument('file', type=click.File('rb'))
+    @click.option('--format', type=click.Choice(['ndjson', 'csv']), default=None,
+                  help='Defaults to csv for .csv files, ndjson otherwise')
+    @click.option('--chunk-size', type=int, default=None, help='Rows per INSERT/transaction')
+    def ingest_locations_command(file, format, chunk_size):
+        """Bulk insert sample locations from a NDJSON or CSV file ('-' for stdin)"""
+        if format is None:
+            format = 'csv' if file.name.endswith('.csv') else 'ndjson'
+        report = ingest_locations(file, format, chunk_size or app.config['INGEST_CHUNK_SIZE'])
+        for error in report.errors:
+            click.echo('line %(line)s: %(error)s' % error, err=True)
+        click.echo('%d rows in %.1fs (%.0f rows/sec), %d failed' % (
+            report.rows, report.seconds, report.rows / report.seconds if report.seconds else 0, report.failed))
+
+    @app.cli.command('prune-change-log')
+    @click.option('--days', type=int, default=7, help='Keep the changes of the last days')
+    def prune_change_log_command(days):
+        """Delete the old changes of the change log, clients older than that reload their area"""
+        click.echo('%d changes deleted' % prune_change_log(days))
+
+    @app.cli.command('backfill-description-hash')
+    @click.option('--chunk-size', type=int, default=1000, help='Rows updated per transaction')
+    def backfill_description_hash_command(chunk_size):
+        """Add and fill in pet.description_hash on a database made before it"""
+        click.echo('%d pets filled in' % backfill_description_hash(chunk_size))
+
+    @app.cli.command('normalize-pet-status')
+    def normalize_pet_status_command():
+        """Drop the old unique index of pet.status_lostorfound and capitalize the statuses"""
+        try:
+            updated, dropped = normalize_pet_status()
+        except RuntimeError as error:
+            raise click.ClickException(str(error))
+        for name in dropped:
+            click.echo('dropped index %s' % name)
+        click.echo('%d statuses capitalized%s' % (updated, ', run flask match-pets' if updated else ''))
+
+    @app.cli.command('archive-pets')
+    @click.option('--chunk-size', type=int, default=1000, help='Pets moved per transaction')
+    def archive_pets_command(chunk_size):
+        """Move the pets older than PET_ACTIVE_DAYS to the archive table"""
+        if not app.config['PET_ACTIVE_DAYS']:
+            raise click.UsageError('PET_ACTIVE_DAYS is 0, pets are never archived')
+        click.echo('%d pets archived' % archive_pets(app.config['PET_ACTIVE_DAYS'], chunk_size))
+
+    @app.cli.command('match-pets')
+    def match_pets_command():
+        """Rebuild the possible matches of all the pets"""
+        click.echo('%d pets matched' % matcher.match_all())
+
     @app.route("/api/get_items_in_radius")
     def get_items_in_radius():
+        # results come nearest first, one page at a time: pass the "next" value
+        # of a response as ?cursor= to get the following page.
+        # ?stream=json or ?stream=ndjson streams all the results instead.
+        # The first page has the change "version" of the results: ?since=<version>
+        # returns only what changed in the area since then (see get_item_changes)
+        if request.args.get('since') is not None:
+            return get_item_changes()
+
+        stream = request.args.get('stream')
+        if stream is not None:
+            if stream not in ('json', 'ndjson'):
+                abort(400)
+            try:
+                latitude = float(request.args.get('lat'))
+                longitude = float(request.args.get('lng'))
+                radius = int(request.args.get('radius'))
+            except (TypeError, ValueError):
+                abort(400)
+            return stream_items(SampleLocation.iter_items_within_radius(latitude, longitude, radius), stream)
+
+        cursor = request.args.get('cursor')
+        try:
+            after = decode_cursor(cursor) if cursor else None
+            page_size = min(int(request.args.get('page_size', app.config['RADIUS_PAGE_SIZE'])),
+                            app.config['RADIUS_MAX_PAGE_SIZE'])
+        except ValueError:
+            abort(400)
+        if page_size < 1:
+            abort(400)
+
         try:
             latitude = float(request.args.get('lat'))
             longitude = float(request.args.get('lng'))
             radius = int(request.args.get('radius'))
-            
-            locations = SampleLocation.get_items_within_radius(latitude, longitude, radius)
+
+            # read before the items, so no change made meanwhile can get lost
+            version = stable_version(SampleLocation, app.config['CHANGES_SETTLE_SECONDS']) if cursor is None else None
+            # one extra item tells us if there is a next page
+            locations = SampleLocation.get_items_within_radius(latitude, longitude, radius,
+                limit=page_size + 1, after=after)
+            next_cursor = encode_cursor(locations[page_size - 1]) if len(locations) > page_size else None
+            record_rows(len(locations[:page_size]))
+            return jsonify(
+                {
+                    "success": True,
+                    "results": locations[:page_size],
+                    "next": next_cursor,
+                    "version": version
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    def get_item_changes():
+        # ?since=<version>: the locations inserted/updated ("upserts") and deleted
+        # ("deletes", ids) in the radius since the version, and the version to ask
+        # from next time. "reset" means the client has to load the area again
+        try:
+            since = int(request.args.get('since'))
+            latitude = float(request.args.get('lat'))
+            longitude = float(request.args.get('lng'))
+            radius = int(request.args.get('radius'))
+        except (TypeError, ValueError):
+            abort(400)
+        try:
+            version = stable_version(SampleLocation, app.config['CHANGES_SETTLE_SECONDS'])
+            changes = get_changes_within_radius(SampleLocation, latitude, longitude, radius,
+                since, app.config['CHANGES_MAX'])
+            if changes is None:
+                return jsonify({"success": True, "reset": True, "version": version}), 200
+            upserts, deletes = changes
+            record_rows(len(upserts) + len(deletes))
+            return jsonify(
+                {
+                    "success": True,
+                    "reset": False,
+                    "upserts": upserts,
+                    "deletes": deletes,
+                    # never go back: the client may be ahead of the settled version
+                    "version": max(version, since)
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    # full-text search of the pets: ?q= words of the name or description, most relevant
+    # first, optionally within ?radius= meters of ?lat= ?lng= and lost or found between
+    # ?from= and ?to= (ISO dates). Paged as get_items_in_radius, with ?cursor=.
+    # ?include_archived=1 also searches the archived pets
+    @app.route("/api/pets/search")
+    def search_pets():
+        text = request.args.get('q', '').strip()
+        cursor = request.args.get('cursor')
+        try:
+            after = decode_cursor(cursor) if cursor else None
+            page_size = min(int(request.args.get('page_size', app.config['RADIUS_PAGE_SIZE'])),
+                            app.config['RADIUS_MAX_PAGE_SIZE'])
+            location = None
+            if request.args.get('lat') is not None:
+                location = (float(request.args.get('lat')), float(request.args.get('lng')),
+                            int(request.args.get('radius')))
+            start = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+            end = datetime.fromisoformat(request.args['to']) if request.args.get('to') else None
+        except (TypeError, ValueError):
+            abort(400)
+        if not text or page_size < 1:
+            abort(400)
+
+        try:
+            latitude, longitude, radius = location or (None, None, None)
+            # one extra item tells us if there is a next page
+            pets = Pet.search(text, limit=page_size + 1, after=after,
+                lat=latitude, lng=longitude, radius=radius, start=start, end=end,
+                include_archived=request.args.get('include_archived') == '1')
+            next_cursor = encode_cursor(pets[page_size - 1], 'relevance') if len(pets) > page_size else None
+            record_rows(len(pets[:page_size]))
             return jsonify(
                 {
                     "success": True,
-                    "results": locations
+                    "results": pets[:page_size],
+                    "next": next_cursor
                 }
             ), 200
         except:
@@ -199,6 +566,224 @@ def create_app(test_config=None):
             app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
             abort(500)
 
+    # the possible matches of a pet, best first: one range of the (pet_id, score) index
+    @app.route("/api/pets/<int:pet_id>/matches")
+    def get_pet_matches(pet_id):
+        try:
+            matches = PetMatch.get_matches(pet_id, limit=app.config['MATCH_MAX'])
+            record_rows(len(matches))
+            return jsonify({
+                "success": True,
+                "results": matches
+            }), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    @app.route("/api/pets/stream")
+    def stream_pets():
+        # Server-Sent Events of the pets added, changed ("pet" events) and removed
+        # ("delete" events) in a viewport (south, west, north, east), from the
+        # version ?since= (or the Last-Event-ID of a reconnecting EventSource), else
+        # from now on. The stream ends after STREAM_MAX_SECONDS, EventSource reconnects
+        try:
+            south = float(request.args.get('south'))
+            west = float(request.args.get('west'))
+            north = float(request.args.get('north'))
+            east = float(request.args.get('east'))
+            since = request.args.get('since', request.headers.get('Last-Event-ID'))
+            since = int(since) if since is not None else None
+        except (TypeError, ValueError):
+            abort(400)
+
+        if not open_streams.acquire(blocking=False):
+            response = jsonify({"success": False, "error": 503, "message": "too many streams"})
+            response.status_code = 503
+            response.headers['Retry-After'] = '30'
+            return response
+
+        poll_seconds = app.config['STREAM_POLL_SECONDS']
+        keepalive_seconds = app.config['STREAM_KEEPALIVE_SECONDS']
+        max_seconds = app.config['STREAM_MAX_SECONDS']
+        settle_seconds = app.config['CHANGES_SETTLE_SECONDS']
+        limit = app.config['CHANGES_MAX']
+
+        def generate():
+            version = since if since is not None else stable_version(Pet, settle_seconds)
+            # versions sent but not settled yet: they come back until they are
+            sent = set()
+            started = last_sent = time.monotonic()
+            yield 'retry: 5000\n\n'
+            while time.monotonic() - started < max_seconds:
+                changes = get_changes(Pet, within_box(ChangeLog.geom, south, west, north, east), version, limit)
+                settled = stable_version(Pet, settle_seconds)
+                # end the transaction: a long one would keep seeing the same snapshot
+                read_session(Pet).close()
+                if changes is None:
+                    yield 'event: reset\ndata: {}\n\n'
+                    return
+                for change_version, item_id, item in changes:
+                    if change_version in sent:
+                        continue
+                    if item is None:
+                        yield 'event: delete\nid: %d\ndata: %s\n\n' % (change_version, json.dumps({'id': item_id}))
+                    else:
+                        yield 'event: pet\nid: %d\ndata: %s\n\n' % (change_version, json.dumps(item.to_dict()))
+                    record_rows(1)
+                    sent.add(change_version)
+                    last_sent = time.monotonic()
+                version = max(version, settled)
+                sent = {change_version for change_version in sent if change_version > version}
+                if time.monotonic() - last_sent >= keepalive_seconds:
+                    yield ': keepalive\n\n'
+                    last_sent = time.monotonic()
+                time.sleep(poll_seconds)
+
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # no buffering by nginx (and the like) in front of us
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.call_on_close(open_streams.release)
+        return response
+
+    @app.route("/api/export")
+    def export():
+        # streams all the items of a layer (or only those within lat/lng/radius)
+        # as NDJSON (default) or JSON (?format=json). The pets layer only has the
+        # active pets unless ?include_archived=1
+        layers = {'locations': SampleLocation, 'pets': Pet}
+        layer = request.args.get('layer', 'locations')
+        format = request.args.get('format', 'ndjson')
+        if layer not in layers or format not in ('json', 'ndjson'):
+            abort(400)
+        options = {'include_archived': True} if layer == 'pets' and request.args.get('include_archived') == '1' else {}
+
+        if request.args.get('radius') is None:
+            return stream_items(layers[layer].iter_all(**options), format)
+        try:
+            latitude = float(request.args.get('lat'))
+            longitude = float(request.args.get('lng'))
+            radius = int(request.args.get('radius'))
+        except (TypeError, ValueError):
+            abort(400)
+        return stream_items(layers[layer].iter_items_within_radius(latitude, longitude, radius, **options), format)
+
+    @app.route("/api/get_clusters")
+    def get_clusters():
+        # clusters of the items in the map viewport, for the zoom levels at which
+        # showing every single item makes no sense (see clusterMaxZoom in map.js)
+        layers = {'locations': SampleLocation, 'pets': Pet}
+        layer = request.args.get('layer', 'locations')
+        if layer not in layers:
+            abort(400)
+        try:
+            zoom = int(request.args.get('zoom'))
+            south = float(request.args.get('south'))
+            west = float(request.args.get('west'))
+            north = float(request.args.get('north'))
+            east = float(request.args.get('east'))
+
+            clusters = layers[layer].get_clusters(zoom, south, west, north, east)
+            record_rows(len(clusters))
+            return jsonify(
+                {
+                    "success": True,
+                    "clusters": clusters
+                }
+            ), 200
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+    @app.route("/api/tiles/<int:z>/<int:x>/<int:y>")
+    def get_tile(z, x, y):
+        # Unlike the radius API, every client asks for the same few tiles,
+        # so responses can be reused by the browser and any proxy/CDN: they carry
+        # a strong ETag (the hash of the body) and are revalidated with If-None-Match.
+        # ?format=bin returns the compact encoding of tiles.encode_binary.
+        # A layer has at most TILE_MAX_ITEMS items: when it has more, it is cut (the
+        # lowest ids are kept) and listed in "truncated" (the X-Tile-Truncated header
+        # of binary tiles), the client shows the clusters of the tile instead
+        if not is_valid_tile(z, x, y):
+            abort(404)
+        binary = request.args.get('format') == 'bin'
+        try:
+            south, west, north, east = tile_bounds(z, x, y)
+            limit = app.config['TILE_MAX_ITEMS']
+            # one extra item tells us if a layer has more
+            locations = SampleLocation.get_items_in_box(south, west, north, east, limit + 1)
+            pets = Pet.get_items_in_box(south, west, north, east, limit + 1)
+            truncated = [name for name, items in (('locations', locations), ('pets', pets)) if len(items) > limit]
+            locations = locations[:limit]
+            pets = pets[:limit]
+            record_rows(len(locations) + len(pets))
+
+            if binary:
+                body = encode_binary([locations, pets])
+                mimetype = 'application/octet-stream'
+            else:
+                body = json.dumps(
+                    {
+                        "success": True,
+                        "tile": [z, x, y],
+                        "locations": locations,
+                        "pets": pets,
+                        "truncated": truncated
+                    }
+                )
+                mimetype = 'application/json'
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            app.logger.error(traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2))
+            abort(500)
+
+        response = make_response(body)
+        response.mimetype = mimetype
+        if binary and truncated:
+            response.headers['X-Tile-Truncated'] = ','.join(truncated)
+        response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['TILE_MAX_AGE']
+        response.vary.add('Accept-Encoding')
+        return response.make_conditional(request)
+
+    @app.route("/api/cache_stats")
+    def cache_stats():
+        # hit/miss counters of the radius query caches (of this worker), to size them
+        return jsonify(
+            {
+                "success": True,
+                "backend": app.config['RESULT_CACHE'] or None,
+                "caches": {
+                    model.__tablename__: model.result_cache.stats() if model.result_cache is not None else None
+                    for model in (SampleLocation, Pet)
+                }
+            }
+        ), 200
+
+    @app.route("/metrics")
+    def get_metrics():
+        # request metrics of this worker in the Prometheus text format, see metrics.py
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            "success": False,
+            "error": 400,
+            "message": "bad request"
+        }), 400
+
+    @app.errorhandler(403)
+    def forbidden(error):
+        return jsonify({
+            "success": False,
+            "error": 403,
+            "message": "forbidden"
+        }), 403
+
     @app.errorhandler(500)
     def server_error(error):
         return jsonify({
@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import click
+from flask import request, send_file, url_for, abort
+
+# the built assets go to static/dist, named after their content (map.3f2a9c41d0e7.js):
+# a name is never served with two different contents, so they are cached for good
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+MAX_AGE = 365 * 24 * 3600
+
+# precompressed variants, in order of preference: (Accept-Encoding token, suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_css_comment = re.compile(r'/\*.*?\*/', re.DOTALL)
+_css_space = re.compile(r'\s*([{}:;,>])\s*')
+_js_line_comment = re.compile(r'^\s*//.*$', re.MULTILINE)
+_js_block_comment = re.compile(r'^\s*/\*.*?\*/\s*$', re.MULTILINE | re.DOTALL)
+
+
+def minify_css(text):
+    try:
+        import rcssmin
+        return rcssmin.cssmin(text)
+    except ImportError:
+        pass
+    text = _css_comment.sub('', text)
+    text = _css_space.sub(r'\1', text)
+    return ' '.join(text.split())
+
+
+def minify_js(text):
+    """rjsmin when installed, else only drops whole comment lines, indentation and
+    blank lines: nothing that could be inside a string or a regular expression"""
+    try:
+        import rjsmin
+        return rjsmin.jsmin(text)
+    except ImportError:
+        pass
+    text = _js_block_comment.sub('', text)
+    text = _js_line_comment.sub('', text)
+    return '\n'.join(line.strip() for line in text.splitlines() if line.strip()) + '\n'
+
+
+def compress(data):
+    """Return {suffix: bytes} of the precompressed variants of data (no .br without the brotli package)"""
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        variants['.br'] = brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return variants
+
+
+def build_assets(static_folder):
+    """Minify, fingerprint and precompress the files of static_folder into its dist
+    folder, and write the manifest mapping their names to the built ones. Returns the manifest"""
+    dist = os.path.join(static_folder, DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+    manifest = {}
+    for name in sorted(os.listdir(static_folder)):
+        path = os.path.join(static_folder, name)
+        if not os.path.isfile(path):
+            continue
+        base, extension = os.path.splitext(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if extension == '.js':
+            data = minify_js(data.decode('utf-8')).encode('utf-8')
+        elif extension == '.css':
+            data = minify_css(data.decode('utf-8')).encode('utf-8')
+
+        built = '%s.%s%s' % (base, hashlib.sha256(data).hexdigest()[:HASH_LENGTH], extension)
+        manifest[name] = built
+        _write(os.path.join(dist, built), data)
+        for suffix, compressed in compress(data).items():
+            # not worth it for what does not compress (images...)
+            if len(compressed) < len(data):
+                _write(os.path.join(dist, built + suffix), compressed)
+
+    _write(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def _write(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+'''
+setup_assets(app):
+    serves the assets built by `flask build-assets` under /assets, with immutable
+    cache headers and their precompressed variant when the client accepts it.
+    Templates link them with asset_url(filename), which falls back to the plain
+    static file of filename when the assets are not built
+'''
+def setup_assets(app):
+    dist = os.path.join(app.static_folder, DIST_DIR)
+    manifest = load_manifest(app.static_folder)
+    built = set(manifest.values())
+    if not manifest:
+        app.logger.info('no built assets in %s, serving the static files as they are', dist)
+
+    def asset_url(filename):
+        if filename in manifest:
+            return url_for('asset', filename=manifest[filename])
+        return url_for('static', filename=filename)
+
+    app.jinja_env.globals['asset_url'] = asset_url
+
+    @app.route('/assets/<filename>')
+    def asset(filename):
+        if filename not in built:
+            abort(404)
+        path = os.path.join(dist, filename)
+        encoding = None
+        for token, suffix in ENCODINGS:
+            if request.accept_encodings[token] and os.path.exists(path + suffix):
+                path, encoding = path + suffix, token
+                break
+        # the mimetype of the asset, not of its .br / .gz
+        response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], conditional=True, max_age=MAX_AGE)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Minify, fingerprint and precompress the static files into static/dist (run at deploy)"""
+        for name, built_name in build_assets(app.static_folder).items():
+            click.echo('%s -> %s/%s' % (name, DIST_DIR, built_name))
+
+    return asset_url
@@ -0,0 +1,73 @@
+"""Compare two reports of benchmarks.run, endpoint by endpoint.
+
+    python -m benchmarks.compare base.json run.json [--json]
+"""
+import argparse
+import json
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+
+
+def change(base, new):
+    if base is None or new is None:
+        return None
+    if base == 0:
+        return None if new == 0 else float('inf')
+    return round((new - base) / base * 100, 1)
+
+
+def compare(base, new):
+    """Return {endpoint: {metric: {base, new, change_pct}}} plus the throughput"""
+    result = {
+        'base': base.get('revision'),
+        'new': new.get('revision'),
+        'requests_per_sec': {
+            'base': base['total']['requests_per_sec'],
+            'new': new['total']['requests_per_sec'],
+            'change_pct': change(base['total']['requests_per_sec'], new['total']['requests_per_sec'])
+        },
+        'endpoints': {}
+    }
+    for endpoint in sorted(set(base['endpoints']) | set(new['endpoints'])):
+        base_stats = base['endpoints'].get(endpoint, {})
+        new_stats = new['endpoints'].get(endpoint, {})
+        result['endpoints'][endpoint] = {
+            metric: {
+                'base': base_stats.get(metric),
+                'new': new_stats.get(metric),
+                'change_pct': change(base_stats.get(metric), new_stats.get(metric))
+            }
+            for metric in METRICS
+        }
+    return result
+
+
+def format_table(result):
+    lines = ['%s -> %s' % (result['base'], result['new'])]
+    throughput = result['requests_per_sec']
+    lines.append('requests/s: %s -> %s (%s%%)' % (throughput['base'], throughput['new'], throughput['change_pct']))
+    lines.append('%-28s %-20s %10s %10s %9s' % ('endpoint', 'metric', 'base', 'new', 'change'))
+    for endpoint, metrics in result['endpoints'].items():
+        for metric, values in metrics.items():
+            lines.append('%-28s %-20s %10s %10s %8s%%' % (
+                endpoint, metric, values['base'], values['new'], values['change_pct']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--json', action='store_true', help='print the comparison as JSON')
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    result = compare(base, new)
+    print(json.dumps(result, indent=2) if args.json else format_table(result))
+
+
+if __name__ == '__main__':
+    main()
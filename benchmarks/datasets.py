@@ -0,0 +1,119 @@
+import math
+import random
+
+import bcrypt
+
+from models import db, SampleLocation, Pet, User, Geometry
+
+# (name, lat, lng, weight, spread in km): the points are spread around these cities,
+# weight being their share of the points and spread the standard deviation
+CITIES = [
+    ('Berlin', 52.5200, 13.4050, 10, 12),
+    ('Hamburg', 53.5511, 9.9937, 5, 10),
+    ('Munich', 48.1351, 11.5820, 5, 10),
+    ('Cologne', 50.9375, 6.9603, 3, 8),
+    ('Paris', 48.8566, 2.3522, 9, 12),
+    ('London', 51.5074, -0.1278, 9, 15),
+    ('Madrid', 40.4168, -3.7038, 5, 10),
+    ('Rome', 41.9028, 12.4964, 4, 10),
+    ('Warsaw', 52.2297, 21.0122, 3, 8),
+    ('Istanbul', 41.0082, 28.9784, 6, 15),
+    ('New York', 40.7128, -74.0060, 10, 15),
+    ('Los Angeles', 34.0522, -118.2437, 7, 25),
+    ('Chicago', 41.8781, -87.6298, 5, 15),
+    ('Mexico City', 19.4326, -99.1332, 7, 15),
+    ('Sao Paulo', -23.5505, -46.6333, 8, 20),
+    ('Buenos Aires', -34.6037, -58.3816, 5, 15),
+    ('Lagos', 6.5244, 3.3792, 5, 15),
+    ('Cairo', 30.0444, 31.2357, 6, 12),
+    ('Mumbai', 19.0760, 72.8777, 8, 12),
+    ('Delhi', 28.7041, 77.1025, 8, 15),
+    ('Bangkok', 13.7563, 100.5018, 5, 12),
+    ('Tokyo', 35.6762, 139.6503, 10, 20),
+    ('Seoul', 37.5665, 126.9780, 6, 12),
+    ('Shanghai', 31.2304, 121.4737, 8, 18),
+    ('Sydney', -33.8688, 151.2093, 4, 20),
+    ('Auckland', -36.8485, 174.7633, 1, 10),
+    ('Anchorage', 61.2181, -149.9003, 1, 8),
+]
+
+# share of the points spread uniformly over the world (rural noise)
+UNIFORM_SHARE = 0.05
+
+KM_PER_DEGREE = 111.32
+
+PET_NAMES = ['Laika', 'Rex', 'Luna', 'Bella', 'Max', 'Milo', 'Coco', 'Kira', 'Simba', 'Nala', 'Oskar', 'Lucky']
+PET_KINDS = ['dog', 'cat', 'rabbit', 'parrot', 'ferret', 'turtle']
+COLORS = ['black', 'white', 'brown', 'grey', 'ginger', 'spotted', 'tabby']
+
+
+def city_points(rng):
+    """Yield (lat, lng) points forever, clustered around CITIES"""
+    weights = [weight for _, _, _, weight, _ in CITIES]
+    while True:
+        if rng.random() < UNIFORM_SHARE:
+            # uniform over the sphere, not over the lat/lng rectangle
+            yield math.degrees(math.asin(rng.uniform(-1.0, 1.0))), rng.uniform(-180.0, 180.0)
+            continue
+        _, lat, lng, _, spread = rng.choices(CITIES, weights)[0]
+        lat = max(-89.9, min(89.9, lat + rng.gauss(0.0, spread / KM_PER_DEGREE)))
+        lng += rng.gauss(0.0, spread / KM_PER_DEGREE / math.cos(math.radians(lat)))
+        yield lat, (lng + 180.0) % 360.0 - 180.0
+
+
+def _insert_rows(table, rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            db.session.execute(table.insert().values(chunk))
+            db.session.commit()
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert().values(chunk))
+        db.session.commit()
+
+
+def generate(locations, pets, users, seed=0, chunk_size=1000):
+    """Fill the (empty) tables with a synthetic dataset. The same arguments
+    always give the same rows, so runs of different commits can be compared"""
+    if pets and not users:
+        raise ValueError('pets need users to belong to')
+    rng = random.Random(seed)
+    points = city_points(rng)
+
+    # one hash for every user: hashing a real bcrypt per user would take hours
+    password = bcrypt.hashpw(b'benchmark', bcrypt.gensalt(4)).decode('utf-8')
+    _insert_rows(User.__table__, (
+        {
+            'username': 'user%d' % i,
+            'email': 'user%d@example.com' % i,
+            'password': password
+        }
+        for i in range(1, users + 1)
+    ), chunk_size)
+
+    def location_rows():
+        for i in range(locations):
+            lat, lng = next(points)
+            yield {
+                'describe': 'Location %d' % i,
+                'geom': Geometry.point_representation(latitude=lat, longitude=lng)
+            }
+    _insert_rows(SampleLocation.__table__, location_rows(), chunk_size)
+
+    def pet_rows():
+        for i in range(pets):
+            lat, lng = next(points)
+            status = rng.choice(['Lost', 'Found'])
+            description = '%s %s %s, last seen near %.4f, %.4f (#%d)' % (
+                status, rng.choice(COLORS), rng.choice(PET_KINDS), lat, lng, i)
+            yield {
+                'status_lostorfound': status,
+                'petname': '%s-%d' % (rng.choice(PET_NAMES), i),
+                'description': description,
+                'description_hash': Pet.fingerprint(description),
+                'geom': Geometry.point_representation(latitude=lat, longitude=lng),
+                'pet_custodian': rng.randint(1, users)
+            }
+    _insert_rows(Pet.__table__, pet_rows(), chunk_size)
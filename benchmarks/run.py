@@ -0,0 +1,254 @@
+"""Replay map traces against the location APIs and report latencies as JSON.
+
+    python -m benchmarks.run --locations 100000 --views 2000 --output run.json
+    python -m benchmarks.compare base.json run.json
+
+Without --database-url the dataset is generated once into a SQLite file under
+instance/benchmarks (named after its size and seed) and served by the local spatial
+engine; with a MySQL URL pass --generate to fill its (empty) tables first.
+The app runs in process, configured by the usual environment variables
+(SPATIAL_INDEX_ENABLED, RESULT_CACHE...), or is reached over HTTP with --base-url,
+in which case the DB query counts are not known.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, 'instance', 'benchmarks')
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Stats:
+    def __init__(self):
+        self.durations = []
+        self.queries = []
+        self.errors = 0
+
+    def add(self, seconds, queries, ok):
+        self.durations.append(seconds)
+        if queries is not None:
+            self.queries.append(queries)
+        if not ok:
+            self.errors += 1
+
+    def to_dict(self):
+        durations = sorted(self.durations)
+        return {
+            'count': len(durations),
+            'errors': self.errors,
+            'p50_ms': round(percentile(durations, 0.50) * 1000, 3) if durations else None,
+            'p95_ms': round(percentile(durations, 0.95) * 1000, 3) if durations else None,
+            'p99_ms': round(percentile(durations, 0.99) * 1000, 3) if durations else None,
+            'mean_ms': round(sum(durations) / len(durations) * 1000, 3) if durations else None,
+            'max_ms': round(durations[-1] * 1000, 3) if durations else None,
+            'queries_per_request': round(sum(self.queries) / len(self.queries), 2) if self.queries else None
+        }
+
+
+class LocalClient:
+    """Calls the app in process, counting the SQL statements each request runs"""
+
+    def __init__(self):
+        from sqlalchemy import event
+        from app import app
+        from models import db
+
+        self.client = app.test_client()
+        self.queries = 0
+        with app.app_context():
+            engine = db.get_engine(app)
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count_query(*args):
+            self.queries += 1
+
+    def get(self, path, params):
+        started_queries = self.queries
+        response = self.client.get(path + '?' + urllib.parse.urlencode(params))
+        return response.status_code, response.get_json(silent=True), self.queries - started_queries
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def get(self, path, params):
+        url = self.base_url + path + '?' + urllib.parse.urlencode(params)
+        try:
+            with urllib.request.urlopen(url) as response:
+                return response.status, json.loads(response.read()), None
+        except urllib.error.HTTPError as e:
+            return e.code, None, None
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT) != 0
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_database(args):
+    """Point DATABASE_URL at the benchmark DB, generating the dataset when needed"""
+    database_url = args.database_url
+    generate = args.generate
+    if database_url is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        path = os.path.join(DATA_DIR, 'l%d-p%d-u%d-s%d.db' % (args.locations, args.pets, args.users, args.seed))
+        generate = generate or not os.path.exists(path)
+        if generate and os.path.exists(path):
+            os.remove(path)
+        database_url = 'sqlite:///' + path
+    os.environ['DATABASE_URL'] = database_url
+    if not generate:
+        return
+
+    # a bare app: the real one loads the spatial indexes at start, the tables must be filled by then
+    from flask import Flask
+    from models import db, setup_db
+    from benchmarks.datasets import generate as generate_dataset
+
+    started = time.perf_counter()
+    app = Flask('benchmarks')
+    setup_db(app)
+    with app.app_context():
+        db.create_all()
+        generate_dataset(args.locations, args.pets, args.users, args.seed, args.chunk_size)
+        db.session.remove()
+    print('generated %d locations, %d pets, %d users in %.1fs' % (
+        args.locations, args.pets, args.users, time.perf_counter() - started), file=sys.stderr)
+
+
+def replay(client, args):
+    from benchmarks.traces import views, view_requests, MAX_MARKERS
+
+    rng = random.Random(args.trace_seed)
+    stats = {}
+
+    def call(name, path, params, record):
+        started = time.perf_counter()
+        status, body, queries = client.get(path, params)
+        seconds = time.perf_counter() - started
+        if record:
+            stats.setdefault(name, Stats()).add(seconds, queries, status == 200)
+        return body, seconds, queries
+
+    requests = 0
+    started = time.perf_counter()
+    for number, (endpoint, params, center) in enumerate(view_requests(views(args.views, args.trace_seed))):
+        record = number >= args.warmup
+        if record and number == args.warmup:
+            requests = 0
+            started = time.perf_counter()
+
+        if endpoint == 'get_clusters':
+            call('get_clusters', '/api/get_clusters', params, record)
+            requests += 1
+        else:
+            # follow the pages as map.js does, up to MAX_MARKERS items
+            loaded = 0
+            view_seconds = 0.0
+            view_queries = 0
+            while True:
+                body, seconds, queries = call('get_items_in_radius', '/api/get_items_in_radius', params, record)
+                requests += 1
+                view_seconds += seconds
+                view_queries += queries or 0
+                if not body or not body.get('success'):
+                    break
+                loaded += len(body['results'])
+                if not body.get('next') or loaded >= MAX_MARKERS:
+                    break
+                params = dict(params, cursor=body['next'])
+            if record:
+                stats.setdefault('get_items_in_radius:view', Stats()).add(
+                    view_seconds, view_queries if queries is not None else None, True)
+
+        if rng.random() < args.write_ratio:
+            location = {
+                'lat': center[0] + rng.uniform(-0.01, 0.01),
+                'lng': center[1] + rng.uniform(-0.01, 0.01),
+                'describe': 'benchmark write'
+            }
+            call('store_item', '/api/store_item', location, record)
+            requests += 1
+
+    seconds = time.perf_counter() - started
+    return stats, requests, seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='default: a generated SQLite file under instance/benchmarks')
+    parser.add_argument('--generate', action='store_true', help='(re)generate the dataset')
+    parser.add_argument('--locations', type=int, default=10000)
+    parser.add_argument('--pets', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the dataset')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='rows per INSERT when generating')
+    parser.add_argument('--views', type=int, default=2000, help='map positions in the trace')
+    parser.add_argument('--trace-seed', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=100, help='map requests of the trace left out of the stats')
+    parser.add_argument('--write-ratio', type=float, default=0.02, help='store_item calls per map request')
+    parser.add_argument('--base-url', help='benchmark a running server instead of the app in process')
+    parser.add_argument('--output', default='-', help='JSON report file, - for stdout')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, ROOT)
+    prepare_database(args)
+    if args.base_url:
+        client = HTTPClient(args.base_url)
+        config = {}
+    else:
+        client = LocalClient()
+        from app import app
+        config = {key: app.config[key] for key in (
+            'SPATIAL_ENGINE', 'SPATIAL_INDEX_ENABLED', 'RESULT_CACHE', 'RADIUS_PAGE_SIZE')}
+
+    stats, requests, seconds = replay(client, args)
+    report = {
+        'revision': git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'target': args.base_url or 'in-process',
+        'config': config,
+        'dataset': {'locations': args.locations, 'pets': args.pets, 'users': args.users, 'seed': args.seed},
+        'trace': {'views': args.views, 'seed': args.trace_seed, 'warmup': args.warmup, 'write_ratio': args.write_ratio},
+        'total': {
+            'requests': requests,
+            'seconds': round(seconds, 3),
+            'requests_per_sec': round(requests / seconds, 1) if seconds else None
+        },
+        'endpoints': {name: endpoint_stats.to_dict() for name, endpoint_stats in sorted(stats.items())}
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
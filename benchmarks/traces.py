@@ -0,0 +1,93 @@
+import math
+import random
+
+from clusters import TILE_SIZE, MAX_LATITUDE
+from spatial_index import distance_sphere
+
+from benchmarks.datasets import CITIES, KM_PER_DEGREE
+
+# the same as radiusToZoomLevel, clusterMaxZoom and maxMarkers in static/map.js
+RADIUS_TO_ZOOM_LEVEL = [
+    800000, 800000, 800000, 800000, 800000, 800000, 800000,  # zoom 0 - 6
+    400000, 200000, 100000, 51000, 26000, 13000, 6500,  # zoom 7 - 13
+    3500, 1800, 900, 430, 210, 120  # zoom 14 - 19
+]
+CLUSTER_MAX_ZOOM = 12
+MAX_MARKERS = 1000
+MIN_ZOOM = 6
+MAX_ZOOM = 19
+
+# screen size of the map, in pixels
+VIEWPORT = (1280, 720)
+
+# what the user does between two map 'idle' events
+ACTIONS = [
+    ('pan', 0.55),
+    ('zoom_in', 0.2),
+    ('zoom_out', 0.15),
+    ('jump', 0.1),  # search an address in another city
+]
+
+
+def viewport_bounds(lat, lng, zoom, viewport=VIEWPORT):
+    """Return (south, west, north, east) of the map showing (lat, lng) at its centre"""
+    scale = TILE_SIZE * 2 ** zoom
+    sin_lat = math.sin(math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+
+    def latitude(pixel_y):
+        pixel_y = max(0.0, min(scale, pixel_y))
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * pixel_y / scale))))
+
+    half_width = min(180.0, viewport[0] / 2 / scale * 360.0)
+    west = (lng - half_width + 180.0) % 360.0 - 180.0
+    east = (lng + half_width + 180.0) % 360.0 - 180.0
+    if half_width == 180.0:
+        west, east = -180.0, 180.0
+    return latitude(y + viewport[1] / 2), west, latitude(y - viewport[1] / 2), east
+
+
+def views(length, seed=0):
+    """Yield length (lat, lng, zoom) map positions of a user browsing the map,
+    as the 'idle' events of static/map.js would see them"""
+    rng = random.Random(seed)
+    weights = [weight for _, _, _, weight, _ in CITIES]
+    actions, action_weights = zip(*ACTIONS)
+
+    _, lat, lng, _, _ = rng.choices(CITIES, weights)[0]
+    zoom = 11
+    for _ in range(length):
+        yield lat, lng, zoom
+        action = rng.choices(actions, action_weights)[0]
+        if action == 'pan':
+            # drag the map by up to half a screen
+            scale = TILE_SIZE * 2 ** zoom
+            dx = rng.uniform(-0.5, 0.5) * VIEWPORT[0] / scale * 360.0
+            dy = rng.uniform(-0.5, 0.5) * VIEWPORT[1] / scale * 360.0 * math.cos(math.radians(lat))
+            lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat + dy))
+            lng = (lng + dx + 180.0) % 360.0 - 180.0
+        elif action == 'zoom_in':
+            zoom = min(MAX_ZOOM, zoom + 1)
+        elif action == 'zoom_out':
+            zoom = max(MIN_ZOOM, zoom - 1)
+        else:
+            _, lat, lng, _, spread = rng.choices(CITIES, weights)[0]
+            lat += rng.gauss(0.0, spread / KM_PER_DEGREE)
+            lng += rng.gauss(0.0, spread / KM_PER_DEGREE)
+            zoom = rng.randint(11, 15)
+
+
+def view_requests(views):
+    """Yield (endpoint, params, (lat, lng) of the view) of the API calls static/map.js makes for a sequence of views:
+    clusters up to CLUSTER_MAX_ZOOM, else a radius query when the map moved more than
+    100 m or zoomed out since the last one (its pages are followed by the runner)"""
+    query = None  # (lat, lng, zoom) of the last query
+    for lat, lng, zoom in views:
+        if zoom <= CLUSTER_MAX_ZOOM:
+            south, west, north, east = viewport_bounds(lat, lng, zoom)
+            query = (lat, lng, zoom)
+            yield 'get_clusters', {'zoom': zoom, 'south': south, 'west': west, 'north': north, 'east': east}, (lat, lng)
+        elif (query is None or query[2] <= CLUSTER_MAX_ZOOM or zoom < query[2]
+              or distance_sphere(query[0], query[1], lat, lng) > 100):
+            query = (lat, lng, zoom)
+            yield 'get_items_in_radius', {'lat': lat, 'lng': lng, 'radius': RADIUS_TO_ZOOM_LEVEL[zoom]}, (lat, lng)
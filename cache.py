@@ -0,0 +1,213 @@
+import math
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from spatial_index import EARTH_RADIUS, bounding_box, distance_sphere
+
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180.0
+
+
+class LocalCacheBackend:
+    """In-process cache backend: bounded LRU with a TTL, one per worker process.
+    The writes of the other workers reach it through the change log, see
+    models.refresh_indexes"""
+
+    shared = False
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_counters(self, keys):
+        with self._lock:
+            return [self._counters.get(key, 0) for key in keys]
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend:
+    """Cache backend shared by all the workers (and hosts), on redis: eviction is
+    left to the redis maxmemory-policy (use allkeys-lru), entries expire after ttl"""
+
+    shared = True
+
+    def __init__(self, url, ttl=300, prefix='afcache:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def get_counters(self, keys):
+        if not keys:
+            return []
+        return [int(value or 0) for value in self.client.mget([self.prefix + key for key in keys])]
+
+    def incr(self, key):
+        self.client.incr(self.prefix + key)
+
+    def __len__(self):
+        return self.client.dbsize()
+
+
+class RadiusQueryCache:
+    """Cache of radius query results of one table.
+
+    Only the keys are quantized: the centre is snapped to a grid about 1/32 of
+    the radius wide, so near-identical map positions share one entry (and one DB
+    query). The entry holds the nearest items of the snapped centre within the
+    radius padded by the largest snap error, which covers the circle of any centre
+    snapped there; each lookup then measures the distances from its own centre
+    again, drops what is out of its radius and sorts the rest.
+
+    Invalidation is per cell: the world is cut in grids of several resolutions,
+    every write bumps a generation counter of the cells holding the point, and a
+    cached result remembers the generations of the cells covering its bounding
+    box (on the finest grid where that takes at most max_cells cells). A result is
+    stale as soon as one of them changed, so a write only drops the entries
+    around it.
+    """
+
+    def __init__(self, backend, name, cell_sizes=(4.0, 0.5, 0.0625, 0.0078125), max_cells=16, overfetch=2):
+        self.backend = backend
+        self.name = name
+        self.cell_sizes = cell_sizes
+        self.max_cells = max_cells
+        # an entry holds overfetch times the items of a page: the nearest ones to the
+        # snapped centre are not exactly the nearest ones to the caller's centre
+        self.overfetch = overfetch
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def quantize(self, lat, lng, radius):
+        """Return (lat, lng, step) of the grid point the query centre is snapped to,
+        step being the grid spacing in degrees"""
+        step = 2.0 ** math.floor(math.log2(max(radius, 1) / METERS_PER_DEGREE / 32))
+        return round(lat / step) * step, round(lng / step) * step, step
+
+    def _cell_key(self, level, row, column):
+        return 'gen:%s:%d:%d:%d' % (self.name, level, row, column)
+
+    def _cells(self, lat, lng, radius):
+        """Return the generation keys of the cells covering the bounding box of a query"""
+        south, west, north, east = bounding_box(lat, lng, radius)
+        for level, size in reversed(list(enumerate(self.cell_sizes))):
+            columns = int(round(360.0 / size))
+            rows = range(int(math.floor(south / size)), int(math.floor(north / size)) + 1)
+            first_column = int(math.floor((west + 180.0) / size))
+            last_column = int(math.floor((east + 180.0) / size))
+            if west > east:
+                last_column += columns
+            column_count = min(columns, last_column - first_column + 1)
+            if len(rows) * column_count <= self.max_cells or level == 0:
+                return [self._cell_key(level, row, (first_column + i) % columns)
+                        for row in rows for i in range(column_count)]
+
+    def get_or_compute(self, lat, lng, radius, limit, after, compute, fill=None):
+        """Return the first limit items within radius meters of (lat, lng), nearest
+        first, from the cache or from compute(lat, lng, radius, limit, after), which
+        returns dicts with their 'id', 'location' and 'distance'.
+
+        Only first pages are cached (after is None); the next ones, and the first
+        pages the entry cannot answer for sure, are computed for the exact centre.
+        The cached results come from fill (same arguments, compute by default): it
+        must not read older data than the writes that bumped the generations, which
+        a lagging read replica may do.
+        """
+        if after is not None:
+            return compute(lat, lng, radius, limit, after)
+
+        snapped_lat, snapped_lng, step = self.quantize(lat, lng, radius)
+        # a degree of longitude is never longer than one of latitude: an upper bound
+        # of the distance between a centre and the grid point it is snapped to
+        padded_radius = radius + step * METERS_PER_DEGREE
+        size = limit * self.overfetch
+        key = 'radius:%s:%r:%r:%r:%r' % (self.name, snapped_lat, snapped_lng, radius, size)
+        cells = self._cells(snapped_lat, snapped_lng, padded_radius)
+
+        entry = self.backend.get(key)
+        if entry is not None and entry[0] == self.backend.get_counters(cells):
+            self.hits += 1
+            result = entry[1]
+        else:
+            if entry is not None:
+                self.stale += 1
+            self.misses += 1
+            # read the generations before running the query: a write landing in between
+            # makes the entry look stale next time instead of serving the old result
+            generations = self.backend.get_counters(cells)
+            result = (fill or compute)(snapped_lat, snapped_lng, padded_radius, size, None)
+            self.backend.set(key, (generations, result))
+
+        error = distance_sphere(lat, lng, snapped_lat, snapped_lng)
+        items = []
+        for item in result:
+            distance = distance_sphere(lat, lng, item['location']['lat'], item['location']['lng'])
+            if distance <= radius:
+                items.append(dict(item, distance=distance))
+        items.sort(key=lambda item: (item['distance'], item['id']))
+
+        if len(result) >= size:
+            # the entry is cut at some distance from the snapped centre: it holds every
+            # item nearer than that distance minus the snap error to the caller's centre
+            horizon = result[-1]['distance'] - error
+            items = [item for item in items if item['distance'] < horizon]
+            if len(items) < limit:
+                return compute(lat, lng, radius, limit, None)
+        return items[:limit]
+
+    def invalidate(self, lat, lng):
+        """Drop the cached results whose area contains the point (lat, lng)"""
+        for level, size in enumerate(self.cell_sizes):
+            columns = int(round(360.0 / size))
+            row = int(math.floor(lat / size))
+            column = int(math.floor((lng + 180.0) / size)) % columns
+            self.backend.incr(self._cell_key(level, row, column))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_ratio': self.hits / lookups if lookups else None
+        }
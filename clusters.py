@@ -0,0 +1,179 @@
+import heapq
+import math
+import threading
+
+# Web mercator, as used by Google Maps: at zoom z the world is a square
+# of TILE_SIZE * 2^z pixels
+TILE_SIZE = 256
+MAX_LATITUDE = 85.05112878
+
+# size (in screen pixels) of the square cells the points are clustered in
+CELL_PIXELS = 64
+
+
+def mercator_pixel(lat, lng, zoom):
+    """Return the (x, y) web mercator pixel coordinates of a point at a zoom level"""
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    scale = TILE_SIZE * 2 ** zoom
+    x = (lng + 180.0) / 360.0 * scale
+    sin_lat = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+
+def cell_ranges(zoom, south, west, north, east, cell_pixels=CELL_PIXELS):
+    """Return the column and row ranges of the cells of a zoom level covering a viewport.
+    The column range runs past the last column when the viewport crosses the antimeridian"""
+    columns = TILE_SIZE * 2 ** zoom // cell_pixels
+    x_west, y_north = mercator_pixel(north, west, zoom)
+    x_east, y_south = mercator_pixel(south, east, zoom)
+    first_column = min(columns - 1, int(x_west // cell_pixels))
+    last_column = min(columns - 1, int(x_east // cell_pixels))
+    if west > east:
+        last_column += columns
+    first_row = max(0, int(y_north // cell_pixels))
+    last_row = min(columns - 1, int(y_south // cell_pixels))
+    return range(first_column, last_column + 1), range(first_row, last_row + 1), columns
+
+
+class ClusterGrid:
+    """Per zoom level aggregates of points, meant to live once per worker process.
+
+    Every zoom level between min_zoom and max_zoom is cut into cells of
+    cell_pixels x cell_pixels screen pixels and keeps [count, sum of lat,
+    sum of lng, a sample id] per cell, so a viewport query only visits the
+    cells on screen, whatever the number of points behind them.
+    The cells are nested (a cell splits into 4 cells one zoom level up), which
+    lets insert/remove update all the levels from the cell at max_zoom, where
+    the points themselves are kept.
+    Points can be given an expiry time, expire() removes the ones past it.
+    """
+
+    def __init__(self, min_zoom=0, max_zoom=16, cell_pixels=CELL_PIXELS):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.cell_pixels = cell_pixels
+        # zoom -> {(column, row): [count, sum_lat, sum_lng, sample_id]},
+        # and on max_zoom {(column, row): {id: (lat, lng)}}
+        self._levels = {zoom: {} for zoom in range(min_zoom, max_zoom + 1)}
+        self._points = {}  # id -> (lat, lng, cell at max_zoom)
+        self._expires = {}  # id -> expiry, of the points that have one
+        self._expiry = []  # heap of (expiry, id), entries of moved/removed points are skipped
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, lat, lng):
+        x, y = mercator_pixel(lat, lng, self.max_zoom)
+        columns = TILE_SIZE * 2 ** self.max_zoom // self.cell_pixels
+        return int(x // self.cell_pixels) % columns, min(columns - 1, int(y // self.cell_pixels))
+
+    def _parent(self, cell, zoom):
+        shift = self.max_zoom - zoom
+        return cell[0] >> shift, cell[1] >> shift
+
+    def insert(self, item_id, lat, lng, expires=None):
+        """Add a point, or move it if item_id is already in the grid. expires: when it
+        is to be dropped by expire() (any comparable value, typically a datetime)"""
+        lat = float(lat)
+        lng = float(lng)
+        cell = self._cell(lat, lng)
+        with self._lock:
+            self._discard(item_id)
+            self._points[item_id] = (lat, lng, cell)
+            if expires is not None:
+                self._expires[item_id] = expires
+                heapq.heappush(self._expiry, (expires, item_id))
+            self._levels[self.max_zoom].setdefault(cell, {})[item_id] = (lat, lng)
+            for zoom in range(self.min_zoom, self.max_zoom):
+                aggregate = self._levels[zoom].setdefault(self._parent(cell, zoom), [0, 0.0, 0.0, item_id])
+                aggregate[0] += 1
+                aggregate[1] += lat
+                aggregate[2] += lng
+
+    def remove(self, item_id):
+        with self._lock:
+            self._discard(item_id)
+
+    def expire(self, now):
+        """Remove the points whose expiry is before now, return how many"""
+        expired = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] < now:
+                expires, item_id = heapq.heappop(self._expiry)
+                if self._expires.get(item_id) == expires:
+                    self._discard(item_id)
+                    expired += 1
+        return expired
+
+    def _discard(self, item_id):
+        self._expires.pop(item_id, None)
+        previous = self._points.pop(item_id, None)
+        if previous is None:
+            return
+        lat, lng, cell = previous
+        members = self._levels[self.max_zoom][cell]
+        del members[item_id]
+        if not members:
+            del self._levels[self.max_zoom][cell]
+
+        # bottom up, so when the sample of a cell goes away a replacement
+        # can be taken from one of its (already updated) children
+        for zoom in range(self.max_zoom - 1, self.min_zoom - 1, -1):
+            parent = self._parent(cell, zoom)
+            aggregate = self._levels[zoom][parent]
+            aggregate[0] -= 1
+            if aggregate[0] == 0:
+                del self._levels[zoom][parent]
+                continue
+            aggregate[1] -= lat
+            aggregate[2] -= lng
+            if aggregate[3] == item_id:
+                aggregate[3] = self._child_sample(parent, zoom)
+
+    def _child_sample(self, cell, zoom):
+        children = self._levels[zoom + 1]
+        for dx in (0, 1):
+            for dy in (0, 1):
+                child = children.get((cell[0] * 2 + dx, cell[1] * 2 + dy))
+                if child:
+                    return next(iter(child)) if zoom + 1 == self.max_zoom else child[3]
+        return None
+
+    def _cluster(self, zoom, cell):
+        if zoom < self.max_zoom:
+            count, sum_lat, sum_lng, sample_id = self._levels[zoom][cell]
+        else:
+            members = self._levels[zoom][cell]
+            count = len(members)
+            sum_lat = sum(lat for lat, _ in members.values())
+            sum_lng = sum(lng for _, lng in members.values())
+            sample_id = next(iter(members))
+        return {
+            'count': count,
+            'sample_id': sample_id,
+            'location': {
+                'lat': sum_lat / count,
+                'lng': sum_lng / count
+            }
+        }
+
+    def query(self, zoom, south, west, north, east):
+        """Return the clusters of the cells of a zoom level overlapping a viewport"""
+        zoom = max(self.min_zoom, min(self.max_zoom, zoom))
+        column_range, row_range, columns = cell_ranges(zoom, south, west, north, east, self.cell_pixels)
+        column_count = min(columns, len(column_range))
+        with self._lock:
+            level = self._levels[zoom]
+            # walk whichever is smaller: the cells of the viewport or the occupied cells
+            if column_count * len(row_range) < len(level):
+                cells = [(column % columns, row)
+                         for column in column_range[:column_count]
+                         for row in row_range
+                         if (column % columns, row) in level]
+            else:
+                cells = [cell for cell in level
+                         if cell[1] in row_range
+                         and (column_count == columns or (cell[0] - column_range[0]) % columns < column_count)]
+            return [self._cluster(zoom, cell) for cell in cells]
@@ -1,9 +1,10 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed
 from flask_login import current_user
-from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField, SelectField, HiddenField
+from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField, SelectField, HiddenField, DateField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
 from models import User, Pet
+from photos import image_format
 
 class RegistrationForm(FlaskForm):
    username = StringField('Username', validators=[DataRequired(), Length(min=3, max= 20)])
@@ -33,7 +34,7 @@ class LostPetForm(FlaskForm):
    status_lostorfound = StringField('Please enter "Lost"', validators=[DataRequired()])
    petname = StringField('Pet Name', validators=[DataRequired(), Length(min=2, max= 20)])
    image_file= FileField('Optional but recommended: Upload a photo', validators=[FileAllowed(['jpg', 'png'])])
-   date_lostorfound = StringField('On what date was the pet lost?', validators=[DataRequired(), Length(min=2, max= 20)])
+   date_lostorfound = DateField('On what date was the pet lost?', validators=[DataRequired()])
    description = TextAreaField('Describe your lost pet, add what type (and breed if it helps) plus helpful details about it getting lost', validators=[DataRequired()])
    #describe = StringField('Choose a title for the location where it was last seen (For ex: Dog Laika lost here.)',
                            #validators=[DataRequired(), Length(min=1, max=80)])
@@ -42,20 +43,27 @@ class LostPetForm(FlaskForm):
    coord_longitude = HiddenField('Longitude', validators=[DataRequired()])                 
    submit = SubmitField('Save your entry')
    
-   def validate_status_lostorfound(self, status_lostorfound):
-        pet= Pet.query.filter_by(status_lostorfound=status_lostorfound.data).first() 
-        if pet:
-           raise ValidationError('Please enter "Lost"')
+   # the extension says nothing of the content: Pillow has to read it as a photo
+   def validate_image_file(self, image_file):
+        if image_file.data:
+           try:
+              image_format(image_file.data.stream)
+           except ValueError:
+              raise ValidationError('Please upload a photo (JPEG or PNG)')
 
-   def validate_petname(self, petname):
-        pet= Pet.query.filter_by(petname=petname.data).first() 
-        if pet:
-           raise ValidationError('Please enter the name of the pet')
-   
-   def validate_description(self, description):
-        pet= Pet.query.filter_by(description=description.data).first() 
-        if pet:
-           raise ValidationError('Please enter descroption of the pet and any details about his disappearance')
+   # petname and description must not be used by another pet: they are checked
+   # together, in one round-trip (see Pet.find_conflicts)
+   def validate(self, extra_validators=None):
+        valid = super().validate(extra_validators)
+        status_valid = (self.status_lostorfound.data or '').strip().capitalize() in ('Lost', 'Found')
+        if not status_valid:
+           self.status_lostorfound.errors.append('Please enter "Lost" or "Found"')
+        petname_taken, description_taken = Pet.find_conflicts(self.petname.data, self.description.data)
+        if petname_taken:
+           self.petname.errors.append('Please enter the name of the pet')
+        if description_taken:
+           self.description.errors.append('Please enter descroption of the pet and any details about his disappearance')
+        return valid and status_valid and not (petname_taken or description_taken)
    
    '''def validate_describe(self, describe):
         pet= Pet.query.filter_by(describe=describe.data).first() 
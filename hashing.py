@@ -0,0 +1,83 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt as _bcrypt
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already queued"""
+
+
+def hash_rounds(pw_hash):
+    """Return the cost (log2 rounds) a bcrypt hash was made with: $2b$<cost>$..."""
+    if isinstance(pw_hash, bytes):
+        pw_hash = pw_hash.decode('utf-8')
+    return int(pw_hash.split('$')[2])
+
+
+class PasswordHasher:
+    """Runs bcrypt in a small pool of threads (bcrypt releases the GIL while hashing).
+
+    At most `workers` hashes run at once per process, so a burst of logins cannot
+    take all the CPU from the map API. At most `max_pending` hashes may be running
+    or queued, each one holding the request thread waiting for it: beyond that,
+    callers get HashingBusy right away, to be answered with a 503 rather than piling
+    up requests. With max_pending below the threads of a gthread worker (see
+    max_pending_for), logins never hold all of them.
+    """
+
+    def __init__(self, bcrypt, rounds, workers=2, max_pending=3):
+        self.bcrypt = bcrypt
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self._run(self.bcrypt.generate_password_hash, password, self.rounds).decode('utf-8')
+
+    def check(self, pw_hash, password):
+        return self._run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """True when pw_hash was made with another cost than the configured one"""
+        return hash_rounds(pw_hash) != self.rounds
+
+
+def max_pending_for(threads, max_pending=None):
+    """Return the max_pending of a PasswordHasher serving requests on `threads` threads:
+    by default all of them but one, and never all of them (a ValueError), except with
+    a single thread where there is nothing to keep free"""
+    if max_pending is None:
+        return max(1, threads - 1)
+    if max_pending < 1 or (threads > 1 and max_pending >= threads):
+        raise ValueError('BCRYPT_MAX_PENDING must be between 1 and GUNICORN_THREADS - 1 (%d), got %d'
+                         % (threads - 1, max_pending))
+    return max_pending
+
+
+def calibrate(target_seconds, min_rounds=4, max_rounds=16, password=b'calibration password'):
+    """Time bcrypt on this host for increasing costs, return (chosen cost, [(cost, seconds), ...]):
+    the chosen cost is the highest one hashing within target_seconds"""
+    timings = []
+    chosen = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        started = time.perf_counter()
+        _bcrypt.hashpw(password, _bcrypt.gensalt(rounds))
+        seconds = time.perf_counter() - started
+        timings.append((rounds, seconds))
+        if seconds > target_seconds:
+            break
+        chosen = rounds
+    return chosen, timings
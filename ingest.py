@@ -0,0 +1,149 @@
+import csv
+import io
+import json
+import time
+
+from sqlalchemy import func
+
+from models import db, SampleLocation, Geometry, refresh_indexes, log_new_items, invalidate_cached
+
+# how many error details a report keeps, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+
+def parse_records(stream, format):
+    """Yield (line number, record dict) from a binary stream of NDJSON or CSV.
+    CSV needs a header line naming the columns (lat, lng, describe)"""
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if format == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_number, line in enumerate(text, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, ValueError('invalid JSON: %s' % e)
+            continue
+        yield line_number, record
+
+
+def _number(value, name):
+    # JSON numbers, or the strings of CSV. Not booleans, which float() would take
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError('%s must be a number' % name)
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError('%s must be a number' % name)
+
+
+def validate_location(record):
+    """Return the sample_locations row of a record, raise ValueError if it is not valid"""
+    if isinstance(record, Exception):
+        raise record
+    if not isinstance(record, dict):
+        raise ValueError('record is not an object')
+    latitude = _number(record.get('lat'), 'lat')
+    longitude = _number(record.get('lng'), 'lng')
+    if not -90.0 <= latitude <= 90.0:
+        raise ValueError('lat out of range: %s' % latitude)
+    if not -180.0 <= longitude <= 180.0:
+        raise ValueError('lng out of range: %s' % longitude)
+    describe = record.get('describe')
+    if describe is None:
+        describe = ''
+    if not isinstance(describe, str):
+        raise ValueError('describe must be a string')
+    if len(describe) > 80:
+        raise ValueError('describe longer than 80 characters')
+    return {
+        'describe': describe,
+        'geom': Geometry.point_representation(latitude, longitude)
+    }
+
+
+class IngestReport:
+    def __init__(self):
+        self.rows = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.monotonic()
+        self.seconds = 0.0
+
+    def error(self, line_number, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line_number, 'error': message})
+
+    def finish(self):
+        self.seconds = time.monotonic() - self.started
+        return self
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'failed': self.failed,
+            'errors': self.errors,
+            'seconds': round(self.seconds, 3),
+            'rows_per_sec': round(self.rows / self.seconds, 1) if self.seconds else None
+        }
+
+
+def _insert_chunk(chunk, report, logged_id):
+    """Write a chunk as one multi-row INSERT in its own transaction, along with the
+    change log of its rows (the ones above logged_id). If the DB rejects it, the rows
+    are retried one by one so only the bad ones get lost. Returns the highest id logged"""
+    table = SampleLocation.__table__
+    try:
+        db.session.execute(table.insert().values([row for _, row in chunk]))
+        last_id = log_new_items(SampleLocation, logged_id)
+        db.session.commit()
+        report.rows += len(chunk)
+        return last_id
+    except Exception:
+        db.session.rollback()
+
+    for line_number, row in chunk:
+        try:
+            db.session.execute(table.insert().values(row))
+            last_id = log_new_items(SampleLocation, logged_id)
+            db.session.commit()
+            logged_id = last_id
+            report.rows += 1
+        except Exception as e:
+            db.session.rollback()
+            report.error(line_number, str(e.__cause__ or e).splitlines()[0])
+    return logged_id
+
+
+def ingest_locations(stream, format='ndjson', chunk_size=1000):
+    """Bulk insert sample locations from a NDJSON/CSV stream, chunk_size rows per
+    INSERT and transaction. Invalid rows are reported, not fatal. Returns an IngestReport"""
+    report = IngestReport()
+    last_id = db.session.query(func.max(SampleLocation.id)).scalar() or 0
+    logged_id = last_id
+
+    chunk = []
+    for line_number, record in parse_records(stream, format):
+        try:
+            chunk.append((line_number, validate_location(record)))
+        except ValueError as e:
+            report.error(line_number, str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            logged_id = _insert_chunk(chunk, report, logged_id)
+            invalidate_cached(SampleLocation, *[row['geom'] for _, row in chunk])
+            chunk = []
+    if chunk:
+        logged_id = _insert_chunk(chunk, report, logged_id)
+        invalidate_cached(SampleLocation, *[row['geom'] for _, row in chunk])
+
+    # multi-row INSERTs do not tell us the new ids, the spatial index picks up the new rows from the change log
+    refresh_indexes(SampleLocation, force=True)
+    return report.finish()
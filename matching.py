@@ -0,0 +1,155 @@
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Pet, PetMatch, Point, radius_search, within_radius, distance_expression
+
+logger = logging.getLogger(__name__)
+
+# weights of the match score (0 - 1): how close the two pets were, how close in time,
+# and how many words their descriptions share
+DISTANCE_WEIGHT = 0.5
+TIME_WEIGHT = 0.3
+DESCRIPTION_WEIGHT = 0.2
+
+# a pet can be found a little before its owner reports it lost
+EARLY_FOUND = timedelta(days=1)
+
+_word = re.compile(r'[a-z0-9]+')
+STOP_WORDS = {'a', 'an', 'and', 'the', 'with', 'of', 'in', 'on', 'is', 'has', 'was', 'to', 'very', 'it', 'her', 'his'}
+
+
+def description_words(description):
+    return set(_word.findall((description or '').lower())) - STOP_WORDS
+
+
+def other_status(status):
+    return {'Lost': 'Found', 'Found': 'Lost'}.get(status)
+
+
+def time_window(pet, days):
+    """Return (start, end) of the date_lostorfound of the pets that could match pet"""
+    if pet.status_lostorfound == 'Lost':
+        return pet.date_lostorfound - EARLY_FOUND, pet.date_lostorfound + timedelta(days=days)
+    return pet.date_lostorfound - timedelta(days=days), pet.date_lostorfound + EARLY_FOUND
+
+
+def score(distance, days_apart, words, other_words, radius, window_days):
+    closeness = max(0.0, 1 - distance / radius) if radius else 1.0
+    recency = max(0.0, 1 - days_apart / window_days) if window_days else 1.0
+    common = len(words | other_words)
+    similarity = len(words & other_words) / common if common else 0.0
+    return round(DISTANCE_WEIGHT * closeness + TIME_WEIGHT * recency + DESCRIPTION_WEIGHT * similarity, 4)
+
+
+def find_candidates(pet, radius, window_days):
+    """Return [(pet, distance)] of the pets of the other status within radius meters
+    of pet and within the time window: the in memory radius search (spatial grid)
+    when there is one, else the SPATIAL index of the DB"""
+    point = Point.from_geom(pet.geom)
+    start, end = time_window(pet, window_days)
+    query = Pet.query.filter(
+        Pet.status_lostorfound == other_status(pet.status_lostorfound),
+        Pet.date_lostorfound.between(start, end),
+        Pet.id != pet.id)
+
+    search = radius_search(Pet)
+    if search is not None:
+        distances = {item_id: distance for distance, item_id in search(point.lat, point.lng, radius)}
+        if not distances:
+            return []
+        return [(candidate, distances[candidate.id])
+                for candidate in query.filter(Pet.id.in_(list(distances))).all()]
+
+    return query.add_columns(distance_expression(Pet.geom, point.lat, point.lng)).filter(
+        within_radius(Pet.geom, point.lat, point.lng, radius)).all()
+
+
+def store_match(row):
+    """Insert the PetMatch row, or update the one of the same pair that another worker
+    matching one of the two pets stored in between"""
+    try:
+        with db.session.begin_nested():
+            db.session.execute(PetMatch.__table__.insert(), [row])
+    except IntegrityError:
+        PetMatch.query.filter_by(pet_id=row['pet_id'], match_id=row['match_id']).update(
+            {'score': row['score'], 'distance': row['distance'], 'days_apart': row['days_apart']},
+            synchronize_session=False)
+
+
+def match_pet(pet_id, radius, window_days, max_matches):
+    """(Re)compute the matches of a pet and store them in PetMatch, for it and for each
+    of its candidates (which keep their max_matches best ones). Returns the number of matches"""
+    pet = Pet.query.get(pet_id)
+    if pet is None or other_status(pet.status_lostorfound) is None:
+        return 0
+
+    words = description_words(pet.description)
+    matches = []
+    for candidate, distance in find_candidates(pet, radius, window_days):
+        days_apart = abs((candidate.date_lostorfound - pet.date_lostorfound).total_seconds()) / 86400
+        matches.append((score(distance, days_apart, words, description_words(candidate.description),
+                              radius, window_days), candidate.id, distance, days_apart))
+    matches.sort(key=lambda match: (-match[0], match[1]))
+    matches = matches[:max_matches]
+
+    PetMatch.query.filter(db.or_(PetMatch.pet_id == pet.id, PetMatch.match_id == pet.id)).delete(
+        synchronize_session=False)
+    for match_score, candidate_id, distance, days_apart in matches:
+        for pet_id, match_id in ((pet.id, candidate_id), (candidate_id, pet.id)):
+            store_match({'pet_id': pet_id, 'match_id': match_id, 'score': match_score,
+                         'distance': distance, 'days_apart': days_apart})
+
+    # the candidates only keep their best max_matches
+    for _, candidate_id, _, _ in matches:
+        worse = db.session.query(PetMatch.id).filter(PetMatch.pet_id == candidate_id).order_by(
+            PetMatch.score.desc(), PetMatch.match_id).offset(max_matches).all()
+        if worse:
+            PetMatch.query.filter(PetMatch.id.in_([row.id for row in worse])).delete(synchronize_session=False)
+    db.session.commit()
+    return len(matches)
+
+
+class PetMatcher:
+    """Matches the new pets against the pets of the other status in background
+    threads, the request creating the pet does not wait for it.
+
+    One thread by default, but that only serializes the matching within a process:
+    every worker process has its own matcher, so two pets can still be matched at
+    the same time. Both then store the matches of a common candidate; the pairs
+    are upserted (see store_match), and that candidate may be left with matches
+    trimmed from a stale list. Pending work is lost if the process stops,
+    `flask match-pets` rebuilds all the matches.
+    """
+
+    def __init__(self, app, workers=1):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='matching')
+
+    def config(self):
+        return (self.app.config['MATCH_RADIUS'], self.app.config['MATCH_WINDOW_DAYS'],
+                self.app.config['MATCH_MAX'])
+
+    def submit(self, pet_id):
+        return self.executor.submit(self.run, pet_id)
+
+    def run(self, pet_id):
+        with self.app.app_context():
+            try:
+                return match_pet(pet_id, *self.config())
+            except Exception:
+                logger.exception('matching pet %s failed', pet_id)
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    def match_all(self):
+        """Rebuild the matches of all the pets, in the calling thread"""
+        count = 0
+        for (pet_id,) in db.session.query(Pet.id).order_by(Pet.id).all():
+            match_pet(pet_id, *self.config())
+            count += 1
+        return count
@@ -0,0 +1,223 @@
+import bisect
+import heapq
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+
+# histogram buckets: request latencies and time spent in the DB (seconds),
+# SQL statements per request and rows returned per request
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+# SQL statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 50
+
+FAMILIES = {
+    # name: (type, help, buckets)
+    'http_requests_total': ('counter', 'Requests by endpoint, method and status', None),
+    'http_request_duration_seconds': ('histogram', 'Request latency', SECONDS_BUCKETS),
+    'db_statements_per_request': ('histogram', 'SQL statements run by a request', STATEMENT_BUCKETS),
+    'db_seconds_per_request': ('histogram', 'Time a request spent running SQL statements', SECONDS_BUCKETS),
+    'rows_per_request': ('histogram', 'Items returned by a request', ROW_BUCKETS),
+    'serialization_seconds_per_request': ('histogram', 'Time a request spent serializing JSON', SECONDS_BUCKETS),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    """What one request did, collected while it runs (in flask.g)"""
+
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.slowest = []  # min-heap of the (seconds, statement) of the MAX_LOGGED_STATEMENTS slowest
+        self.rows = 0
+        self.serialization_seconds = 0.0
+
+    def add_statement(self, seconds, statement):
+        self.statements += 1
+        self.db_seconds += seconds
+        if len(self.slowest) < MAX_LOGGED_STATEMENTS:
+            heapq.heappush(self.slowest, (seconds, statement))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, statement))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+class Metrics:
+    """Per worker process registry of the request metrics, rendered in the
+    Prometheus text format. Each gunicorn worker has its own: scrape them all,
+    or sum up over the instances"""
+
+    def __init__(self):
+        self._series = {name: {} for name in FAMILIES}  # name -> {labels: value or Histogram}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            series = self._series[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            series = self._series[name]
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram(FAMILIES[name][2])
+            histogram.observe(value)
+
+    def record(self, request_metrics, status):
+        endpoint = (('endpoint', request_metrics.endpoint),)
+        self.inc('http_requests_total', endpoint + (('method', request_metrics.method), ('status', str(status))))
+        self.observe('http_request_duration_seconds', endpoint, request_metrics.elapsed())
+        self.observe('db_statements_per_request', endpoint, request_metrics.statements)
+        self.observe('db_seconds_per_request', endpoint, request_metrics.db_seconds)
+        self.observe('rows_per_request', endpoint, request_metrics.rows)
+        self.observe('serialization_seconds_per_request', endpoint, request_metrics.serialization_seconds)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (kind, help, buckets) in FAMILIES.items():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for labels, value in sorted(self._series[name].items()):
+                    if kind == 'counter':
+                        lines.append('%s%s %s' % (name, _labels(labels), value))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), value.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', str(bound)),)), cumulative))
+                    lines.append('%s_sum%s %r' % (name, _labels(labels), value.sum))
+                    lines.append('%s_count%s %d' % (name, _labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def current():
+    """Return the RequestMetrics of the running request, None outside of requests"""
+    if has_request_context():
+        return g.get('request_metrics')
+    return None
+
+
+def record_rows(count):
+    """Count items returned by the running request"""
+    request_metrics = current()
+    if request_metrics is not None:
+        request_metrics.rows += count
+
+
+class TimedJSONEncoder(JSONEncoder):
+    """The app JSON encoder, adding the time spent encoding to the running request"""
+
+    def encode(self, o):
+        request_metrics = current()
+        if request_metrics is None:
+            return super().encode(o)
+        started = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            request_metrics.serialization_seconds += time.perf_counter() - started
+
+
+def server_timing(request_metrics):
+    return 'db;dur=%.1f;desc="%d statements", serialize;dur=%.1f, app;dur=%.1f' % (
+        request_metrics.db_seconds * 1000, request_metrics.statements,
+        request_metrics.serialization_seconds * 1000, request_metrics.elapsed() * 1000)
+
+
+'''
+setup_metrics(app, *engines):
+    instruments the requests of app and the SQL statements run on engines, returns
+    the Metrics to expose. SERVER_TIMING adds a Server-Timing header to the
+    responses, requests slower than SLOW_REQUEST_MS are logged with their statements
+'''
+def setup_metrics(app, *engines):
+    app.config.setdefault('SERVER_TIMING', os.getenv('SERVER_TIMING', '') == '1')
+    app.config.setdefault('SLOW_REQUEST_MS', int(os.getenv('SLOW_REQUEST_MS', 500)))
+    metrics = Metrics()
+    app.json_encoder = TimedJSONEncoder
+
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['statement_started'].pop()
+        request_metrics = current()
+        if request_metrics is not None:
+            request_metrics.add_statement(time.perf_counter() - started, statement)
+
+    def failed_statement(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('statement_started'):
+            connection.info['statement_started'].pop()
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', start_statement)
+        event.listen(engine, 'after_cursor_execute', end_statement)
+        event.listen(engine, 'handle_error', failed_statement)
+
+    def log_slow(request_metrics, status):
+        elapsed = request_metrics.elapsed()
+        if elapsed * 1000 < app.config['SLOW_REQUEST_MS']:
+            return
+        statements = '\n'.join('  %8.1f ms  %s' % (seconds * 1000, ' '.join(statement.split())[:200])
+                               for seconds, statement in sorted(request_metrics.slowest, reverse=True)[:10])
+        app.logger.warning('slow request %s %s (%s): %.1f ms, %d SQL statements in %.1f ms, '
+                           'serialization %.1f ms, %d rows\n%s',
+                           request_metrics.method, request_metrics.endpoint, status, elapsed * 1000,
+                           request_metrics.statements, request_metrics.db_seconds * 1000,
+                           request_metrics.serialization_seconds * 1000, request_metrics.rows, statements)
+
+    @app.before_request
+    def start_request():
+        g.request_metrics = RequestMetrics(request.endpoint or 'none', request.method)
+
+    @app.after_request
+    def end_request(response):
+        request_metrics = g.get('request_metrics')
+        if request_metrics is None:
+            return response
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = server_timing(request_metrics)
+
+        # streamed responses are only done once their body was sent
+        status = response.status_code
+        def finish():
+            metrics.record(request_metrics, status)
+            log_slow(request_metrics, status)
+        response.call_on_close(finish)
+        return response
+
+    return metrics
@@ -1,29 +1,371 @@
 import os
 import re
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, String, Integer, Text, Float, ForeignKey, create_engine
+import struct
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import Column, String, Integer, Text, Float, ForeignKey, Index, create_engine, and_, or_, null
 from sqlalchemy.sql.expression import cast
 from sqlalchemy import func
 from sqlalchemy.types import UserDefinedType
+from sqlalchemy import inspect, exists, event, select, text, bindparam
+from sqlalchemy.orm import validates, Session
+from sqlalchemy.orm.base import NO_VALUE
 
 
 from flask_login import UserMixin, LoginManager
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from spatial_index import SpatialIndex, bounding_box, distance_sphere
+from clusters import ClusterGrid, TILE_SIZE, CELL_PIXELS
+from photos import photo_url
+from cache import LocalCacheBackend, RedisCacheBackend, RadiusQueryCache
+import spatial_engines
+from spatial_engines import MySQLSpatialEngine, make_engine
 
 db = SQLAlchemy()
 
 '''
 setup_db(app):
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service,
+    SPATIAL_ENGINE picks the spatial SQL: 'mysql', or 'local' (SQLite, the default
+    for sqlite:// URLs, see spatial_engines.LocalSpatialEngine).
+    DB_POOL_* tune the connection pool of each worker, see pool_options.
+    DATABASE_REPLICA_URL adds a read replica for the map read paths, see read_session
 '''
 def setup_db(app):
     database_path = os.getenv('DATABASE_URL', 'DATABASE_URL_WAS_NOT_SET?!')
 
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SPATIAL_ENGINE", os.getenv('SPATIAL_ENGINE',
+        'local' if database_path.startswith('sqlite') else 'mysql'))
+    app.config.setdefault("DATABASE_REPLICA_URL", os.getenv('DATABASE_REPLICA_URL', ''))
+    app.config.setdefault("DB_REPLICA_MAX_LAG", float(os.getenv('DB_REPLICA_MAX_LAG', 2)))
+    # SQLite (file) connections are not pooled
+    if not database_path.startswith('sqlite'):
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", pool_options(app))
+    if app.config["DATABASE_REPLICA_URL"]:
+        app.config.setdefault("SQLALCHEMY_BINDS", {})['replica'] = app.config["DATABASE_REPLICA_URL"]
     db.app = app
     db.init_app(app)
 
+    Geometry.engine = make_engine(app.config["SPATIAL_ENGINE"])
+    for engine in get_engines(app):
+        Geometry.engine.install(engine)
+
+    ReadReplica.max_lag = app.config["DB_REPLICA_MAX_LAG"]
+    if app.config["DATABASE_REPLICA_URL"]:
+        # binds={} so that every table goes to the replica, not to the engine of its model
+        ReadReplica.session = db.create_scoped_session(
+            options={'bind': db.get_engine(app, 'replica'), 'binds': {}})
+        @app.teardown_appcontext
+        def remove_replica_session(exception=None):
+            ReadReplica.session.remove()
+    else:
+        ReadReplica.session = None
+
+def pool_options(app):
+    """Return the engine options of the connection pools (of the primary and of the replica
+    each). By default a worker keeps one connection per thread (GUNICORN_THREADS), and when
+    DB_MAX_CONNECTIONS is set, the pools of all the workers (WEB_CONCURRENCY) stay within it"""
+    workers = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+    threads = max(1, int(os.getenv('GUNICORN_THREADS', 4)))
+    app.config.setdefault("DB_MAX_CONNECTIONS", int(os.getenv('DB_MAX_CONNECTIONS', 0)))
+    per_worker = app.config["DB_MAX_CONNECTIONS"] // workers
+    if per_worker:
+        pool_size = max(1, min(threads, per_worker))
+        max_overflow = max(0, per_worker - pool_size)
+    else:
+        pool_size = threads
+        max_overflow = 2
+    app.config.setdefault("DB_POOL_SIZE", int(os.getenv('DB_POOL_SIZE', pool_size)))
+    app.config.setdefault("DB_MAX_OVERFLOW", int(os.getenv('DB_MAX_OVERFLOW', max_overflow)))
+    # below the MySQL wait_timeout (and the idle timeouts of proxies in between)
+    app.config.setdefault("DB_POOL_RECYCLE", int(os.getenv('DB_POOL_RECYCLE', 280)))
+    app.config.setdefault("DB_POOL_TIMEOUT", int(os.getenv('DB_POOL_TIMEOUT', 10)))
+    app.config.setdefault("DB_POOL_PRE_PING", os.getenv('DB_POOL_PRE_PING', '1') == '1')
+    return {
+        'pool_size': app.config["DB_POOL_SIZE"],
+        'max_overflow': app.config["DB_MAX_OVERFLOW"],
+        'pool_recycle': app.config["DB_POOL_RECYCLE"],
+        'pool_timeout': app.config["DB_POOL_TIMEOUT"],
+        'pool_pre_ping': app.config["DB_POOL_PRE_PING"],
+    }
+
+def get_engines(app):
+    """Return the engines of app: the primary, and the read replica if there is one"""
+    engines = [db.get_engine(app)]
+    if app.config["DATABASE_REPLICA_URL"]:
+        engines.append(db.get_engine(app, 'replica'))
+    return engines
+
+class ReadReplica:
+    # scoped session on DATABASE_REPLICA_URL, None without replica (see setup_db)
+    session = None
+    # seconds after a write to a table during which this worker reads it from the primary
+    max_lag = 0.0
+
+def read_session(model):
+    """Return the session the read paths of the map query model with: the read replica,
+    unless there is none or this worker wrote to model within DB_REPLICA_MAX_LAG seconds
+    (so that it reads its own writes). The result cache fills on the primary"""
+    if ReadReplica.session is None or time.monotonic() - model.last_write < ReadReplica.max_lag:
+        return db.session
+    return ReadReplica.session
+
+'''
+setup_spatial_index(app):
+    builds the per-worker in-memory spatial indexes and cluster grids of the models,
+    only when SPATIAL_INDEX_ENABLED is set (the tables need to exist by then).
+    Each worker keeps them, and the in-memory indexes of the spatial engine, up to
+    date from the change log, reading it at most every SPATIAL_INDEX_REFRESH_SECONDS,
+    see refresh_indexes
+'''
+def setup_spatial_index(app):
+    app.config.setdefault("SPATIAL_INDEX_ENABLED", os.getenv('SPATIAL_INDEX_ENABLED', '') == '1')
+    app.config.setdefault("SPATIAL_INDEX_REFRESH_SECONDS", float(os.getenv('SPATIAL_INDEX_REFRESH_SECONDS', 1)))
+    IndexRefresh.interval = app.config["SPATIAL_INDEX_REFRESH_SECONDS"]
+    IndexRefresh.settle_seconds = app.config.get("CHANGES_SETTLE_SECONDS", IndexRefresh.settle_seconds)
+    IndexRefresh.spatial_index = app.config["SPATIAL_INDEX_ENABLED"]
+    for model in INDEXED_MODELS:
+        model.spatial_index = None
+        model.cluster_grid = None
+        model.index_version = None
+        model.index_checked = float('-inf')
+    if not IndexRefresh.spatial_index:
+        return
+
+    with app.app_context():
+        for model in (SampleLocation, Pet):
+            load_indexes(model)
+        db.session.remove()
+
+class IndexRefresh:
+    # seconds between two reads of the change log by refresh_indexes
+    interval = 1.0
+    # see stable_version
+    settle_seconds = 2.0
+    # SPATIAL_INDEX_ENABLED
+    spatial_index = False
+    # table name -> versions of the changes read and not settled yet the result cache
+    # already dropped its entries for, see refresh_indexes
+    invalidated = {}
+    lock = threading.Lock()
+
+def has_indexes(model):
+    """Whether model has per-worker state to keep up to date from the change log: its
+    spatial index and cluster grid, the in-memory indexes of the spatial engine, or a
+    result cache of this worker only (whose entries the writes of the others must drop)"""
+    return (model.spatial_index is not None or Geometry.engine.in_memory
+            or (model.result_cache is not None and not model.result_cache.backend.shared))
+
+def reads_rows(model):
+    """Whether refresh_indexes needs the rows of model, not only the change log"""
+    return model.spatial_index is not None or IndexRefresh.spatial_index or Geometry.engine.in_memory
+
+def index_columns(model):
+    """Return the columns the in-memory indexes of model are built from: id, geom, then its search_columns"""
+    return [model.id, model.geom] + [getattr(model, name) for name in getattr(model, 'search_columns', ())]
+
+def grid_columns(model):
+    """Return the extra columns the cluster grid of model needs: the date of the active
+    window, see grid_insert"""
+    return [model.date_lostorfound] if getattr(model, 'active_days', None) is not None else []
+
+def grid_insert(model, item_id, geom, date=None):
+    """Put an item in the cluster grid of model. With an active window (see setup_archive)
+    the grid only has the active items, each one until it leaves the window (see
+    ClusterGrid.expire): its counts cannot be filtered afterwards as the rows are"""
+    active_days = getattr(model, 'active_days', None)
+    if active_days is None:
+        model.cluster_grid.insert(item_id, geom.lat, geom.lng)
+        return
+    expires = date + timedelta(days=active_days)
+    if expires < datetime.utcnow():
+        model.cluster_grid.remove(item_id)
+    else:
+        model.cluster_grid.insert(item_id, geom.lat, geom.lng, expires=expires)
+
+def load_indexes(model):
+    """(Re)build the in-memory indexes of model from its table"""
+    # taken before the rows are read: the changes after it are applied again, which does no harm
+    version = stable_version(model, IndexRefresh.settle_seconds, db.session)
+    columns = index_columns(model)
+    grid = IndexRefresh.spatial_index and model in (SampleLocation, Pet)
+    rows = db.session.query(*columns + (grid_columns(model) if grid else [])).all() if reads_rows(model) else []
+    if grid:
+        model.spatial_index = SpatialIndex()
+        model.cluster_grid = ClusterGrid()
+        for row in rows:
+            model.spatial_index.insert(row[0], row[1].lat, row[1].lng)
+            grid_insert(model, row[0], row[1], *row[len(columns):])
+        rows = [row[:len(columns)] for row in rows]
+    Geometry.engine.load(model, rows)
+    if model.result_cache is not None and not model.result_cache.backend.shared:
+        # the changes in between were not seen
+        model.result_cache.backend.clear()
+    IndexRefresh.invalidated[model.__tablename__] = set()
+    model.index_version = version
+    model.index_checked = time.monotonic()
+
+def refresh_indexes(model, force=False):
+    """Apply the changes of the change log after model.index_version to the in-memory
+    indexes of model (see has_indexes), so that every worker sees the writes of all of
+    them. The log is read at most every IndexRefresh.interval seconds, unless force
+    (a worker applies its own writes right away). Only the changed ids are read
+    again; the changes younger than the settle window (see stable_version) are read
+    again next time, as some change with a lower version may not be committed yet.
+    A per-worker result cache drops its entries around each change, once"""
+    if not has_indexes(model):
+        return
+    if not force and time.monotonic() - model.index_checked < IndexRefresh.interval:
+        return
+    with IndexRefresh.lock:
+        if model.index_version is None:
+            load_indexes(model)
+            return
+        now = time.monotonic()
+        if not force and now - model.index_checked < IndexRefresh.interval:
+            return
+        model.index_checked = now
+        settled = datetime.utcnow() - timedelta(seconds=IndexRefresh.settle_seconds)
+        # on the primary: a worker must see its own writes
+        with db.get_engine().connect() as connection:
+            first = connection.execute(select(func.min(ChangeLog.id))).scalar()
+            # the log was pruned past the changes not applied yet
+            pruned = first is not None and first > model.index_version + 1
+            changes = connection.execute(select(ChangeLog.id, ChangeLog.item_id, ChangeLog.created, ChangeLog.geom).where(
+                ChangeLog.table_name == model.__tablename__,
+                ChangeLog.id > model.index_version
+            ).order_by(ChangeLog.id)).all()
+            changed = list({item_id for _, item_id, _, _ in changes}) if reads_rows(model) else []
+            columns = index_columns(model)
+            width = len(columns)
+            if model.cluster_grid is not None:
+                columns += grid_columns(model)
+            rows = []
+            for start in range(0, len(changed), 1000):
+                rows.extend(connection.execute(select(*columns).where(
+                    model.id.in_(changed[start:start + 1000]))).all())
+        if pruned:
+            load_indexes(model)
+            return
+
+        removed = set(changed).difference(row[0] for row in rows)
+        if model.spatial_index is not None:
+            for item_id in removed:
+                model.spatial_index.remove(item_id)
+                model.cluster_grid.remove(item_id)
+            for row in rows:
+                model.spatial_index.insert(row[0], row[1].lat, row[1].lng)
+                grid_insert(model, row[0], row[1], *row[width:])
+            model.cluster_grid.expire(datetime.utcnow())
+            rows = [row[:width] for row in rows]
+        if changed:
+            Geometry.engine.update(model, rows, removed)
+        invalidated = IndexRefresh.invalidated.setdefault(model.__tablename__, set())
+        if model.result_cache is not None and not model.result_cache.backend.shared:
+            for version, _, _, geom in changes:
+                if version not in invalidated:
+                    model.result_cache.invalidate(geom.lat, geom.lng)
+                    invalidated.add(version)
+        for version, _, created, _ in changes:
+            if created > settled:
+                break
+            model.index_version = version
+        invalidated.difference_update([version for version in invalidated if version <= model.index_version])
+
+'''
+setup_result_cache(app):
+    puts a cache in front of the radius queries of the models, RESULT_CACHE
+    picks the backend: 'local' (per worker LRU, the writes of the other workers drop
+    its entries through the change log within SPATIAL_INDEX_REFRESH_SECONDS), 'redis'
+    (shared, RESULT_CACHE_URL) or '' (no cache)
+'''
+def setup_result_cache(app):
+    app.config.setdefault("RESULT_CACHE", os.getenv('RESULT_CACHE', ''))
+    app.config.setdefault("RESULT_CACHE_URL", os.getenv('RESULT_CACHE_URL', ''))
+    app.config.setdefault("RESULT_CACHE_MAX_ENTRIES", int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 10000)))
+    app.config.setdefault("RESULT_CACHE_TTL", int(os.getenv('RESULT_CACHE_TTL', 300)))
+
+    if app.config["RESULT_CACHE"] == 'local':
+        backend = LocalCacheBackend(app.config["RESULT_CACHE_MAX_ENTRIES"], app.config["RESULT_CACHE_TTL"])
+    elif app.config["RESULT_CACHE"] == 'redis':
+        backend = RedisCacheBackend(app.config["RESULT_CACHE_URL"], app.config["RESULT_CACHE_TTL"])
+    else:
+        backend = None
+
+    for model in (SampleLocation, Pet):
+        model.result_cache = RadiusQueryCache(backend, model.__tablename__) if backend is not None else None
+
+'''
+setup_archive(app):
+    the map APIs only show the pets reported in the last PET_ACTIVE_DAYS days
+    (0 shows them all), `flask archive-pets` moves the older ones to PetArchive
+'''
+def setup_archive(app):
+    app.config.setdefault("PET_ACTIVE_DAYS", int(os.getenv('PET_ACTIVE_DAYS', 180)))
+    Pet.active_days = app.config["PET_ACTIVE_DAYS"] or None
+
+def invalidate_cached(item, *geoms):
+    """Drop the cached radius results around the given positions of item (a model or
+    an instance), called on every write to the models"""
+    inspect(item).mapper.class_.last_write = time.monotonic()
+    if item.result_cache is not None:
+        for geom in geoms:
+            point = Point.from_geom(geom)
+            item.result_cache.invalidate(point.lat, point.lng)
+
+def previous_geom(item):
+    """Return the committed geom of item if it was loaded and then changed, else None"""
+    deleted = inspect(item).attrs.geom.history.deleted
+    if deleted:
+        return deleted[0]
+    if item.spatial_index is not None and item.id in item.spatial_index:
+        return Point(*item.spatial_index.get(item.id))
+    return None
+
+def radius_search(model):
+    """Return the query_radius(lat, lng, radius, limit, after) answering the radius queries
+    of model in memory (its spatial index, or the spatial engine), None when SQL does"""
+    refresh_indexes(model)
+    if model.spatial_index is not None:
+        return model.spatial_index.query_radius
+    return Geometry.engine.radius_search(model)
+
+def active_filters(model):
+    """Return the filter clauses keeping the model items of its active window (see
+    setup_archive): the rows waiting for archive_pets are left out of the map APIs"""
+    active_days = getattr(model, 'active_days', None)
+    if active_days is None:
+        return []
+    return [model.date_lostorfound >= datetime.utcnow() - timedelta(days=active_days)]
+
+def get_indexed_items_within_radius(model, lat, lng, radius, limit, after=None, session=None):
+    """Answer a radius query from the radius_search of model:
+    it already knows the exact distances, so the DB is only asked for the rows by id
+    (with session, read_session(model) by default).
+    The ids whose row is gone or out of the active window are skipped, and more
+    hits are read until limit rows are found or there are no more"""
+    session = session or read_session(model)
+    search = radius_search(model)
+    results = []
+    while len(results) < limit:
+        hits = search(lat, lng, radius, limit=limit, after=after)
+        if not hits:
+            break
+        ids = [item_id for _, item_id in hits]
+        rows = {row.id: row for row in session.query(model).filter(model.id.in_(ids), *active_filters(model)).all()}
+        results.extend((rows[item_id], distance) for distance, item_id in hits if item_id in rows)
+        if len(hits) < limit:
+            break
+        after = hits[-1]
+    return results[:limit]
+
 '''
     drops the database tables and starts fresh
     can be used to initialize a clean database
@@ -67,15 +409,87 @@ def insert_sample_locations():
 # Geometry in your own models when using a MySql DB
 # For more reference see https://docs.sqlalchemy.org/en/14/core/custom_types.html
 
+class Point:
+    """A (lat, lng) position, the value of Geometry('POINT') columns once loaded"""
+    __slots__ = ('lat', 'lng')
+
+    def __init__(self, lat, lng):
+        self.lat = lat
+        self.lng = lng
+
+    def __eq__(self, other):
+        return isinstance(other, Point) and self.lat == other.lat and self.lng == other.lng
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.lat, self.lng))
+
+    def __repr__(self):
+        return 'Point(%r, %r)' % (self.lat, self.lng)
+
+    def wkt(self):
+        return Geometry.point_representation(self.lat, self.lng)
+
+    def to_dict(self):
+        return {'lng': self.lng, 'lat': self.lat}
+
+    @staticmethod
+    def from_geom(geom):
+        """Return geom as a Point, geom being a Point or a 'POINT(lng lat)' WKT string"""
+        if isinstance(geom, Point):
+            return geom
+        longitude, latitude = Geometry.extract_from_point_representation(geom)
+        return Point(latitude, longitude)
+
+    # WKB as returned by ST_AsBinary(): byte order, geometry type, then x and y (lng lat)
+    _wkb_header = struct.Struct('<BI')
+    _wkb_point = {1: struct.Struct('<dd'), 0: struct.Struct('>dd')}
+
+    @staticmethod
+    def from_wkb(data):
+        byte_order = data[0]
+        x, y = Point._wkb_point[byte_order].unpack_from(data, Point._wkb_header.size)
+        return Point(y, x)
+
+
 class Geometry(UserDefinedType):
-    def get_col_spec(self):
-        return 'GEOMETRY' 
+    cache_ok = True
+
+    # the spatial SQL in use (see spatial_engines), set by setup_db
+    engine = MySQLSpatialEngine()
+
+    # geometry_type='POINT', srid=4326 gives a 'POINT SRID 4326' column:
+    # MySQL (>= 8.0) only uses a SPATIAL INDEX on columns restricted to one SRID
+    def __init__(self, geometry_type='GEOMETRY', srid=None):
+        self.geometry_type = geometry_type
+        self.srid = srid
+
+    def get_col_spec(self, **kw):
+        return self.engine.col_spec(self.geometry_type, self.srid)
 
     def bind_expression(self, bindvalue):
-        return func.ST_GeomFromText(bindvalue, SpatialConstants.SRID, type_=self)
+        return self.engine.geom_from_text(bindvalue, type_=self)
 
+    # points are read as WKB and decoded straight into Point values, which is much
+    # cheaper than having MySQL render WKT and parsing the string back, per row
     def column_expression(self, col):
-        return func.ST_AsText(col, type_=self)
+        return self.engine.as_binary(col, type_=self)
+
+    def bind_processor(self, dialect):
+        def process(value):
+            if isinstance(value, Point):
+                return value.wkt()
+            return value
+        return process
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            if value is None:
+                return None
+            return Point.from_wkb(bytes(value))
+        return process
 
     @staticmethod
     def point_representation(latitude, longitude):
@@ -91,23 +505,241 @@ class Geometry(UserDefinedType):
 
 
 class SpatialConstants:
-    SRID = 4326
+    SRID = spatial_engines.SRID
+    # widest envelope (in degrees of longitude) used for the MBR prefilter,
+    # wider boxes are split as the edges of geographic polygons are geodesics
+    MAX_ENVELOPE_WIDTH = 90.0
+
     @staticmethod
     def point_representation(latitude, longitude):
         return 'POINT(%s %s)' % (longitude, latitude)
 
     @staticmethod
     def get_location_latitude(self):
-        point = Geometry.extract_from_point_representation(self.geom)
-        return point[1]
+        return Point.from_geom(self.geom).lat
     @staticmethod
     def get_location_longitude(self):
-        point = Geometry.extract_from_point_representation(self.geom)
-        return point[0]
+        return Point.from_geom(self.geom).lng
+
+
+def point_expression(lat, lng):
+    return Geometry.engine.geom_from_text(Geometry.point_representation(lat, lng))
+
+def distance_expression(column, lat, lng):
+    """Return the SQL expression of the spherical distance (in meters) from column to (lat, lng)"""
+    return Geometry.engine.distance(column, lat, lng)
+
+def split_box(south, west, north, east):
+    """Return boxes at most MAX_ENVELOPE_WIDTH degrees wide covering (south, west, north, east),
+    west > east meaning the box crosses the antimeridian"""
+    if west > east:
+        # crossing the antimeridian: one box on each side
+        spans = [(west, 180.0), (-180.0, east)]
+    else:
+        spans = [(west, east)]
+
+    boxes = []
+    for span_west, span_east in spans:
+        while span_east - span_west > SpatialConstants.MAX_ENVELOPE_WIDTH:
+            boxes.append((south, span_west, north, span_west + SpatialConstants.MAX_ENVELOPE_WIDTH))
+            span_west += SpatialConstants.MAX_ENVELOPE_WIDTH
+        boxes.append((south, span_west, north, span_east))
+    return boxes
+
+def within_box(column, south, west, north, east):
+    """Return a filter clause keeping the points of column inside a lat/lng box,
+    answered by MySQL from the SPATIAL INDEX of the column"""
+    return Geometry.engine.within_boxes(column, split_box(south, west, north, east))
+
+def within_radius(column, lat, lng, radius):
+    """Return a filter clause keeping the points of column within radius meters of (lat, lng).
+
+    st_distance_sphere() cannot use an index, so it is put behind an MBRContains()
+    envelope check which MySQL answers from the SPATIAL INDEX of the column:
+    only the rows inside the bounding box get the exact distance computed.
+    """
+    exact = distance_expression(column, lat, lng) <= radius
+    south, west, north, east = bounding_box(lat, lng, radius)
+    if west == -180.0 and east == 180.0:
+        # the circle reaches a pole, no box helps
+        return exact
+    return and_(within_box(column, south, west, north, east), exact)
+
+def get_clusters(model, zoom, south, west, north, east):
+    """Return the clusters of the model items for a map viewport at a zoom level:
+    items are grouped in cells of CELL_PIXELS x CELL_PIXELS screen pixels, each
+    cluster having its count, centroid and the id of one of its items"""
+    if model.cluster_grid is not None:
+        refresh_indexes(model)
+        return model.cluster_grid.query(zoom, south, west, north, east)
+
+    # without the in-memory grid the DB groups the items of the viewport
+    # by the (web mercator) pixel cell they fall into
+    scale = TILE_SIZE * 2 ** zoom / CELL_PIXELS
+    latitude = Geometry.engine.latitude(model.geom)
+    longitude = Geometry.engine.longitude(model.geom)
+    column = func.floor((longitude + 180.0) / 360.0 * scale)
+    row = func.floor((0.5 - func.ln(func.tan(func.pi() / 4 + func.radians(latitude) / 2)) / (2 * func.pi())) * scale)
+    results = read_session(model).query(
+        func.count(model.id), func.avg(latitude), func.avg(longitude), func.min(model.id)
+    ).filter(
+        within_box(model.geom, south, west, north, east), *active_filters(model)
+    ).group_by(column, row).all()
+
+    return [
+        {
+            'count': count,
+            'sample_id': sample_id,
+            'location': {
+                'lat': float(lat),
+                'lng': float(lng)
+            }
+        }
+        for count, lat, lng, sample_id in results
+    ]
+
+def get_items_in_box(model, south, west, north, east, limit):
+    """Return the model items inside a lat/lng box, by id, at most limit of them"""
+    if model.spatial_index is not None:
+        refresh_indexes(model)
+        ids = sorted(model.spatial_index.query_box(south, west, north, east))
+        # the ids of inactive rows are skipped before the limit, a few pages of ids at a time
+        results = []
+        chunk_size = max(limit, 100)
+        for start in range(0, len(ids), chunk_size):
+            results.extend(read_session(model).query(model).filter(
+                model.id.in_(ids[start:start + chunk_size]), *active_filters(model)).order_by(model.id).all())
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+    return read_session(model).query(model).filter(
+        within_box(model.geom, south, west, north, east), *active_filters(model)
+    ).order_by(model.id).limit(limit).all()
+
+def separate_session(model):
+    """Return a new session on the database read_session(model) is on, with a connection
+    of its own: MySQL cannot read two server-side cursors of one connection in turns.
+    The caller closes it"""
+    # get_bind() of the session itself, not of its scoped_session proxy
+    return Session(bind=read_session(model)().get_bind())
+
+def iter_items_within_radius(model, lat, lng, radius, batch_size=1000, active_only=True, session=None):
+    """Yield (item, distance) of all the model items within radius meters, nearest first,
+    batch_size rows at a time: the rows come through a server-side cursor (or pages of
+    the spatial index), so memory use does not depend on the number of results.
+    active_only=False includes the items out of the active window. session: the
+    session to read with, read_session(model) by default"""
+    session = session or read_session(model)
+    filters = active_filters(model) if active_only else []
+    search = radius_search(model)
+    if search is not None:
+        after = None
+        while True:
+            hits = search(lat, lng, radius, limit=batch_size, after=after)
+            if not hits:
+                return
+            rows = {row.id: row for row in session.query(model).filter(
+                model.id.in_([item_id for _, item_id in hits]), *filters)}
+            for distance, item_id in hits:
+                if item_id in rows:
+                    yield rows[item_id], distance
+            after = hits[-1]
+
+    distance = distance_expression(model.geom, lat, lng)
+    query = session.query(model).add_columns(distance.label('distance')).filter(
+        within_radius(model.geom, lat, lng, radius), *filters
+    ).order_by(distance, model.id)
+    for item, item_distance in query.execution_options(stream_results=True).yield_per(batch_size):
+        yield item, item_distance
+
+def iter_all_items(model, batch_size=1000, active_only=True, session=None):
+    """Yield all the model items by id, batch_size rows at a time through a server-side cursor"""
+    query = (session or read_session(model)).query(model).filter(
+        *(active_filters(model) if active_only else [])).order_by(model.id)
+    for item in query.execution_options(stream_results=True).yield_per(batch_size):
+        yield item
+
+def get_items_page_within_radius(model, lat, lng, radius, limit, after=None, session=None):
+    """Return [(item, distance), ...] of the model items within radius meters, nearest first,
+    read with session (read_session(model) by default).
+
+    Paging is keyset based: after is the (distance, id) of the last item of the
+    previous page, and the page starts right behind it in the (distance, id) order,
+    instead of OFFSET making the DB produce and throw away all the previous pages.
+    """
+    if radius_search(model) is not None:
+        return get_indexed_items_within_radius(model, lat, lng, radius, limit, after, session)
+
+    distance = distance_expression(model.geom, lat, lng)
+    query = (session or read_session(model)).query(model).add_columns(distance.label('distance')).filter(
+        within_radius(model.geom, lat, lng, radius), *active_filters(model))
+    if after is not None:
+        query = query.filter(or_(
+            distance > after[0],
+            and_(distance == after[0], model.id > after[1])))
+    return query.order_by(distance, model.id).limit(limit).all()
+
+def search_items(model, text, filters, limit, after=None, lat=None, lng=None, radius=None):
+    """Return [(item, relevance, distance), ...] of the model items having any of the words
+    of text in their search_columns, most relevant first, keeping only the ones matching
+    the SQL filters and, when lat is given, within radius meters of (lat, lng) (distance
+    is None otherwise).
+
+    The words are looked up in a full-text index, the FULLTEXT index on MySQL or the
+    text_search of the spatial engine, never by scanning the rows. Paging is keyset
+    based on (relevance, id) as in get_items_page_within_radius.
+    """
+    refresh_indexes(model)
+    search = Geometry.engine.text_search(model)
+    if search is not None:
+        return search_indexed_items(model, search, text, filters, limit, after, lat, lng, radius)
+
+    relevance = Geometry.engine.text_relevance([getattr(model, name) for name in model.search_columns], text)
+    query = read_session(model).query(model).add_columns(relevance.label('relevance')).filter(relevance > 0, *filters)
+    if lat is not None:
+        query = query.add_columns(distance_expression(model.geom, lat, lng).label('distance')).filter(
+            within_radius(model.geom, lat, lng, radius))
+    else:
+        query = query.add_columns(null().label('distance'))
+    if after is not None:
+        query = query.filter(or_(
+            relevance < after[0],
+            and_(relevance == after[0], model.id > after[1])))
+    return query.order_by(relevance.desc(), model.id).limit(limit).all()
+
+def search_indexed_items(model, search, text, filters, limit, after, lat, lng, radius):
+    """search_items from an in memory text index: the ids it ranks are intersected with the
+    radius_search of model, then the DB is asked for the rows by id with the filters,
+    a few pages of ids at a time until limit items are found"""
+    scores = search(text)
+    distances = None
+    if lat is not None:
+        distances = {item_id: distance for distance, item_id in radius_search(model)(lat, lng, radius)}
+    ranked = sorted((-score, item_id) for item_id, score in scores.items()
+                    if distances is None or item_id in distances)
+    if after is not None:
+        ranked = [key for key in ranked if key > (-after[0], after[1])]
+
+    results = []
+    chunk_size = max(limit, 100)
+    for start in range(0, len(ranked), chunk_size):
+        chunk = ranked[start:start + chunk_size]
+        rows = {row.id: row for row in read_session(model).query(model).filter(
+            model.id.in_([item_id for _, item_id in chunk]), *filters).all()}
+        for score, item_id in chunk:
+            if item_id in rows:
+                results.append((rows[item_id], -score, distances[item_id] if distances is not None else None))
+                if len(results) == limit:
+                    return results
+    return results
     
 
 class SampleLocation(db.Model):
     __tablename__ = 'sample_locations'
+    __table_args__ = (
+        Index('idx_sample_locations_geom', 'geom', mysql_prefix='SPATIAL'),
+    )
 
     id = Column(Integer, primary_key=True)
     describe = Column(String(80))
@@ -115,60 +747,98 @@ class SampleLocation(db.Model):
     # This is how we will represent where is this item located in the map / in earth:
     # as a POINT, that is a special (the simplest) type of Geometry
     # see this for a nice explanation on alternatives: http://mysql.rjweb.org/doc.php/find_nearest_in_mysql
-    geom = Column(Geometry, nullable=False)
+    geom = Column(Geometry('POINT', srid=SpatialConstants.SRID), nullable=False)
+
+    # per-worker SpatialIndex and ClusterGrid, see setup_spatial_index, and the change log
+    # version and time.monotonic() the in-memory indexes were last brought up to, see refresh_indexes
+    spatial_index = None
+    cluster_grid = None
+    index_version = None
+    index_checked = float('-inf')
+    # RadiusQueryCache, see setup_result_cache
+    result_cache = None
+    # time.monotonic() of the last write of this worker, see read_session
+    last_write = float('-inf')
 
     @staticmethod
     def point_representation(latitude, longitude):
         return 'POINT(%s %s)' % (longitude, latitude)
 
     @staticmethod
-    def get_items_within_radius(lat, lng, radius):
-        """Return all sample locations within a given radius (in meters)"""
+    def get_items_within_radius(lat, lng, radius, limit=100, after=None):
+        """Return the sample locations within a given radius (in meters), nearest first.
+        See get_items_page_within_radius for paging with limit/after"""
+        def compute(lat, lng, radius, limit, after, session=None):
+            results = get_items_page_within_radius(SampleLocation, lat, lng, radius, limit, after, session)
+            return [dict(l.to_dict(), distance=distance) for l, distance in results]
+
+        def fill(lat, lng, radius, limit, after):
+            # on the primary: a replica read may predate the write that bumped the cells
+            return compute(lat, lng, radius, limit, after, db.session)
+
+        if SampleLocation.result_cache is not None:
+            # drops the entries the writes of the other workers made stale
+            refresh_indexes(SampleLocation)
+            return SampleLocation.result_cache.get_or_compute(lat, lng, radius, limit, after, compute, fill)
+        return compute(lat, lng, radius, limit, after)
+
+    @staticmethod
+    def iter_items_within_radius(lat, lng, radius):
+        """Yield all the sample locations within a given radius (in meters), nearest first, see iter_items_within_radius"""
+        for l, distance in iter_items_within_radius(SampleLocation, lat, lng, radius):
+            yield dict(l.to_dict(), distance=distance)
 
-        #TODO: The arbitrary limit = 100 is just a quick way to make sure 
-        # we won't return tons of entries at once, 
-        # paging needs to be in place for real usecase
-        results = SampleLocation.query.filter(
-            func.st_distance_sphere(
-                SampleLocation.geom, 
-                func.ST_GeomFromText(Geometry.point_representation(lat, lng), SpatialConstants.SRID)
-            ) <= radius
-        ).limit(100).all() 
+    @staticmethod
+    def iter_all():
+        """Yield all the sample locations, see iter_all_items"""
+        for l in iter_all_items(SampleLocation):
+            yield l.to_dict()
+
+    @staticmethod
+    def get_clusters(zoom, south, west, north, east):
+        """Return the clusters of sample locations in a map viewport, see get_clusters"""
+        return get_clusters(SampleLocation, zoom, south, west, north, east)
 
-        print("results: ")
-        print(results)
-        return [l.to_dict() for l in results]    
+    @staticmethod
+    def get_items_in_box(south, west, north, east, limit=1000):
+        """Return the sample locations inside a lat/lng box, see get_items_in_box"""
+        return [l.to_dict() for l in get_items_in_box(SampleLocation, south, west, north, east, limit)]    
 
     def get_location_latitude(self):
-        point = Geometry.extract_from_point_representation(self.geom)
-        return point[1]
+        return Point.from_geom(self.geom).lat
 
     def get_location_longitude(self):
-        point = Geometry.extract_from_point_representation(self.geom)
-        return point[0]
+        return Point.from_geom(self.geom).lng
 
     def to_dict(self):
         return {
             'id': self.id,
             'describe': self.describe,
-            'location': {
-                'lng': self.get_location_longitude(),
-                'lat': self.get_location_latitude()
-            }
+            'location': Point.from_geom(self.geom).to_dict()
         }    
 
     def insert(self):
+        geom = self.geom
         db.session.add(self)
         db.session.commit()
+        refresh_indexes(type(self), force=True)
+        invalidate_cached(self, geom)
         
 
     def delete(self):
+        geom = self.geom
         db.session.delete(self)
         db.session.commit()
+        refresh_indexes(type(self), force=True)
+        invalidate_cached(self, geom)
         
 
     def update(self):
+        geom = self.geom
+        previous = previous_geom(self)
         db.session.commit() 
+        refresh_indexes(type(self), force=True)
+        invalidate_cached(self, geom, *([previous] if previous is not None and Point.from_geom(previous) != Point.from_geom(geom) else []))
             
         
 class User(db.Model, UserMixin):
@@ -183,15 +853,72 @@ class User(db.Model, UserMixin):
         return f"User('{self.username}', '{self.email}')"
     
 class Pet(db.Model):
+    __table_args__ = (
+        Index('idx_pet_geom', 'geom', mysql_prefix='SPATIAL'),
+        # candidates of the matching: the other status, within a time window
+        Index('idx_pet_status_date', 'status_lostorfound', 'date_lostorfound'),
+        # the words of the pets, see search_items
+        Index('idx_pet_text', 'petname', 'description', mysql_prefix='FULLTEXT'),
+        # the active window and archive_pets. MySQL cannot put a date and a SPATIAL
+        # column in one index: the SPATIAL one stays small by only having active pets
+        Index('idx_pet_date', 'date_lostorfound'),
+        # archived ids must never be given out again (InnoDB does not either)
+        {'sqlite_autoincrement': True},
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    status_lostorfound = db.Column(db.String(5), unique=True, nullable=False)
+    status_lostorfound = db.Column(db.String(5), nullable=False)
     date_lostorfound = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     petname = db.Column(db.String(20), unique=True)
     description = db.Column(db.Text, nullable=False)
-    geom = db.Column(Geometry, nullable=False)
+    # fingerprint of the normalized description, set along with it (see fingerprint):
+    # duplicate descriptions are looked up on this indexed column, not on the Text
+    description_hash = db.Column(db.String(64), nullable=False, index=True)
+    geom = db.Column(Geometry('POINT', srid=SpatialConstants.SRID), nullable=False)
     image_file= db.Column(db.String(100))
     pet_custodian = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    # per-worker SpatialIndex and ClusterGrid, see setup_spatial_index, and the change log
+    # version and time.monotonic() the in-memory indexes were last brought up to, see refresh_indexes
+    spatial_index = None
+    cluster_grid = None
+    index_version = None
+    index_checked = float('-inf')
+    # RadiusQueryCache, see setup_result_cache
+    result_cache = None
+    # time.monotonic() of the last write of this worker, see read_session
+    last_write = float('-inf')
+    # the columns of the full-text search, see search_items
+    search_columns = ('petname', 'description')
+    # days the pets stay on the map, see setup_archive
+    active_days = None
+
+    @staticmethod
+    def fingerprint(text):
+        """Return the SHA-256 of a text, ignoring case and whitespace differences"""
+        normalized = ' '.join(text.lower().split())
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    @validates('status_lostorfound')
+    def validate_status_lostorfound(self, key, status_lostorfound):
+        # stored as 'Lost' / 'Found' whatever the case it was typed in
+        return status_lostorfound.strip().capitalize() if status_lostorfound else status_lostorfound
+
+    @validates('description')
+    def validate_description(self, key, description):
+        self.description_hash = Pet.fingerprint(description or '')
+        return description
+
+    @staticmethod
+    def find_conflicts(petname, description):
+        """Return which of (petname, description) are already used by a pet,
+        with a single query: one EXISTS per column, each one an index lookup"""
+        row = db.session.query(
+            exists().where(Pet.petname == petname),
+            exists().where(Pet.description_hash == Pet.fingerprint(description or ''))
+        ).one()
+        return tuple(bool(value) for value in row)
+
     def __repr__(self):  
         return f"Pet('{self.petname}', '{self.image_file}', '{self.status_lostorfound}', '{self.type}', '{self.description}','{self.geom}')"
     
@@ -200,12 +927,17 @@ class Pet(db.Model):
         return 'POINT(%s %s)' % (longitude, latitude)
      
     def get_location_latitude(self):
-        point = Geometry.extract_from_point_representation(self.geom)
-        return point[1]
+        return Point.from_geom(self.geom).lat
 
     def get_location_longitude(self):
-        point = Geometry.extract_from_point_representation(self.geom)
-        return point[0] 
+        return Point.from_geom(self.geom).lng
+
+    def insert(self):
+        geom = self.geom
+        db.session.add(self)
+        db.session.commit()
+        refresh_indexes(type(self), force=True)
+        invalidate_cached(self, geom)
                    
     def to_dict(self):
          return {
@@ -214,27 +946,399 @@ class Pet(db.Model):
              'status_lostorfound':self.status_lostorfound,
              'date_lostorfound':self.date_lostorfound,
              'image_file': self.image_file,
+             'thumbnail': photo_url(self.image_file) if self.image_file else None,
              'description': self.description,
-             'location': {
-                 'lng': SpatialConstants.get_location_longitude(self.geom),
-                 'lat': SpatialConstants.get_location_latitude(self.geom)
-             }
+             'location': Point.from_geom(self.geom).to_dict()
          }  
 
      
     @staticmethod
-    def get_items_within_radius(lat, lng, radius):
-        """Return all sample locations within a given radius (in meters)"""
+    def get_items_within_radius(lat, lng, radius, limit=100, after=None):
+        """Return the pets within a given radius (in meters), nearest first.
+        See get_items_page_within_radius for paging with limit/after"""
+        def compute(lat, lng, radius, limit, after, session=None):
+            results = get_items_page_within_radius(Pet, lat, lng, radius, limit, after, session)
+            return [dict(l.to_dict(), distance=distance) for l, distance in results]
 
-        #TODO: The arbitrary limit = 100 is just a quick way to make sure 
-        # we won't return tons of entries at once, 
-        # paging needs to be in place for real usecase
-        results = Pet.query.filter(
-            func.st_distance_sphere(
-                Pet.geom, 
-                func.ST_GeomFromText(Geometry.point_representation(lat, lng), SpatialConstants.SRID)
-            ) <= radius
-        ).limit(100).all() 
+        def fill(lat, lng, radius, limit, after):
+            # on the primary: a replica read may predate the write that bumped the cells
+            return compute(lat, lng, radius, limit, after, db.session)
 
-        
-        return [l.to_dict() for l in results]   
\ No newline at end of file
+        if Pet.result_cache is not None:
+            # drops the entries the writes of the other workers made stale
+            refresh_indexes(Pet)
+            return Pet.result_cache.get_or_compute(lat, lng, radius, limit, after, compute, fill)
+        return compute(lat, lng, radius, limit, after)
+
+    @staticmethod
+    def search(text, limit=20, after=None, lat=None, lng=None, radius=None, start=None, end=None,
+               include_archived=False):
+        """Return the pets matching the words of text, most relevant first, optionally
+        within radius meters of (lat, lng) and lost or found between start and end.
+        See search_items for paging with limit/after"""
+        filters = []
+        if start is not None:
+            filters.append(Pet.date_lostorfound >= start)
+        if end is not None:
+            filters.append(Pet.date_lostorfound <= end)
+        if not include_archived:
+            results = search_items(Pet, text, filters + active_filters(Pet), limit, after, lat, lng, radius)
+            return [dict(pet.to_dict(), relevance=relevance, distance=distance) for pet, relevance, distance in results]
+
+        # both tables are ranked in the same (relevance, id) order: merge their pages
+        archived_filters = []
+        if start is not None:
+            archived_filters.append(PetArchive.date_lostorfound >= start)
+        if end is not None:
+            archived_filters.append(PetArchive.date_lostorfound <= end)
+        results = heapq.merge(
+            search_items(Pet, text, filters, limit, after, lat, lng, radius),
+            search_items(PetArchive, text, archived_filters, limit, after, lat, lng, radius),
+            key=lambda result: (-result[1], result[0].id))
+        return [dict(pet.to_dict(), relevance=relevance, distance=distance)
+                for pet, relevance, distance in itertools.islice(results, limit)]
+
+    @staticmethod
+    def iter_items_within_radius(lat, lng, radius, include_archived=False):
+        """Yield all the pets within a given radius (in meters), nearest first, see iter_items_within_radius"""
+        results = iter_items_within_radius(Pet, lat, lng, radius, active_only=not include_archived)
+        if not include_archived:
+            for l, distance in results:
+                yield dict(l.to_dict(), distance=distance)
+            return
+        # both cursors are read in turns: the archive gets a connection of its own
+        archive_session = separate_session(PetArchive)
+        try:
+            results = heapq.merge(results, iter_items_within_radius(PetArchive, lat, lng, radius, session=archive_session),
+                                  key=lambda result: (result[1], result[0].id))
+            for l, distance in results:
+                yield dict(l.to_dict(), distance=distance)
+        finally:
+            archive_session.close()
+
+    @staticmethod
+    def iter_all(include_archived=False):
+        """Yield all the pets, see iter_all_items"""
+        results = iter_all_items(Pet, active_only=not include_archived)
+        if not include_archived:
+            for l in results:
+                yield l.to_dict()
+            return
+        # both cursors are read in turns: the archive gets a connection of its own
+        archive_session = separate_session(PetArchive)
+        try:
+            for l in heapq.merge(results, iter_all_items(PetArchive, session=archive_session), key=lambda item: item.id):
+                yield l.to_dict()
+        finally:
+            archive_session.close()
+
+    @staticmethod
+    def get_clusters(zoom, south, west, north, east):
+        """Return the clusters of pets in a map viewport, see get_clusters"""
+        return get_clusters(Pet, zoom, south, west, north, east)
+
+    @staticmethod
+    def get_items_in_box(south, west, north, east, limit=1000):
+        """Return the pets inside a lat/lng box, see get_items_in_box"""
+        return [l.to_dict() for l in get_items_in_box(Pet, south, west, north, east, limit)]   
+
+def backfill_description_hash(chunk_size=1000):
+    """Bring a pet table made before Pet.description_hash up to date: the column is
+    added as NULL, filled chunk_size rows per transaction (the hash is computed in
+    Python, see Pet.fingerprint, plain SQL cannot), then indexed and, on MySQL, made
+    NOT NULL (SQLite cannot change a column). Returns the number of rows filled"""
+    engine = db.get_engine()
+    table = Pet.__table__
+    column = table.c.description_hash
+    if column.name not in {c['name'] for c in inspect(engine).get_columns(table.name)}:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE %s ADD COLUMN %s VARCHAR(64) NULL' % (table.name, column.name)))
+
+    filled = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(select(table.c.id, table.c.description).where(
+                column.is_(None)).limit(chunk_size)).all()
+            if not rows:
+                break
+            connection.execute(
+                table.update().where(table.c.id == bindparam('pet_id')).values(description_hash=bindparam('hash')),
+                [{'pet_id': pet_id, 'hash': Pet.fingerprint(description or '')} for pet_id, description in rows])
+        filled += len(rows)
+
+    indexes = {index['name'] for index in inspect(engine).get_indexes(table.name)}
+    with engine.begin() as connection:
+        for index in table.indexes:
+            if column in index.columns.values() and index.name not in indexes:
+                index.create(connection)
+        if engine.dialect.name == 'mysql':
+            connection.execute(text('ALTER TABLE %s MODIFY %s VARCHAR(64) NOT NULL' % (table.name, column.name)))
+    return filled
+
+
+def normalize_pet_status():
+    """Bring a pet table made before the statuses were capitalized up to date: drop
+    the unique index status_lostorfound had (every pet but one Lost and one Found was
+    rejected), then store 'lost' / 'found' as 'Lost' / 'Found' in the pets and their
+    archive. Returns (rows updated, names of the dropped indexes). SQLite cannot drop
+    a UNIQUE constraint declared in its table: that table has to be made again"""
+    engine = db.get_engine()
+    table = Pet.__table__
+    column = table.c.status_lostorfound
+    inspector = inspect(engine)
+    if any(constraint['column_names'] == [column.name] for constraint in inspector.get_unique_constraints(table.name)
+           if engine.dialect.name == 'sqlite'):
+        raise RuntimeError('%s.%s is UNIQUE in the table definition, SQLite cannot drop it: '
+                           'make the table again' % (table.name, column.name))
+    dropped = [index['name'] for index in inspector.get_indexes(table.name)
+               if index['unique'] and index['column_names'] == [column.name]]
+
+    updated = 0
+    with engine.begin() as connection:
+        for name in dropped:
+            if engine.dialect.name == 'mysql':
+                connection.execute(text('ALTER TABLE %s DROP INDEX %s' % (table.name, name)))
+            else:
+                connection.execute(text('DROP INDEX %s' % name))
+        for model in (Pet, PetArchive):
+            if not inspector.has_table(model.__tablename__):
+                continue
+            for status in ('Lost', 'Found'):
+                # compared by their bytes: the MySQL collations ignore the case
+                updated += connection.execute(model.__table__.update().where(
+                    func.lower(model.status_lostorfound) == status.lower(),
+                    func.hex(model.status_lostorfound) != func.hex(status)
+                ).values(status_lostorfound=status)).rowcount
+    return updated, dropped
+
+
+class PetMatch(db.Model):
+    """A possible match of a lost and a found pet (see matching.py), stored once for
+    each of the two pets so that the matches of a pet are one index range"""
+    __tablename__ = 'pet_match'
+    __table_args__ = (
+        Index('idx_pet_match_pet_score', 'pet_id', 'score'),
+        db.UniqueConstraint('pet_id', 'match_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    pet_id = Column(Integer, ForeignKey('pet.id'), nullable=False)
+    match_id = Column(Integer, ForeignKey('pet.id'), nullable=False)
+    score = Column(Float, nullable=False)
+    distance = Column(Float, nullable=False)
+    days_apart = Column(Float, nullable=False)
+    created = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    match = db.relationship('Pet', foreign_keys=[match_id], lazy='joined')
+
+    @staticmethod
+    def get_matches(pet_id, limit=20):
+        """Return the possible matches of a pet, best first"""
+        matches = PetMatch.query.filter(PetMatch.pet_id == pet_id).order_by(
+            PetMatch.score.desc()).limit(limit).all()
+        return [
+            dict(match.match.to_dict(), score=match.score, distance=match.distance, days_apart=match.days_apart)
+            for match in matches
+        ]
+
+
+class PetArchive(db.Model):
+    """The pets moved out of the pet table by archive_pets: same columns and ids,
+    only read when asked for with include_archived"""
+    __tablename__ = 'pet_archive'
+    __table_args__ = (
+        Index('idx_pet_archive_geom', 'geom', mysql_prefix='SPATIAL'),
+        Index('idx_pet_archive_text', 'petname', 'description', mysql_prefix='FULLTEXT'),
+        Index('idx_pet_archive_date', 'date_lostorfound'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    status_lostorfound = Column(String(5), nullable=False)
+    date_lostorfound = Column(db.DateTime, nullable=False)
+    petname = Column(String(20))
+    description = Column(Text, nullable=False)
+    description_hash = Column(String(64), nullable=False)
+    geom = Column(Geometry('POINT', srid=SpatialConstants.SRID), nullable=False)
+    image_file = Column(String(100))
+    pet_custodian = Column(Integer, ForeignKey('user.id'), nullable=False)
+    archived = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # no spatial index or caches: the archive is not on the hot path (the spatial
+    # engine may still keep it in memory, see refresh_indexes)
+    spatial_index = None
+    cluster_grid = None
+    index_version = None
+    index_checked = float('-inf')
+    result_cache = None
+    last_write = float('-inf')
+    search_columns = Pet.search_columns
+
+    def to_dict(self):
+        return dict(Pet.to_dict(self), archived=True)
+
+ARCHIVED_COLUMNS = ('id', 'status_lostorfound', 'date_lostorfound', 'petname', 'description',
+                    'description_hash', 'geom', 'image_file', 'pet_custodian')
+
+def archive_pets(days, chunk_size=1000):
+    """Move the pets reported more than days ago to PetArchive, chunk_size pets per
+    transaction, dropping their matches. The change log gets them as deletes of
+    the pet table and inserts into the archive. Returns the number of pets archived"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    archived = 0
+    while True:
+        pets = db.session.query(Pet).filter(Pet.date_lostorfound < cutoff).order_by(
+            Pet.date_lostorfound, Pet.id).limit(chunk_size).all()
+        if not pets:
+            return archived
+        ids = [pet.id for pet in pets]
+        geoms = [pet.geom for pet in pets]
+        now = datetime.utcnow()
+        db.session.execute(PetArchive.__table__.insert(), [
+            dict({column: getattr(pet, column) for column in ARCHIVED_COLUMNS}, archived=now) for pet in pets
+        ])
+        log_changes(db.session.connection(), [(PetArchive, pet.id, pet.geom, False) for pet in pets])
+        PetMatch.query.filter(or_(PetMatch.pet_id.in_(ids), PetMatch.match_id.in_(ids))).delete(
+            synchronize_session=False)
+        # through the session, so the change log gets the deletes
+        for pet in pets:
+            db.session.delete(pet)
+        db.session.commit()
+        refresh_indexes(Pet, force=True)
+        refresh_indexes(PetArchive, force=True)
+        invalidate_cached(Pet, *geoms)
+        archived += len(pets)
+
+
+class ChangeLog(db.Model):
+    """One row per write to a sample location or pet, its id being the change version:
+    clients that have the items of an area at some version ask for the changes after it
+    (see get_changes) instead of downloading the whole area again"""
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        Index('idx_change_log_geom', 'geom', mysql_prefix='SPATIAL'),
+        Index('idx_change_log_table_id', 'table_name', 'id'),
+        # stable_version: the last change before a time is the first entry of a backward scan
+        Index('idx_change_log_created_id', 'created', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(32), nullable=False)
+    item_id = Column(Integer, nullable=False)
+    deleted = Column(db.Boolean, nullable=False, default=False)
+    # where the item is (or was, for deletes and the old position of moves)
+    geom = Column(Geometry('POINT', srid=SpatialConstants.SRID), nullable=False)
+    created = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# the models whose writes go to the change log (the archive only gets the pets archive_pets moves in)
+LOGGED_MODELS = (SampleLocation, Pet)
+# the models the in-memory indexes are kept of, see refresh_indexes
+INDEXED_MODELS = (SampleLocation, Pet, PetArchive)
+
+def load_previous_geom(target, value, oldvalue, initiator):
+    pass
+
+# the change log needs the position a moved item leaves: setting geom loads the
+# committed one first when it is not loaded (expired after a commit)
+for logged_model in LOGGED_MODELS:
+    event.listen(logged_model.geom, 'set', load_previous_geom, active_history=True)
+
+def log_changes(connection, changes):
+    """Write [(model, item id, geom, deleted), ...] to the change log"""
+    if changes:
+        connection.execute(ChangeLog.__table__.insert(), [
+            {'table_name': model.__tablename__, 'item_id': item_id, 'geom': geom, 'deleted': deleted}
+            for model, item_id, geom, deleted in changes
+        ])
+
+@event.listens_for(SignallingSession, 'after_flush')
+def log_flushed_changes(session, flush_context):
+    """Log the writes of the logged models in the transaction that makes them"""
+    changes = []
+    for item in session.new:
+        if isinstance(item, LOGGED_MODELS):
+            changes.append((type(item), item.id, item.geom, False))
+    for item in session.dirty:
+        if isinstance(item, LOGGED_MODELS) and session.is_modified(item):
+            moved_from = inspect(item).attrs.geom.history.deleted
+            if moved_from and moved_from[0] is not None:
+                changes.append((type(item), item.id, moved_from[0], True))
+            changes.append((type(item), item.id, item.geom, False))
+    for item in session.deleted:
+        geom = inspect(item).attrs.geom.loaded_value
+        if isinstance(item, LOGGED_MODELS) and geom is not NO_VALUE:
+            changes.append((type(item), item.id, geom, True))
+    log_changes(session.connection(), changes)
+
+def log_new_items(model, last_id):
+    """Log the items with an id above last_id, for writes that do not go through
+    the session (bulk ingest), in the transaction of the writes: the caller commits.
+    Returns the highest id logged"""
+    rows = db.session.query(model.id, model.geom).filter(model.id > last_id).order_by(model.id).all()
+    log_changes(db.session.connection(), [(model, item_id, geom, False) for item_id, geom in rows])
+    return rows[-1][0] if rows else last_id
+
+def stable_version(model, settle_seconds, session=None):
+    """Return the version clients can ask the changes after next time.
+
+    Versions are given out when rows are inserted, not when they are committed, so
+    a change may show up after changes with a higher version: the version returned
+    is the last one older than settle_seconds (transactions take less than that),
+    later changes are sent again the next time, which does no harm"""
+    settled = datetime.utcnow() - timedelta(seconds=settle_seconds)
+    version = (session or read_session(model)).query(ChangeLog.id).filter(ChangeLog.created <= settled).order_by(
+        ChangeLog.created.desc(), ChangeLog.id.desc()).limit(1).scalar()
+    return version or 0
+
+def get_changes(model, area, since, limit):
+    """Return [(version, item id, item or None when deleted), ...] of the model items
+    changed in area (a filter clause on ChangeLog.geom) after the version since, the
+    last change of each item, by version. Returns None when the client has to reload
+    the area: there are more than limit changes or the log no longer goes back to since"""
+    session = read_session(model)
+    first, last = session.query(func.min(ChangeLog.id), func.max(ChangeLog.id)).one()
+    if first is not None and not first - 1 <= since <= last:
+        return None
+    rows = session.query(ChangeLog.id, ChangeLog.item_id, ChangeLog.deleted).filter(
+        ChangeLog.table_name == model.__tablename__,
+        ChangeLog.id > since,
+        area
+    ).order_by(ChangeLog.id).limit(limit + 1).all()
+    if len(rows) > limit:
+        return None
+
+    latest = {}
+    for version, item_id, deleted in rows:
+        latest[item_id] = (version, deleted)
+    upserted = [item_id for item_id, (_, deleted) in latest.items() if not deleted]
+    items = {item.id: item for item in session.query(model).filter(model.id.in_(upserted))} if upserted else {}
+    return sorted(
+        (version, item_id, None if deleted else items.get(item_id))
+        for item_id, (version, deleted) in latest.items()
+    )
+
+def get_changes_within_radius(model, lat, lng, radius, since, limit):
+    """Return (upserted item dicts with their distance, deleted ids) of the model items
+    within radius meters changed after the version since, None if the client has to reload"""
+    changes = get_changes(model, within_radius(ChangeLog.geom, lat, lng, radius), since, limit)
+    if changes is None:
+        return None
+    upserts = []
+    deletes = []
+    for _, item_id, item in changes:
+        if item is None:
+            deletes.append(item_id)
+            continue
+        point = Point.from_geom(item.geom)
+        distance = distance_sphere(lat, lng, point.lat, point.lng)
+        if distance <= radius:
+            upserts.append(dict(item.to_dict(), distance=distance))
+        else:
+            # it moved out of the area since
+            deletes.append(item_id)
+    return upserts, deletes
+
+def prune_change_log(days):
+    """Delete the changes older than days, return how many"""
+    deleted = ChangeLog.query.filter(ChangeLog.created < datetime.utcnow() - timedelta(days=days)).delete()
+    db.session.commit()
+    return deleted
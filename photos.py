@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# the sizes a photo is served in, besides the original upload:
+# a few KB thumbnail for the map popups and a bigger one for the pet page
+VARIANTS = {
+    'thumb': (160, 160),
+    'popup': (480, 480),
+}
+VARIANT_QUALITY = 80
+
+# the formats photos are accepted in (as Pillow names them), and their mimetype
+FORMATS = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def photo_url(digest, variant='thumb'):
+    return '/photos/%s/%s' % (digest, variant)
+
+
+def image_format(file):
+    """Return the format (a key of FORMATS) of an image, file being a path or a
+    file-like object (rewound afterwards). Pillow reads and verifies the whole
+    image, raises ValueError when it is not a photo of an accepted format"""
+    from PIL import Image
+    try:
+        with Image.open(file) as image:
+            format = image.format
+            image.verify()
+    # Pillow raises about anything on broken files (OSError, SyntaxError, struct.error...)
+    except Exception as e:
+        raise ValueError('not an image: %s' % e)
+    finally:
+        if hasattr(file, 'seek'):
+            file.seek(0)
+    if format not in FORMATS:
+        raise ValueError('%s images are not accepted' % format)
+    return format
+
+
+class PhotoStore:
+    """Content-addressed photo storage on local disk.
+
+    Uploads are streamed to disk while being hashed and stored under their
+    SHA-256, so the same photo is kept once and a stored file never changes
+    (which is what lets it be served with immutable cache headers).
+    Resized variants are made by a small pool of background threads, the
+    request storing the photo does not wait for them.
+    """
+
+    def __init__(self, root, workers=2):
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photos')
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+
+    def original_path(self, digest):
+        return os.path.join(self.root, 'originals', digest[:2], digest)
+
+    def variant_path(self, digest, variant):
+        return os.path.join(self.root, 'variants', digest[:2], '%s-%s.jpg' % (digest, variant))
+
+    def save(self, stream):
+        """Store an uploaded photo (a file-like object), return its digest. Raises
+        ValueError, storing nothing, when it is not an image (see image_format)"""
+        sha256 = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    tmp.write(chunk)
+            image_format(tmp_path)
+            digest = sha256.hexdigest()
+            path = self.original_path(digest)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                return digest
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.executor.submit(self.make_variants, digest)
+        return digest
+
+    def make_variants(self, digest):
+        try:
+            # Pillow is only needed by the workers making the variants
+            from PIL import Image
+
+            with Image.open(self.original_path(digest)) as image:
+                image = image.convert('RGB')
+                for variant, size in VARIANTS.items():
+                    path = self.variant_path(digest, variant)
+                    if os.path.exists(path):
+                        continue
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    resized = image.copy()
+                    resized.thumbnail(size)
+                    # written aside and renamed, so a half written file is never served
+                    tmp_path = path + '.tmp'
+                    resized.save(tmp_path, 'JPEG', quality=VARIANT_QUALITY, optimize=True, progressive=True)
+                    os.replace(tmp_path, path)
+        except Exception:
+            logger.exception('could not make the variants of photo %s', digest)
+
+    @staticmethod
+    def mimetype(path):
+        """Return the mimetype of a stored file, from the format Pillow reads in its
+        header (not from any file name), None when it is not an accepted photo"""
+        from PIL import Image
+        try:
+            with Image.open(path) as image:
+                return FORMATS.get(image.format)
+        except Exception:
+            return None
+
+    def find(self, digest, variant):
+        """Return (path, final) of the file to serve for a variant of a photo:
+        final is False when the variant is not ready yet and the original is returned"""
+        if variant != 'original':
+            path = self.variant_path(digest, variant)
+            if os.path.exists(path):
+                return path, True
+        path = self.original_path(digest)
+        if os.path.exists(path):
+            return path, variant == 'original'
+        return None, False
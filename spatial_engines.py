@@ -0,0 +1,298 @@
+import functools
+import math
+import re
+import struct
+import threading
+
+from sqlalchemy import event, func, and_, or_
+from sqlalchemy.dialects import mysql
+
+from spatial_index import EARTH_RADIUS, distance_sphere
+from text_index import InvertedIndex
+
+SRID = 4326
+# with SRID 4326 MySQL reads WKT as 'lat lng' unless told otherwise,
+# all our WKT is written as 'lng lat'
+AXIS_ORDER = 'axis-order=long-lat'
+
+
+class MySQLSpatialEngine:
+    """Spatial SQL of MySQL (>= 8.0): geometries are stored in native spatial columns,
+    filtered with MBRContains() on their SPATIAL INDEX and measured with st_distance_sphere()"""
+
+    name = 'mysql'
+    # whether the engine keeps in-memory indexes of the tables, see load / update
+    in_memory = False
+
+    def col_spec(self, geometry_type, srid):
+        if srid is None:
+            return geometry_type
+        return '%s SRID %d' % (geometry_type, srid)
+
+    def geom_from_text(self, wkt, type_=None):
+        return func.ST_GeomFromText(wkt, SRID, AXIS_ORDER, type_=type_)
+
+    def as_binary(self, column, type_=None):
+        return func.ST_AsBinary(column, AXIS_ORDER, type_=type_)
+
+    def distance(self, column, lat, lng):
+        return func.st_distance_sphere(column, self.geom_from_text('POINT(%s %s)' % (lng, lat)))
+
+    def latitude(self, column):
+        return func.ST_Latitude(column)
+
+    def longitude(self, column):
+        return func.ST_Longitude(column)
+
+    def within_boxes(self, column, boxes):
+        return or_(*[
+            func.MBRContains(
+                self.geom_from_text('POLYGON((%s %s, %s %s, %s %s, %s %s, %s %s))' % (
+                    west, south, east, south, east, north, west, north, west, south)),
+                column)
+            for south, west, north, east in boxes
+        ])
+
+    def radius_search(self, model):
+        """Return a query_radius(lat, lng, radius, limit, after) answering the radius
+        queries of model outside of SQL, or None to leave them to the DB"""
+        return None
+
+    def text_relevance(self, columns, text):
+        """Return the SQL expression of the relevance of the row for text, answered
+        from the FULLTEXT index on columns (0 when no word matches)"""
+        return mysql.match(*columns, against=text).in_natural_language_mode()
+
+    def text_search(self, model):
+        """Return a search(text) -> {id: score} answering the full-text queries of
+        model outside of SQL, or None to leave them to the DB (see text_relevance)"""
+        return None
+
+    def install(self, engine):
+        pass
+
+    def load(self, model, rows):
+        """Build the in-memory indexes of model from rows [(id, geom, *search columns)]"""
+        pass
+
+    def update(self, model, rows, removed_ids):
+        """Apply changes to the in-memory indexes of model: rows [(id, geom, *search columns)]
+        were inserted or updated and the rows of removed_ids deleted"""
+        pass
+
+
+# WKB of a point, as ST_AsBinary() returns it: byte order, geometry type, x and y (lng lat)
+_wkb_point = struct.Struct('<BIdd')
+_wkb_coordinates = {1: struct.Struct('<dd'), 0: struct.Struct('>dd')}
+_wkt_point = re.compile(r'^\s*POINT\s*\(\s*(\S+)\s+(\S+)\s*\)\s*$', re.IGNORECASE)
+
+
+def _wkb_from_wkt(wkt, *args):
+    if wkt is None:
+        return None
+    match = _wkt_point.match(wkt)
+    if match is None:
+        raise ValueError('only POINT geometries are supported: %r' % wkt)
+    return _wkb_point.pack(1, 1, float(match.group(1)), float(match.group(2)))
+
+
+def _wkb_coordinates_of(wkb):
+    """Return (lng, lat) of a WKB point"""
+    return _wkb_coordinates[wkb[0]].unpack_from(wkb, 5)
+
+
+def _wkb_latitude(wkb):
+    return None if wkb is None else _wkb_coordinates_of(wkb)[1]
+
+
+def _wkb_longitude(wkb):
+    return None if wkb is None else _wkb_coordinates_of(wkb)[0]
+
+
+def _wkb_distance(a, b):
+    if a is None or b is None:
+        return None
+    lng1, lat1 = _wkb_coordinates_of(a)
+    lng2, lat2 = _wkb_coordinates_of(b)
+    return distance_sphere(lat1, lng1, lat2, lng2)
+
+
+def _math_function(fn):
+    return lambda *args: None if None in args else fn(*args)
+
+
+# registered on every SQLite connection: the MySQL spatial functions our SQL uses,
+# on WKB blobs, and the math functions SQLite is not always built with
+SQLITE_FUNCTIONS = {
+    ('ST_GeomFromText', -1): _wkb_from_wkt,
+    ('ST_AsBinary', -1): lambda wkb, *args: wkb,
+    ('ST_Latitude', 1): _wkb_latitude,
+    ('ST_Longitude', 1): _wkb_longitude,
+    ('st_distance_sphere', 2): _wkb_distance,
+    ('floor', 1): _math_function(math.floor),
+    ('ln', 1): _math_function(math.log),
+    ('tan', 1): _math_function(math.tan),
+    ('radians', 1): _math_function(math.radians),
+    ('pi', 0): lambda: math.pi,
+}
+
+
+class UnitVectors:
+    """The points of one table as NumPy columns: ids and unit vectors (x, y, z) on the sphere"""
+
+    def __init__(self, ids, xyz):
+        self.ids = ids
+        self.xyz = xyz
+
+    @staticmethod
+    def from_points(ids, lats, lngs):
+        import numpy
+        return UnitVectors(numpy.asarray(ids, dtype=numpy.int64),
+                           unit_vectors(numpy.asarray(lats, dtype=numpy.float64).reshape(-1),
+                                        numpy.asarray(lngs, dtype=numpy.float64).reshape(-1)))
+
+    def updated(self, ids, lats, lngs, removed_ids):
+        """Return new columns with the points of ids set (added or moved) and
+        removed_ids left out; the columns are never changed in place, so queries
+        running on them meanwhile are not disturbed"""
+        import numpy
+        changed = UnitVectors.from_points(ids, lats, lngs)
+        kept = ~numpy.isin(self.ids, numpy.concatenate((changed.ids, numpy.asarray(list(removed_ids), dtype=numpy.int64))))
+        return UnitVectors(numpy.concatenate((self.ids[kept], changed.ids)),
+                           numpy.concatenate((self.xyz[kept], changed.xyz)))
+
+
+def unit_vectors(lats, lngs):
+    import numpy
+    lat = numpy.radians(lats)
+    lng = numpy.radians(lngs)
+    cos_lat = numpy.cos(lat)
+    return numpy.column_stack((cos_lat * numpy.cos(lng), cos_lat * numpy.sin(lng), numpy.sin(lat)))
+
+
+class LocalSpatialEngine(MySQLSpatialEngine):
+    """Spatial SQL on SQLite, to run the app, tests and benchmarks without a MySQL server.
+
+    Geometries are stored as WKB blobs (what ST_AsBinary() returns on MySQL) and the
+    MySQL spatial functions are registered on each connection as Python functions, so
+    the queries built for MySQL run unchanged, only without a spatial index: boxes are
+    plain ST_Latitude()/ST_Longitude() ranges.
+
+    Radius queries do not go to SQL: the points of each table are kept as NumPy
+    columns of unit vectors, and a query is one vectorized pass computing the chord
+    length to every point, turned into the same haversine distance as
+    st_distance_sphere(). Needs numpy.
+
+    Full-text queries neither (SQLite has no FULLTEXT index): the search_columns
+    of each table are kept in an InvertedIndex.
+
+    Both are loaded once and then updated with the changed rows only, from the
+    change log (see models.refresh_indexes), so the writes of other processes are seen.
+    """
+
+    name = 'local'
+    in_memory = True
+
+    def __init__(self):
+        self._tables = {}  # table name -> UnitVectors
+        self._texts = {}  # table name -> InvertedIndex
+        self._lock = threading.Lock()
+
+    def col_spec(self, geometry_type, srid):
+        return 'BLOB'
+
+    def within_boxes(self, column, boxes):
+        latitude = self.latitude(column)
+        longitude = self.longitude(column)
+        return or_(*[
+            and_(latitude.between(south, north), longitude.between(west, east))
+            for south, west, north, east in boxes
+        ])
+
+    def install(self, engine):
+        @event.listens_for(engine, 'connect')
+        def register_functions(dbapi_connection, connection_record):
+            for (name, arity), fn in SQLITE_FUNCTIONS.items():
+                dbapi_connection.create_function(name, arity, fn, deterministic=True)
+
+    def load(self, model, rows):
+        vectors = UnitVectors.from_points([row[0] for row in rows],
+                                          [row[1].lat for row in rows],
+                                          [row[1].lng for row in rows])
+        texts = InvertedIndex()
+        for row in rows:
+            if len(row) > 2:
+                texts.add(row[0], *row[2:])
+        with self._lock:
+            self._tables[model.__tablename__] = vectors
+            self._texts[model.__tablename__] = texts
+
+    def update(self, model, rows, removed_ids):
+        with self._lock:
+            vectors = self._tables.get(model.__tablename__)
+            texts = self._texts.get(model.__tablename__)
+        if vectors is None:
+            return self.load(model, rows)
+        # one writer at a time (see models.refresh_indexes): no update gets lost in between
+        vectors = vectors.updated([row[0] for row in rows], [row[1].lat for row in rows],
+                                  [row[1].lng for row in rows], removed_ids)
+        with self._lock:
+            self._tables[model.__tablename__] = vectors
+        for item_id in removed_ids:
+            texts.remove(item_id)
+        for row in rows:
+            if len(row) > 2:
+                texts.add(row[0], *row[2:])
+
+    def vectors(self, model):
+        with self._lock:
+            vectors = self._tables.get(model.__tablename__)
+        if vectors is None:
+            return UnitVectors.from_points([], [], [])
+        return vectors
+
+    def radius_search(self, model):
+        return functools.partial(self.query_radius, model)
+
+    def query_radius(self, model, lat, lng, radius, limit=None, after=None):
+        """Return [(distance, id), ...] of the model items within radius meters of (lat, lng),
+        nearest first, starting after the (distance, id) after when given"""
+        import numpy
+        vectors = self.vectors(model)
+        if not len(vectors.ids):
+            return []
+
+        center = unit_vectors(numpy.array([lat]), numpy.array([lng]))[0]
+        chords = numpy.sqrt(((vectors.xyz - center) ** 2).sum(axis=1))
+        # chord c between two points of the unit sphere <=> central angle 2 * asin(c / 2)
+        distances = 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(chords / 2, 1.0))
+        selected = distances <= radius
+        if after is not None:
+            selected &= (distances > after[0]) | ((distances == after[0]) & (vectors.ids > after[1]))
+
+        ids = vectors.ids[selected]
+        distances = distances[selected]
+        order = numpy.lexsort((ids, distances))
+        if limit is not None:
+            order = order[:limit]
+        return [(float(distances[i]), int(ids[i])) for i in order]
+
+    def text_search(self, model):
+        def search(text):
+            with self._lock:
+                index = self._texts.get(model.__tablename__)
+            return index.search(text) if index is not None else {}
+        return search
+
+
+ENGINES = {
+    'mysql': MySQLSpatialEngine,
+    'local': LocalSpatialEngine,
+}
+
+
+def make_engine(name):
+    try:
+        return ENGINES[name]()
+    except KeyError:
+        raise ValueError('unknown spatial engine %r, expected one of %s' % (name, ', '.join(ENGINES)))
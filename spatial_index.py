@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import math
+import threading
+
+# MySQL's st_distance_sphere uses this radius (in meters) by default,
+# we use the same one so the index and the DB agree on what "within radius" means
+EARTH_RADIUS = 6370986
+
+
+def distance_sphere(lat1, lng1, lat2, lng2):
+    """Return the great circle distance (in meters) between two points (haversine)"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lng, radius):
+    """Return (south, west, north, east) of a box containing the circle of radius meters.
+    west > east means the box crosses the antimeridian, a full longitude range is
+    returned as (-180, 180) when the circle reaches a pole"""
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    south = max(-90.0, lat - dlat)
+    north = min(90.0, lat + dlat)
+    if south == -90.0 or north == 90.0:
+        return south, -180.0, north, 180.0
+
+    dlng = math.degrees(math.asin(min(1.0, math.sin(radius / EARTH_RADIUS) / math.cos(math.radians(lat)))))
+    if dlng >= 180.0:
+        return south, -180.0, north, 180.0
+    west = lng - dlng
+    east = lng + dlng
+    if west < -180.0:
+        west += 360.0
+    if east > 180.0:
+        east -= 360.0
+    return south, west, north, east
+
+
+class SpatialIndex:
+    """In-memory grid index over points, meant to live once per worker process.
+
+    Points are bucketed into a small hierarchy of lat/lng grids (every level is
+    8 times finer than the one above). A radius query walks the cells best-first,
+    ordered by a lower bound of their distance to the centre, and computes the
+    exact distance only for the points of the cells it reaches. Results therefore
+    come out nearest first, and a query with a limit stops as soon as no unvisited
+    cell can hold a closer point: the caller gets the final answer and only has
+    to fetch the rows by primary key.
+    """
+
+    def __init__(self, cell_sizes=(4.0, 0.5, 0.0625, 0.0078125)):
+        self.cell_sizes = cell_sizes
+        # level -> {(row, column): set of child cells} and, on the last level,
+        # {(row, column): {id: (lat, lng)}}
+        self._levels = [{} for _ in cell_sizes]
+        self._points = {}  # id -> (lat, lng)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, item_id):
+        return item_id in self._points
+
+    def get(self, item_id):
+        """Return (lat, lng) of an indexed item, None if not indexed"""
+        return self._points.get(item_id)
+
+    def _cell(self, level, lat, lng):
+        size = self.cell_sizes[level]
+        row = int(math.floor(lat / size))
+        column = int(math.floor((lng + 180.0) / size)) % int(round(360.0 / size))
+        return row, column
+
+    def insert(self, item_id, lat, lng):
+        """Add a point, or move it if item_id is already indexed"""
+        lat = float(lat)
+        lng = float(lng)
+        with self._lock:
+            self._discard(item_id)
+            cells = [self._cell(level, lat, lng) for level in range(len(self.cell_sizes))]
+            for level, cell in enumerate(cells[:-1]):
+                self._levels[level].setdefault(cell, set()).add(cells[level + 1])
+            self._levels[-1].setdefault(cells[-1], {})[item_id] = (lat, lng)
+            self._points[item_id] = (lat, lng)
+
+    def remove(self, item_id):
+        with self._lock:
+            self._discard(item_id)
+
+    def _discard(self, item_id):
+        previous = self._points.pop(item_id, None)
+        if previous is None:
+            return
+        cells = [self._cell(level, *previous) for level in range(len(self.cell_sizes))]
+        bucket = self._levels[-1][cells[-1]]
+        del bucket[item_id]
+        # drop the cells that got empty, bottom up
+        level = len(cells) - 1
+        while level > 0 and not self._levels[level][cells[level]]:
+            del self._levels[level][cells[level]]
+            level -= 1
+            self._levels[level][cells[level]].discard(cells[level + 1])
+        if level == 0 and not self._levels[0][cells[0]]:
+            del self._levels[0][cells[0]]
+
+    def _cell_bounds(self, level, cell, lat, lng):
+        """Return (lower, upper) bounds of the distance from (lat, lng) to any point of the cell"""
+        size = self.cell_sizes[level]
+        south = cell[0] * size
+        west = cell[1] * size - 180.0
+        center_lat = south + size / 2
+        center_lng = west + size / 2
+        # the corners nearest to the equator are the furthest away from the centre
+        corner_lat = south if abs(south) < abs(south + size) else south + size
+        half_diagonal = distance_sphere(center_lat, center_lng, corner_lat, west)
+        distance = distance_sphere(lat, lng, center_lat, center_lng)
+        return max(0.0, distance - half_diagonal), distance + half_diagonal
+
+    def _top_cells(self, lat, lng, radius):
+        """Return the occupied top level cells overlapping the bounding box of the circle"""
+        size = self.cell_sizes[0]
+        columns = int(round(360.0 / size))
+        south, west, north, east = bounding_box(lat, lng, radius)
+        first_row = int(math.floor(south / size))
+        last_row = int(math.floor(north / size))
+        first_column = int(math.floor((west + 180.0) / size))
+        last_column = int(math.floor((east + 180.0) / size))
+        if west > east:
+            # crossing the antimeridian: walk over the end of the column range
+            last_column += columns
+        column_count = min(columns, last_column - first_column + 1)
+        top_level = self._levels[0]
+
+        # walk whichever is smaller: the cells of the box or the occupied cells
+        if (last_row - first_row + 1) * column_count < len(top_level):
+            return [(row, column % columns)
+                    for row in range(first_row, last_row + 1)
+                    for column in range(first_column, first_column + column_count)
+                    if (row, column % columns) in top_level]
+        return [cell for cell in top_level
+                if first_row <= cell[0] <= last_row
+                and (column_count == columns or (cell[1] - first_column) % columns < column_count)]
+
+    def query_box(self, south, west, north, east):
+        """Return the ids of the points inside a lat/lng box (west > east crossing the antimeridian)"""
+        def inside_lng(lng):
+            return west <= lng <= east if west <= east else (lng >= west or lng <= east)
+
+        def overlaps(level, cell):
+            size = self.cell_sizes[level]
+            cell_south = cell[0] * size
+            cell_west = cell[1] * size - 180.0
+            if cell_south > north or cell_south + size < south:
+                return False
+            if west <= east:
+                return cell_west <= east and cell_west + size >= west
+            return cell_west + size >= west or cell_west <= east
+
+        last_level = len(self.cell_sizes) - 1
+        results = []
+        with self._lock:
+            stack = [(0, cell) for cell in self._levels[0] if overlaps(0, cell)]
+            while stack:
+                level, cell = stack.pop()
+                if level == last_level:
+                    results.extend(item_id for item_id, (lat, lng) in self._levels[level][cell].items()
+                                   if south <= lat <= north and inside_lng(lng))
+                    continue
+                stack.extend((level + 1, child) for child in self._levels[level][cell] if overlaps(level + 1, child))
+        return results
+
+    def iter_radius(self, lat, lng, radius, after=None):
+        """Yield (distance, id) of the points within radius meters, nearest first.
+
+        after: optional (distance, id) of the last point of a previous page, only the
+        points sorting after it are yielded. Cells lying completely closer than it are
+        never opened, so a deep page only pays for the ring of cells around the cursor
+        distance, not for all the points of the previous pages.
+        The caller must not insert/remove while iterating.
+        """
+        lat = float(lat)
+        lng = float(lng)
+        after = tuple(after) if after is not None else None
+        min_distance = after[0] if after is not None else 0.0
+        last_level = len(self.cell_sizes) - 1
+
+        # heap entries are (distance, kind, id or level, cell), kind 0 is a point, 1 a cell.
+        # points sort before cells at the same distance so they are emitted asap
+        heap = []
+        for cell in self._top_cells(lat, lng, radius):
+            lower, upper = self._cell_bounds(0, cell, lat, lng)
+            if lower <= radius and upper >= min_distance:
+                heap.append((lower, 1, 0, cell))
+        heapq.heapify(heap)
+
+        while heap:
+            distance, kind, key, cell = heapq.heappop(heap)
+            if distance > radius:
+                return
+            if kind == 0:
+                if after is None or (distance, key) > after:
+                    yield distance, key
+                continue
+
+            level = key
+            if level == last_level:
+                for item_id, (item_lat, item_lng) in self._levels[level][cell].items():
+                    item_distance = distance_sphere(lat, lng, item_lat, item_lng)
+                    if min_distance <= item_distance <= radius:
+                        heapq.heappush(heap, (item_distance, 0, item_id, None))
+                continue
+
+            for child in self._levels[level][cell]:
+                lower, upper = self._cell_bounds(level + 1, child, lat, lng)
+                if lower <= radius and upper >= min_distance:
+                    heapq.heappush(heap, (lower, 1, level + 1, child))
+
+    def query_radius(self, lat, lng, radius, limit=None, after=None):
+        """Return [(distance, id), ...] of the points within radius meters, nearest first"""
+        with self._lock:
+            return list(itertools.islice(self.iter_radius(lat, lng, radius, after), limit))
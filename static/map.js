@@ -1,5 +1,11 @@
 let map;
 let markers;
+// the item markers in the map by item id: a new query only adds, moves and
+// removes the markers of what changed, instead of redrawing them all
+let itemMarkers = {};
+// change version of the items in the map, see pollItemChanges
+let itemsVersion = null;
+let changesTimer = null;
 
 let geocoder;
 
@@ -35,12 +41,65 @@ function initMap() {
     // to call the backend again for new points
     var distanceChange = (queryCenter == null) ? 0 : google.maps.geometry.spherical.computeDistanceBetween (queryCenter, newCenter);
 
-    if (queryCenter == null || queryZoom == null || distanceChange > 100 || newZoom < queryZoom) { //if we have not queried for markers yet, query
+    if (newZoom <= clusterMaxZoom) {
+      // zoomed out: the backend groups the items on screen into clusters
+      refreshClusters(newCenter, newZoom);
+    } else if (queryCenter == null || queryZoom == null || queryZoom <= clusterMaxZoom || distanceChange > 100 || newZoom < queryZoom) { //if we have not queried for markers yet, query
       refreshMarkers(newCenter, newZoom);
     }  
   });
 }
 
+// Up to this zoom level we show clusters (one marker with the number of items
+// per cell of the screen) instead of one marker per item
+var clusterMaxZoom = 12;
+
+function refreshClusters(mapCenter, zoomLevel) {
+  console.log("refreshing clusters")
+  queryCenter = mapCenter;
+  queryZoom = zoomLevel;
+  stopPollingItemChanges();
+
+  var bounds = map.getBounds();
+  var params = {
+    "zoom" : zoomLevel,
+    "south" : bounds.getSouthWest().lat(),
+    "west" : bounds.getSouthWest().lng(),
+    "north" : bounds.getNorthEast().lat(),
+    "east" : bounds.getNorthEast().lng()
+  }
+  var url = "/api/get_clusters?" + dictToURI(params) 
+  loadJSON(url, function(response) {
+      var response_JSON = JSON.parse(response);
+
+      if (!response_JSON.success) {
+          console.log("/api/get_clusters call FAILED!")
+          return
+      }  
+
+      // the map moved meanwhile, a newer query is already running
+      if (queryCenter !== mapCenter || queryZoom !== zoomLevel) {
+          return
+      }
+
+      clearMarkers();
+      placeClustersInMap(response_JSON.clusters)
+   });
+}
+
+function placeClustersInMap(clusters) {
+    markers = clusters.map(function(cluster, i) {
+      var marker = new google.maps.Marker({
+        map: map,
+        position: cluster.location,
+        label: cluster.count > 1 ? String(cluster.count) : null
+      });
+      marker.cluster = cluster;
+
+      return marker;
+    });
+}
+
 var radiusToZoomLevel = [
   800000, // zoom: 0
   800000, // zoom: 1
@@ -68,11 +127,16 @@ function refreshMarkers(mapCenter, zoomLevel) {
   console.log("refreshing markers")
   //Update query center and zoom so we know in referenec to what
   //we queried for markers the last time and can decide if a re-query is needed
+  var previousZoom = queryZoom;
   queryCenter = mapCenter;
   queryZoom = zoomLevel;
+  stopPollingItemChanges();
 
-  // If we had already some markers in the map, we need to clear them
-  clearMarkers();
+  // coming from the clusters, they go away. Item markers already in the map
+  // stay, the ones out of the new area are removed once it is loaded
+  if (previousZoom == null || previousZoom <= clusterMaxZoom) {
+    clearMarkers();
+  }
 
   // This will helpt to understand the radius, its for debug only
   //createCircle(mapCenter,radiusToZoomLevel[zoomLevel]);
@@ -83,6 +147,15 @@ function refreshMarkers(mapCenter, zoomLevel) {
     "lng" : mapCenter.lng(),
     "radius" : radiusToZoomLevel[zoomLevel]
   }
+  loadItemsPage(params, mapCenter, zoomLevel, 0, {});
+}
+
+// The backend returns the items nearest first, one page at a time.
+// We keep following the "next" cursor until there are no more items, 
+// or until we placed maxMarkers in the map
+var maxMarkers = 1000;
+
+function loadItemsPage(params, mapCenter, zoomLevel, loaded, seen) {
   var url = "/api/get_items_in_radius?" + dictToURI(params) 
   loadJSON(url, function(response) {
     // Parse JSON string into object
@@ -95,40 +168,131 @@ function refreshMarkers(mapCenter, zoomLevel) {
           return
       }  
 
+      // the map moved meanwhile, a newer query is already running
+      if (queryCenter !== mapCenter || queryZoom !== zoomLevel) {
+          return
+      }
+
+      // the first page tells the version the results are at
+      if (!params["cursor"]) {
+          itemsVersion = response_JSON.version;
+      }
+
       // place new markers in the map
-      placeItemsInMap(response_JSON.results)
+      placeItemsInMap(response_JSON.results, seen)
+
+      loaded += response_JSON.results.length;
+      if (response_JSON.next && loaded < maxMarkers) {
+          params["cursor"] = response_JSON.next;
+          loadItemsPage(params, mapCenter, zoomLevel, loaded, seen);
+      } else {
+          // the area is loaded: drop the markers left from the previous one
+          for (var id in itemMarkers) {
+              if (!seen[id]) {
+                  removeItemMarker(id);
+              }
+          }
+          startPollingItemChanges(mapCenter, zoomLevel);
+      }
    });
 }
 
-function placeItemsInMap(items) {
-    // Add some markers to the map.
-    // Note: The code uses the JavaScript Array.prototype.map() method to
-    // create an array of markers based on the given "items" array.
-    // The map() method here has nothing to do with the Google Maps API.
-    markers = items.map(function(item, i) {
-      var marker = new google.maps.Marker({
-        map: map,
-        position: item.location
-      });
+// While the map does not move, we only ask for what changed in the area
+// since the version of the items we have (?since=), every changesPollMs
+var changesPollMs = 30000;
+
+function startPollingItemChanges(mapCenter, zoomLevel) {
+  stopPollingItemChanges();
+  if (itemsVersion == null) {
+    return;
+  }
+  changesTimer = setInterval(function() {
+    pollItemChanges(mapCenter, zoomLevel);
+  }, changesPollMs);
+}
+
+function stopPollingItemChanges() {
+  if (changesTimer) {
+    clearInterval(changesTimer);
+    changesTimer = null;
+  }
+}
+
+function pollItemChanges(mapCenter, zoomLevel) {
+  var params = {
+    "lat" : mapCenter.lat(),
+    "lng" : mapCenter.lng(),
+    "radius" : radiusToZoomLevel[zoomLevel],
+    "since" : itemsVersion
+  }
+  var url = "/api/get_items_in_radius?" + dictToURI(params)
+  loadJSON(url, function(response) {
+      var response_JSON = JSON.parse(response);
+
+      if (!response_JSON.success) {
+          console.log("/api/get_items_in_radius?since= call FAILED!")
+          return
+      }
+
+      // the map moved meanwhile
+      if (queryCenter !== mapCenter || queryZoom !== zoomLevel) {
+          return
+      }
+
+      // too many changes (or too old a version): load the area again
+      if (response_JSON.reset) {
+          refreshMarkers(mapCenter, zoomLevel);
+          return
+      }
+
+      placeItemsInMap(response_JSON.upserts, {});
+      response_JSON.deletes.forEach(removeItemMarker);
+      itemsVersion = response_JSON.version;
+   });
+}
+
+function placeItemsInMap(items, seen) {
+    // Add some markers to the map, or move the ones we already have.
+    items.forEach(function(item) {
+      seen[item.id] = true;
+      var marker = itemMarkers[item.id];
+      if (marker) {
+        marker.setPosition(item.location);
+      } else {
+        marker = new google.maps.Marker({
+          map: map,
+          position: item.location
+        });
+        itemMarkers[item.id] = marker;
+      }
 
       //we attach the item to the marker, so when the marker is selected
       //we can get all the item data to fill the highlighted profile box under
       // the map 
       marker.profile = item;
-
-      return marker;
     });
 
     /*console.log(markers);
     console.log(markers.length);*/
 }
 
+function removeItemMarker(id) {
+  var marker = itemMarkers[id];
+  if (marker) {
+    marker.setMap(null);
+    delete itemMarkers[id];
+  }
+}
+
 function clearMarkers() {
   if (markers) {
     markers.map(function(marker, i) {
       marker.setMap(null);
     });
   }
+  for (var id in itemMarkers) {
+    removeItemMarker(id);
+  }
     
   markers = new Array();
   selectedMarker = null;
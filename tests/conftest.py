@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py creates its app on import, from the environment: give it a scratch database
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'import.db'))
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """A fresh app on its own SQLite file, served by the local spatial engine"""
+    monkeypatch.setenv('DATABASE_URL', 'sqlite:///%s' % (tmp_path / 'test.db'))
+    from app import create_app
+    from models import db
+
+    app = create_app({
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'PHOTO_STORAGE': str(tmp_path / 'photos'),
+    })
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def spatial_index(app, monkeypatch):
+    """SPATIAL_INDEX_ENABLED on (the indexes load on first use), the change log read on every query"""
+    from models import SampleLocation, Pet, IndexRefresh
+
+    for model in (SampleLocation, Pet):
+        for name in ('spatial_index', 'cluster_grid', 'index_version', 'index_checked'):
+            monkeypatch.setattr(model, name, getattr(model, name))
+    monkeypatch.setattr(IndexRefresh, 'settle_seconds', 0)
+    monkeypatch.setattr(IndexRefresh, 'interval', 0)
+    monkeypatch.setattr(IndexRefresh, 'spatial_index', True)
+    return app
+
+
+@pytest.fixture
+def user(app):
+    from models import db, User
+
+    user = User(username='owner', email='owner@example.com', password='not a hash')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def client(app, user):
+    """A test client logged in as user"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
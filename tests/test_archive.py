@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+from models import db, Pet, Geometry, archive_pets, refresh_indexes
+
+
+def add_pet(user, name, days_ago, lat=52.5, lng=13.4):
+    pet = Pet(petname=name, status_lostorfound='Lost', description='%s, a pet' % name,
+              date_lostorfound=datetime.utcnow() - timedelta(days=days_ago),
+              geom=Geometry.point_representation(lat, lng), pet_custodian=user.id)
+    pet.insert()
+    return pet
+
+
+def cluster_count():
+    return sum(cluster['count'] for cluster in Pet.get_clusters(10, 52, 13, 53, 14))
+
+
+def test_clusters_only_count_active_pets(spatial_index, user):
+    add_pet(user, 'old', Pet.active_days + 1)
+    leaving = add_pet(user, 'leaving', 10)
+    add_pet(user, 'new', 1)
+    assert Pet.cluster_grid is not None
+    assert cluster_count() == 2
+
+    # time passes: the pet leaves the active window without any write
+    Pet.cluster_grid.expire(leaving.date_lostorfound + timedelta(days=Pet.active_days, seconds=1))
+    assert cluster_count() == 1
+
+
+def test_clusters_follow_date_changes(spatial_index, user):
+    pet = add_pet(user, 'rex', 1)
+    assert cluster_count() == 1
+    pet.date_lostorfound = datetime.utcnow() - timedelta(days=Pet.active_days + 1)
+    db.session.commit()
+    refresh_indexes(Pet, force=True)
+    assert cluster_count() == 0
+
+
+def test_box_limit_applies_to_active_pets(spatial_index, user):
+    for number in range(5):
+        add_pet(user, 'old %d' % number, Pet.active_days + 1, lat=52.5 + number * 0.001)
+    active = [add_pet(user, 'new %d' % number, 1, lat=52.51 + number * 0.001) for number in range(5)]
+    assert Pet.spatial_index is not None
+    assert [pet['id'] for pet in Pet.get_items_in_box(52, 13, 53, 14, limit=3)] == [pet.id for pet in active[:3]]
+
+
+def test_iter_all_merges_the_archive(app, user):
+    pets = [add_pet(user, 'pet %d' % number, days_ago) for number, days_ago in enumerate((400, 1, 300, 2))]
+    ids = [pet.id for pet in pets]
+    assert archive_pets(Pet.active_days) == 2
+    listed = list(Pet.iter_all(include_archived=True))
+    assert [pet['id'] for pet in listed] == sorted(ids)
+    assert [pet.get('archived', False) for pet in listed] == [True, False, True, False]
+    nearby = list(Pet.iter_items_within_radius(52.5, 13.4, 1000, include_archived=True))
+    assert sorted(pet['id'] for pet in nearby) == sorted(ids)
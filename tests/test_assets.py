@@ -0,0 +1,73 @@
+import gzip
+
+from flask import Flask, flash, render_template_string
+
+from assets import DIST_DIR, setup_assets, build_assets
+
+
+def test_pages_are_rendered_once_and_revalidated(app):
+    client = app.test_client()
+    first = client.get('/')
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+
+    second = client.get('/')
+    assert second.headers['ETag'] == etag
+    assert second.data == first.data
+
+    revalidated = client.get('/', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+    assert client.get('/', headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_pages_with_flashed_messages_are_rendered_for_the_request(app):
+    @app.route('/flashing')
+    def flashing():
+        flash('Welcome back', 'info')
+        return 'ok'
+
+    client = app.test_client()
+    cached = client.get('/')
+    client.get('/flashing')
+    response = client.get('/')
+    assert 'ETag' not in response.headers
+    assert b'Welcome back' in response.data
+    # the message was shown once, the cached page comes back
+    assert client.get('/').headers['ETag'] == cached.headers['ETag']
+
+
+def test_without_built_assets_the_static_files_are_linked(tmp_path):
+    (tmp_path / 'map.js').write_text('var a = 1;\n')
+    app = Flask(__name__, static_folder=str(tmp_path), static_url_path='/static')
+    setup_assets(app)
+    with app.test_request_context():
+        assert render_template_string("{{ asset_url('map.js') }}") == '/static/map.js'
+    assert app.test_client().get('/assets/map.js').status_code == 404
+
+
+def test_built_assets_are_fingerprinted_and_precompressed(tmp_path):
+    (tmp_path / 'map.js').write_text('// the map\nfunction show(map) {\n    return map;\n}\n' * 50)
+    manifest = build_assets(str(tmp_path))
+    app = Flask(__name__, static_folder=str(tmp_path), static_url_path='/static')
+    setup_assets(app)
+    with app.test_request_context():
+        url = render_template_string("{{ asset_url('map.js') }}")
+        # the ones that are not built fall back to the static files
+        assert render_template_string("{{ asset_url('main.css') }}") == '/static/main.css'
+    assert url == '/assets/' + manifest['map.js']
+
+    client = app.test_client()
+    built = (tmp_path / DIST_DIR / manifest['map.js']).read_bytes()
+    assert b'// the map' not in built
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype in ('application/javascript', 'text/javascript')
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == built
+
+    plain = client.get(url)
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.data == built
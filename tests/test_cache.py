@@ -0,0 +1,136 @@
+import os
+import random
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from cache import LocalCacheBackend, RadiusQueryCache
+from spatial_index import distance_sphere
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+random.seed(7)
+POINTS = [(item_id, 52.5 + random.uniform(-0.05, 0.05), 13.4 + random.uniform(-0.05, 0.05))
+          for item_id in range(1, 2001)]
+
+
+def compute(lat, lng, radius, limit, after):
+    items = [{'id': item_id, 'location': {'lat': item_lat, 'lng': item_lng},
+              'distance': distance_sphere(lat, lng, item_lat, item_lng)}
+             for item_id, item_lat, item_lng in POINTS]
+    items = sorted((item for item in items if item['distance'] <= radius),
+                   key=lambda item: (item['distance'], item['id']))
+    if after is not None:
+        items = [item for item in items if (item['distance'], item['id']) > tuple(after)]
+    return items[:limit]
+
+
+@pytest.mark.parametrize('radius,limit', [(500, 10), (1000, 100), (3000, 50), (20000, 100)])
+def test_cached_results_are_the_exact_ones(radius, limit):
+    cache = RadiusQueryCache(LocalCacheBackend(), 'test')
+    for _ in range(50):
+        lat, lng = 52.5 + random.uniform(-0.03, 0.03), 13.4 + random.uniform(-0.03, 0.03)
+        # near-identical centres share the entry
+        for lat, lng in ((lat, lng), (lat + 1e-5, lng - 1e-5)):
+            expected = compute(lat, lng, radius, limit, None)
+            result = cache.get_or_compute(lat, lng, radius, limit, None, compute)
+            assert [item['id'] for item in result] == [item['id'] for item in expected]
+            assert [item['distance'] for item in result] == pytest.approx([item['distance'] for item in expected])
+    assert cache.hits
+
+
+def test_writes_invalidate_the_entries_around_them():
+    cache = RadiusQueryCache(LocalCacheBackend(), 'test')
+    cache.get_or_compute(52.5, 13.4, 1000, 10, None, compute)
+    cache.get_or_compute(52.5, 13.4, 1000, 10, None, compute)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.invalidate(40.0, -3.7)
+    cache.get_or_compute(52.5, 13.4, 1000, 10, None, compute)
+    assert (cache.hits, cache.stale) == (2, 0)
+
+    cache.invalidate(52.501, 13.401)
+    cache.get_or_compute(52.5, 13.4, 1000, 10, None, compute)
+    assert (cache.hits, cache.stale) == (2, 1)
+
+
+def test_writes_through_the_models_invalidate_the_cache(app, monkeypatch):
+    from models import SampleLocation, Pet, Geometry, setup_result_cache
+
+    for model in (SampleLocation, Pet):
+        monkeypatch.setattr(model, 'result_cache', None)
+    app.config['RESULT_CACHE'] = 'local'
+    setup_result_cache(app)
+
+    def nearby():
+        return [item['describe'] for item in SampleLocation.get_items_within_radius(52.5, 13.4, 1000)]
+
+    location = SampleLocation(describe='first', geom=Geometry.point_representation(52.5, 13.4))
+    location.insert()
+    assert nearby() == ['first']
+    SampleLocation(describe='second', geom=Geometry.point_representation(52.501, 13.4)).insert()
+    assert nearby() == ['first', 'second']
+    location.geom = Geometry.point_representation(40.4, -3.7)
+    location.update()
+    assert nearby() == ['second']
+    assert SampleLocation.result_cache.stats()['stale'] == 2
+
+
+def test_writes_of_other_workers_invalidate_the_local_cache(app, monkeypatch):
+    from models import SampleLocation, Pet, Geometry, IndexRefresh, setup_result_cache
+
+    for model in (SampleLocation, Pet):
+        monkeypatch.setattr(model, 'result_cache', None)
+    monkeypatch.setattr(IndexRefresh, 'settle_seconds', 0)
+    monkeypatch.setattr(IndexRefresh, 'interval', 0)
+    app.config['RESULT_CACHE'] = 'local'
+    setup_result_cache(app)
+
+    def nearby():
+        return [item['describe'] for item in SampleLocation.get_items_within_radius(52.5, 13.4, 1000)]
+
+    SampleLocation(describe='first', geom=Geometry.point_representation(52.5, 13.4)).insert()
+    assert nearby() == ['first']
+    assert nearby() == ['first']
+    assert SampleLocation.result_cache.hits == 1
+
+    # another worker: its own process and app on the same database
+    subprocess.run([sys.executable, '-c', textwrap.dedent('''
+        from app import create_app
+        from models import SampleLocation, Geometry
+        with create_app({'TESTING': True}).app_context():
+            SampleLocation(describe='second', geom=Geometry.point_representation(52.501, 13.4)).insert()
+    ''')], cwd=ROOT, env=dict(os.environ, DATABASE_URL=app.config['SQLALCHEMY_DATABASE_URI']), check=True)
+    assert nearby() == ['first', 'second']
+    assert SampleLocation.result_cache.stats()['stale'] == 1
+
+
+def test_the_cache_fills_on_the_primary(tmp_path, monkeypatch):
+    from app import create_app
+    from models import db, SampleLocation, Pet, Geometry, IndexRefresh, ReadReplica, read_session
+
+    for model in (SampleLocation, Pet):
+        for name in ('result_cache', 'last_write'):
+            monkeypatch.setattr(model, name, getattr(model, name))
+    monkeypatch.setattr(ReadReplica, 'session', None)
+    monkeypatch.setattr(IndexRefresh, 'settle_seconds', 0)
+    monkeypatch.setattr(IndexRefresh, 'interval', 0)
+    monkeypatch.setenv('DATABASE_URL', 'sqlite:///%s' % (tmp_path / 'primary.db'))
+    app = create_app({
+        'TESTING': True,
+        'RESULT_CACHE': 'local',
+        # a replica that never caught up
+        'DATABASE_REPLICA_URL': 'sqlite:///%s' % (tmp_path / 'replica.db'),
+    })
+    with app.app_context():
+        db.create_all()
+        db.metadata.create_all(db.get_engine(app, 'replica'))
+        SampleLocation(describe='first', geom=Geometry.point_representation(52.5, 13.4)).insert()
+        # the write of another worker: this one reads from the replica
+        SampleLocation.last_write = float('-inf')
+        assert read_session(SampleLocation) is ReadReplica.session
+        result = SampleLocation.get_items_within_radius(52.5, 13.4, 1000)
+        assert [item['describe'] for item in result] == ['first']
+        db.session.remove()
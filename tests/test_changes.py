@@ -0,0 +1,133 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from models import db, SampleLocation, Pet, ChangeLog, Geometry
+
+
+def radius_query(client, **args):
+    args = dict({'lat': 52.5, 'lng': 13.4, 'radius': 1000}, **args)
+    response = client.get('/api/get_items_in_radius', query_string=args)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def add_location(lat, lng, describe='spot'):
+    location = SampleLocation(describe=describe, geom=Geometry.point_representation(lat, lng))
+    location.insert()
+    return location
+
+
+def test_since_returns_the_changes_in_the_area(app):
+    app.config['CHANGES_SETTLE_SECONDS'] = 0
+    client = app.test_client()
+    moved = add_location(52.5, 13.4)
+    deleted = add_location(52.501, 13.4)
+    kept = add_location(52.502, 13.4)
+    first = radius_query(client)
+    assert sorted(item['id'] for item in first['results']) == [moved.id, deleted.id, kept.id]
+
+    added = add_location(52.503, 13.4)
+    add_location(40.4, -3.7, 'far away')
+    moved.geom = Geometry.point_representation(52.6, 13.4)
+    moved.update()
+    deleted.delete()
+
+    changes = radius_query(client, since=first['version'])
+    assert changes['reset'] is False
+    assert [item['id'] for item in changes['upserts']] == [added.id]
+    assert sorted(changes['deletes']) == sorted([moved.id, deleted.id])
+    assert changes['version'] > first['version']
+
+    assert radius_query(client, since=changes['version'])['upserts'] == []
+
+
+def test_since_ahead_of_the_log_resets(app):
+    add_location(52.5, 13.4)
+    assert radius_query(app.test_client(), since=10 ** 9)['reset'] is True
+
+
+def add_pet(user, petname, lat, lng):
+    pet = Pet(petname=petname, status_lostorfound='Lost', date_lostorfound=datetime.utcnow(),
+              description='a dog called %s' % petname, pet_custodian=user.id,
+              geom=Geometry.point_representation(lat, lng))
+    pet.insert()
+    return pet
+
+
+def events(response):
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+    body = response.get_data(as_text=True)
+    # as the server does once the stream ended: frees its place (STREAM_MAX_OPEN)
+    response.close()
+    result = []
+    for block in body.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':') and ': ' in line)
+        if 'event' in fields:
+            result.append((fields['event'], int(fields['id']) if 'id' in fields else None, json.loads(fields['data'])))
+    return result
+
+
+@pytest.fixture
+def short_streams(app):
+    app.config.update(CHANGES_SETTLE_SECONDS=0, STREAM_POLL_SECONDS=0.01, STREAM_MAX_SECONDS=0.05)
+    return app
+
+
+def test_the_pet_stream_sends_the_changes_in_its_viewport(short_streams, user):
+    client = short_streams.test_client()
+    viewport = {'south': 52.4, 'west': 13.3, 'north': 52.6, 'east': 13.5}
+    version = radius_query(client)['version']
+    laika = add_pet(user, 'Laika', 52.5, 13.4)
+    add_pet(user, 'Bello', 40.4, -3.7)
+    gone = add_pet(user, 'Rex', 52.51, 13.41)
+    db.session.delete(gone)
+    db.session.commit()
+
+    sent = events(client.get('/api/pets/stream', query_string=dict(viewport, since=version)))
+    assert [(event, data.get('petname', data['id'])) for event, _, data in sent] == [('pet', 'Laika'), ('delete', gone.id)]
+    assert sent[0][2]['id'] == laika.id
+    assert sent[0][1] < sent[1][1]
+
+    # a reconnecting EventSource resumes after the last event it got
+    resumed = events(client.get('/api/pets/stream', query_string=viewport, headers={'Last-Event-ID': str(sent[0][1])}))
+    assert [event for event, _, _ in resumed] == ['delete']
+    # without since, from now on
+    assert events(client.get('/api/pets/stream', query_string=viewport)) == []
+
+    assert client.get('/api/pets/stream', query_string=dict(viewport, south='x')).status_code == 400
+    assert client.get('/api/pets/stream', query_string={'south': 52.4}).status_code == 400
+
+
+def test_the_pet_stream_resets_past_the_pruned_log(short_streams, user):
+    client = short_streams.test_client()
+    add_pet(user, 'Laika', 52.5, 13.4)
+    add_pet(user, 'Bello', 52.5, 13.4)
+    db.session.query(ChangeLog).filter(ChangeLog.id == db.session.query(db.func.min(ChangeLog.id)).scalar_subquery()).delete(
+        synchronize_session=False)
+    db.session.commit()
+    sent = events(client.get('/api/pets/stream', query_string={'south': 52.4, 'west': 13.3, 'north': 52.6, 'east': 13.5, 'since': 0}))
+    assert [event for event, _, _ in sent] == ['reset']
+
+
+def test_open_streams_are_limited(app):
+    client = app.test_client()
+    viewport = {'south': 52.4, 'west': 13.3, 'north': 52.6, 'east': 13.5}
+    opened = [client.get('/api/pets/stream', query_string=viewport, buffered=False)
+              for _ in range(app.config['STREAM_MAX_OPEN'])]
+    assert [response.status_code for response in opened] == [200] * app.config['STREAM_MAX_OPEN']
+
+    refused = client.get('/api/pets/stream', query_string=viewport)
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After'] == '30'
+
+    # a closed stream frees its place
+    opened.pop().close()
+    response = client.get('/api/pets/stream', query_string=viewport, buffered=False)
+    assert response.status_code == 200
+    # last opened, first closed: each one holds a request context
+    for response in reversed(opened + [response]):
+        response.close()
@@ -0,0 +1,91 @@
+import threading
+
+import bcrypt
+import pytest
+
+from hashing import PasswordHasher, HashingBusy, hash_rounds, max_pending_for
+from models import db, User
+
+
+def test_max_pending_stays_below_the_threads():
+    assert max_pending_for(4) == 3
+    assert max_pending_for(1) == 1
+    assert max_pending_for(4, 2) == 2
+    with pytest.raises(ValueError):
+        max_pending_for(4, 4)
+    with pytest.raises(ValueError):
+        max_pending_for(4, 0)
+
+
+def test_startup_refuses_a_pool_taking_all_the_threads(app):
+    from app import create_app
+    with pytest.raises(ValueError):
+        create_app({'TESTING': True, 'GUNICORN_THREADS': 4, 'BCRYPT_MAX_PENDING': 8})
+
+
+class SlowBcrypt:
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def generate_password_hash(self, password, rounds):
+        self.started.set()
+        self.release.wait(5)
+        return b'hash'
+
+
+def test_a_full_pool_fails_fast():
+    slow = SlowBcrypt()
+    hasher = PasswordHasher(slow, 4, workers=1, max_pending=1)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(hasher.hash('password')))
+    thread.start()
+    slow.started.wait(5)
+    with pytest.raises(HashingBusy):
+        hasher.hash('password')
+    slow.release.set()
+    thread.join()
+    assert results == ['hash']
+    # the slot is free again
+    assert hasher.hash('password') == 'hash'
+
+
+def add_user(rounds):
+    user = User(username='owner', email='owner@example.com',
+                password=bcrypt.hashpw(b'secret', bcrypt.gensalt(rounds)).decode('utf-8'))
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(app):
+    return app.test_client().post('/login', data={'email': 'owner@example.com', 'password': 'secret'})
+
+
+def test_logins_get_a_503_when_the_pool_is_full(app, monkeypatch):
+    add_user(4)
+    hasher = app.extensions['password_hasher']
+    monkeypatch.setattr(hasher, '_slots', threading.BoundedSemaphore(1))
+    hasher._slots.acquire()
+    response = login(app)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+
+
+def test_login_upgrades_the_hash_to_the_configured_cost(app, monkeypatch):
+    user = add_user(4)
+    monkeypatch.setattr(app.extensions['password_hasher'], 'rounds', 5)
+    assert login(app).status_code == 302
+    assert hash_rounds(User.query.get(user.id).password) == 5
+
+
+def test_login_goes_on_when_the_rehash_finds_the_pool_busy(app, monkeypatch):
+    user = add_user(4)
+    hasher = app.extensions['password_hasher']
+    monkeypatch.setattr(hasher, 'rounds', 5)
+
+    def busy(password):
+        raise HashingBusy()
+    monkeypatch.setattr(hasher, 'hash', busy)
+    assert login(app).status_code == 302
+    assert hash_rounds(User.query.get(user.id).password) == 4
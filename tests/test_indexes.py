@@ -0,0 +1,67 @@
+import pytest
+
+from models import db, SampleLocation, IndexRefresh, Geometry, load_indexes, log_changes, refresh_indexes
+
+
+@pytest.fixture
+def indexed(spatial_index):
+    """The spatial index of the sample locations on, over 10 locations"""
+    for lat in range(10):
+        SampleLocation(describe='seed %d' % lat,
+                       geom=Geometry.point_representation(52.5 + lat * 0.001, 13.4)).insert()
+    load_indexes(SampleLocation)
+    return spatial_index
+
+
+def other_worker_insert(lat, lng):
+    """Insert a sample location and log it as another process would: this one is not told"""
+    wkt = Geometry.point_representation(lat, lng)
+    with db.get_engine().begin() as connection:
+        item_id = connection.execute(SampleLocation.__table__.insert().values(
+            describe='other worker', geom=wkt)).inserted_primary_key[0]
+        log_changes(connection, [(SampleLocation, item_id, wkt, False)])
+    return item_id
+
+
+def other_worker_delete(item_id):
+    table = SampleLocation.__table__
+    with db.get_engine().begin() as connection:
+        connection.execute(table.delete().where(table.c.id == item_id))
+        log_changes(connection, [(SampleLocation, item_id, Geometry.point_representation(0, 0), True)])
+
+
+def ids_within_radius(limit=100):
+    return [item['id'] for item in SampleLocation.get_items_within_radius(52.5, 13.4, 5000, limit=limit)]
+
+
+def test_writes_of_other_workers_are_seen(indexed):
+    new_id = other_worker_insert(52.4995, 13.4)
+    assert new_id in ids_within_radius()
+    assert len(SampleLocation.get_clusters(10, 52, 13, 53, 14)) == 1
+    assert SampleLocation.get_clusters(10, 52, 13, 53, 14)[0]['count'] == 11
+
+    first = ids_within_radius()[0]
+    other_worker_delete(first)
+    assert first not in ids_within_radius()
+    assert SampleLocation.get_clusters(10, 52, 13, 53, 14)[0]['count'] == 10
+
+
+def test_refresh_is_throttled(indexed, monkeypatch):
+    monkeypatch.setattr(IndexRefresh, 'interval', 3600)
+    refresh_indexes(SampleLocation, force=True)
+    new_id = other_worker_insert(52.4995, 13.4)
+    assert new_id not in ids_within_radius()
+    refresh_indexes(SampleLocation, force=True)
+    assert new_id in ids_within_radius()
+
+
+def test_pages_are_filled_past_missing_rows(indexed, monkeypatch):
+    # rows gone without the index knowing yet
+    monkeypatch.setattr(IndexRefresh, 'interval', 3600)
+    refresh_indexes(SampleLocation, force=True)
+    nearest = ids_within_radius()
+    table = SampleLocation.__table__
+    with db.get_engine().begin() as connection:
+        connection.execute(table.delete().where(table.c.id.in_(nearest[:6])))
+    assert ids_within_radius(limit=3) == nearest[6:9]
+    assert ids_within_radius(limit=10) == nearest[6:]
@@ -0,0 +1,69 @@
+import io
+import json
+
+import pytest
+
+from ingest import ingest_locations, validate_location
+from models import ChangeLog, SampleLocation
+
+
+def ndjson(*records):
+    return io.BytesIO(''.join(json.dumps(record) + '\n' for record in records).encode('utf-8'))
+
+
+@pytest.mark.parametrize('record', [
+    {'lat': 52.5, 'lng': 13.4, 'describe': 12},
+    {'lat': 52.5, 'lng': 13.4, 'describe': {'title': 'x'}},
+    {'lat': 52.5, 'lng': 13.4, 'describe': 'x' * 81},
+    {'lat': [52.5], 'lng': 13.4},
+    {'lat': True, 'lng': 13.4},
+    {'lat': 'north', 'lng': 13.4},
+    {'lat': 91, 'lng': 13.4},
+    {'lat': 52.5, 'lng': float('nan')},
+    {'lng': 13.4},
+    [52.5, 13.4],
+])
+def test_invalid_records_raise_value_error(record):
+    with pytest.raises(ValueError):
+        validate_location(record)
+
+
+def test_csv_strings_are_numbers():
+    row = validate_location({'lat': '52.5', 'lng': '13.4', 'describe': ''})
+    assert row['geom'] == 'POINT(13.4 52.5)'
+
+
+def test_bad_records_are_reported_per_record(app):
+    report = ingest_locations(ndjson(
+        {'lat': 52.5, 'lng': 13.4, 'describe': 'ok'},
+        {'lat': 52.5, 'lng': 13.4, 'describe': 42},
+        {'lat': 52.6, 'lng': 13.5},
+    ), chunk_size=1)
+    assert report.rows == 2
+    assert report.failed == 1
+    assert report.errors == [{'line': 2, 'error': 'describe must be a string'}]
+    assert SampleLocation.query.count() == 2
+
+
+def test_bulk_ingest_endpoint(app):
+    app.config['INGEST_TOKEN'] = 'secret'
+    client = app.test_client()
+    response = client.post('/api/bulk_ingest?chunk_size=1000000000',
+                           data=ndjson({'lat': 52.5, 'lng': 13.4}, {'lat': 52.5, 'lng': 13.4, 'describe': 7}),
+                           headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.get_json()['report']['rows'] == 1
+    assert response.get_json()['report']['failed'] == 1
+
+
+def test_ingested_rows_are_in_the_change_log(app):
+    ingest_locations(ndjson(
+        {'lat': 52.5, 'lng': 13.4},
+        {'lat': 52.5, 'lng': 13.4, 'describe': 42},
+        {'lat': 52.6, 'lng': 13.5},
+        {'lat': 52.7, 'lng': 13.6},
+    ), chunk_size=2)
+    logged = ChangeLog.query.filter_by(table_name=SampleLocation.__tablename__).all()
+    assert sorted(change.item_id for change in logged) == sorted(
+        item_id for (item_id,) in SampleLocation.query.with_entities(SampleLocation.id))
+    assert len(logged) == 3
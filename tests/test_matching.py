@@ -0,0 +1,91 @@
+from models import Pet, PetMatch
+
+BERLIN = (52.5200, 13.4050)
+
+
+def report(client, petname, status, date, lat, lng, description):
+    response = client.post('/lost', data={
+        'petname': petname,
+        'status_lostorfound': status,
+        'date_lostorfound': date,
+        'description': description,
+        'coord_latitude': str(lat),
+        'coord_longitude': str(lng),
+    })
+    assert response.status_code == 302, response.get_data(as_text=True)
+    return Pet.query.filter_by(petname=petname).one().id
+
+
+def wait_for_matching(app):
+    app.extensions['pet_matcher'].executor.shutdown(wait=True)
+
+
+def matches_of(pet_id):
+    return {match.match_id: match for match in PetMatch.query.filter_by(pet_id=pet_id)}
+
+
+def test_reports_of_both_statuses_are_accepted_and_matched(app, client):
+    laika = report(client, 'Laika', 'Lost', '2026-03-01', BERLIN[0], BERLIN[1], 'black labrador red collar')
+    bello = report(client, 'Bello', 'lost', '2026-03-02', BERLIN[0] + 0.01, BERLIN[1], 'brown terrier')
+    near = report(client, 'Found1', 'Found', '2026-03-03', BERLIN[0] + 0.002, BERLIN[1], 'black labrador with a collar')
+    other = report(client, 'Found2', 'found', '2026-03-10', BERLIN[0] + 0.02, BERLIN[1], 'small terrier')
+    far = report(client, 'Found3', 'Found', '2026-03-03', 48.1372, 11.5756, 'black labrador red collar munich')
+    late = report(client, 'Found4', 'Found', '2026-06-01', BERLIN[0], BERLIN[1], 'black labrador months later')
+    wait_for_matching(app)
+
+    assert Pet.query.get(bello).status_lostorfound == 'Lost'
+    assert set(matches_of(laika)) == {near, other}
+    assert set(matches_of(bello)) == {near, other}
+    assert matches_of(far) == {}
+    assert matches_of(late) == {}
+    # stored for both pets of a pair, with the same score
+    assert matches_of(near)[laika].score == matches_of(laika)[near].score
+    # closer, sooner and with the same words ranks first
+    assert matches_of(laika)[near].score > matches_of(laika)[other].score
+
+
+def test_matches_api_is_ranked(app, client):
+    laika = report(client, 'Laika', 'Lost', '2026-03-01', BERLIN[0], BERLIN[1], 'black labrador red collar')
+    report(client, 'Found1', 'Found', '2026-03-03', BERLIN[0] + 0.002, BERLIN[1], 'black labrador with a collar')
+    report(client, 'Found2', 'Found', '2026-03-20', BERLIN[0] + 0.03, BERLIN[1], 'grey cat')
+    wait_for_matching(app)
+
+    results = client.get('/api/pets/%d/matches' % laika).get_json()['results']
+    assert [result['petname'] for result in results] == ['Found1', 'Found2']
+    assert results[0]['score'] >= results[1]['score']
+
+
+def test_duplicate_name_is_rejected(app, client):
+    report(client, 'Laika', 'Lost', '2026-03-01', BERLIN[0], BERLIN[1], 'black labrador')
+    response = client.post('/lost', data={
+        'petname': 'Laika', 'status_lostorfound': 'Found', 'date_lostorfound': '2026-03-02',
+        'description': 'another dog', 'coord_latitude': '52.5', 'coord_longitude': '13.4',
+    })
+    assert response.status_code == 200
+    assert Pet.query.count() == 1
+
+
+
+def test_a_pair_stored_meanwhile_is_updated(app, client, monkeypatch):
+    import matching
+    from models import db
+
+    laika = report(client, 'Laika', 'Lost', '2026-03-01', BERLIN[0], BERLIN[1], 'black labrador red collar')
+    near = report(client, 'Found1', 'Found', '2026-03-03', BERLIN[0] + 0.002, BERLIN[1], 'black labrador with a collar')
+    wait_for_matching(app)
+    score = matches_of(laika)[near].score
+
+    # another worker matching the found pet stores the pair after this one cleared it
+    store_match = matching.store_match
+    def store_match_concurrently(row):
+        if not PetMatch.query.count():
+            db.session.execute(PetMatch.__table__.insert(), [
+                {'pet_id': laika, 'match_id': near, 'score': 0.1, 'distance': 1.0, 'days_apart': 1.0},
+                {'pet_id': near, 'match_id': laika, 'score': 0.1, 'distance': 1.0, 'days_apart': 1.0}])
+        store_match(row)
+    monkeypatch.setattr(matching, 'store_match', store_match_concurrently)
+
+    assert matching.match_pet(laika, app.config['MATCH_RADIUS'], app.config['MATCH_WINDOW_DAYS'],
+                              app.config['MATCH_MAX']) == 1
+    assert matches_of(laika)[near].score == score
+    assert matches_of(near)[laika].score == score
@@ -0,0 +1,61 @@
+import logging
+import re
+
+from metrics import MAX_LOGGED_STATEMENTS, RequestMetrics
+from models import SampleLocation, Geometry
+
+
+def test_the_slowest_statements_are_kept():
+    request_metrics = RequestMetrics('test', 'GET')
+    durations = [(i * 37) % 101 / 1000 for i in range(200)]
+    for i, seconds in enumerate(durations):
+        request_metrics.add_statement(seconds, 'SELECT %d' % i)
+    assert request_metrics.statements == 200
+    assert len(request_metrics.slowest) == MAX_LOGGED_STATEMENTS
+    assert sorted(seconds for seconds, _ in request_metrics.slowest) == sorted(durations)[-MAX_LOGGED_STATEMENTS:]
+
+
+def test_requests_are_counted(app):
+    client = app.test_client()
+    SampleLocation(describe='spot', geom=Geometry.point_representation(52.5, 13.4)).insert()
+    # a request is recorded once its response is closed (sent)
+    for _ in range(2):
+        response = client.get('/api/get_items_in_radius?lat=52.5&lng=13.4&radius=1000')
+        assert response.status_code == 200
+        response.close()
+    response = client.get('/api/get_items_in_radius?lat=52.5&lng=13.4&radius=1000&cursor=x')
+    assert response.status_code == 400
+    response.close()
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE http_requests_total counter' in text
+    assert 'http_requests_total{endpoint="get_items_in_radius",method="GET",status="200"} 2' in text
+    assert 'http_requests_total{endpoint="get_items_in_radius",method="GET",status="400"} 1' in text
+    assert 'http_request_duration_seconds_count{endpoint="get_items_in_radius"} 3' in text
+    assert 'rows_per_request_bucket{endpoint="get_items_in_radius",le="1"} 3' in text
+    assert re.search(r'db_statements_per_request_sum\{endpoint="get_items_in_radius"\} [1-9]', text)
+
+
+def test_server_timing(app):
+    client = app.test_client()
+    response = client.get('/api/get_items_in_radius?lat=52.5&lng=13.4&radius=1000')
+    assert 'Server-Timing' not in response.headers
+
+    app.config['SERVER_TIMING'] = True
+    response = client.get('/api/get_items_in_radius?lat=52.5&lng=13.4&radius=1000')
+    assert re.fullmatch(r'db;dur=[\d.]+;desc="[1-9]\d* statements", serialize;dur=[\d.]+, app;dur=[\d.]+',
+                        response.headers['Server-Timing'])
+
+
+def test_slow_requests_are_logged(app, caplog):
+    client = app.test_client()
+    with caplog.at_level(logging.WARNING):
+        client.get('/api/get_items_in_radius?lat=52.5&lng=13.4&radius=1000').close()
+        assert not [record for record in caplog.records if 'slow request' in record.getMessage()]
+
+        app.config['SLOW_REQUEST_MS'] = 0
+        client.get('/api/get_items_in_radius?lat=52.5&lng=13.4&radius=1000').close()
+    messages = [record.getMessage() for record in caplog.records if 'slow request' in record.getMessage()]
+    assert len(messages) == 1
+    assert messages[0].startswith('slow request GET get_items_in_radius (200)')
+    assert 'SELECT' in messages[0]
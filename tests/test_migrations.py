@@ -0,0 +1,44 @@
+from sqlalchemy import inspect, text
+
+from models import db, Pet, backfill_description_hash
+
+
+def test_backfill_description_hash(app, user):
+    # a pet table from before description_hash
+    with db.engine.begin() as connection:
+        connection.execute(text('DROP INDEX ix_pet_description_hash'))
+        connection.execute(text('ALTER TABLE pet DROP COLUMN description_hash'))
+        for number, description in enumerate(['Black  Labrador', 'grey cat', None]):
+            connection.execute(text(
+                "INSERT INTO pet (status_lostorfound, date_lostorfound, petname, description, geom, pet_custodian) "
+                "VALUES ('Lost', '2026-01-01 00:00:00', :petname, :description, ST_GeomFromText('POINT(13.4 52.5)'), :user)"
+            ), {'petname': 'pet%d' % number, 'description': description or '', 'user': user.id})
+
+    assert backfill_description_hash(chunk_size=2) == 3
+    assert backfill_description_hash() == 0
+
+    assert 'ix_pet_description_hash' in {index['name'] for index in inspect(db.engine).get_indexes('pet')}
+    pet = Pet.query.filter_by(petname='pet0').one()
+    assert pet.description_hash == Pet.fingerprint('black labrador')
+    assert Pet.find_conflicts('someone else', 'BLACK LABRADOR') == (False, True)
+
+
+def test_normalize_pet_status(app, user):
+    from models import normalize_pet_status
+
+    # a pet table from before the statuses were capitalized
+    with db.engine.begin() as connection:
+        connection.execute(text('CREATE UNIQUE INDEX status_lostorfound ON pet (status_lostorfound)'))
+        for number, status in enumerate(['lost', 'Found', 'FOUND']):
+            connection.execute(text(
+                "INSERT INTO pet (status_lostorfound, date_lostorfound, petname, description, description_hash, geom, pet_custodian) "
+                "VALUES (:status, '2026-01-01 00:00:00', :petname, '', '', ST_GeomFromText('POINT(13.4 52.5)'), :user)"
+            ), {'status': status, 'petname': 'pet%d' % number, 'user': user.id})
+
+    assert normalize_pet_status() == (2, ['status_lostorfound'])
+    assert normalize_pet_status() == (0, [])
+
+    assert 'status_lostorfound' not in {index['name'] for index in inspect(db.engine).get_indexes('pet')}
+    assert sorted(pet.status_lostorfound for pet in Pet.query) == ['Found', 'Found', 'Lost']
+    result = app.test_cli_runner().invoke(args=['normalize-pet-status'])
+    assert result.output == '0 statuses capitalized\n'
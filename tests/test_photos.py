@@ -0,0 +1,58 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from models import Pet
+from photos import PhotoStore
+
+
+def image_bytes(format):
+    data = io.BytesIO()
+    Image.new('RGB', (400, 300), (200, 40, 40)).save(data, format)
+    return data.getvalue()
+
+
+def report(client, petname, filename, data):
+    return client.post('/lost', data={
+        'petname': petname,
+        'status_lostorfound': 'Lost',
+        'date_lostorfound': '2026-03-01',
+        'description': '%s, a black dog' % petname,
+        'coord_latitude': '52.52',
+        'coord_longitude': '13.405',
+        'image_file': (io.BytesIO(data), filename),
+    }, content_type='multipart/form-data')
+
+
+def test_files_that_are_not_photos_are_rejected(app, client):
+    response = report(client, 'Laika', 'x.jpg', b'<html><script>alert(1)</script></html>')
+    assert response.status_code == 200
+    assert 'Please upload a photo (JPEG or PNG)' in response.get_data(as_text=True)
+    assert Pet.query.count() == 0
+    assert not os.path.exists(os.path.join(app.config['PHOTO_STORAGE'], 'originals'))
+
+
+def test_photos_are_served_with_their_real_format(app, client):
+    # a PNG named .jpg is a PNG
+    response = report(client, 'Laika', 'x.jpg', image_bytes('PNG'))
+    assert response.status_code == 302
+    digest = Pet.query.one().image_file
+    original = client.get('/photos/%s/original' % digest)
+    assert original.mimetype == 'image/png'
+    app.extensions['photo_store'].executor.shutdown(wait=True)
+    thumb = client.get('/photos/%s/thumb' % digest)
+    assert thumb.mimetype == 'image/jpeg'
+    assert Image.open(io.BytesIO(thumb.data)).size == (160, 120)
+
+
+def test_the_store_keeps_no_file_that_is_not_a_photo(tmp_path):
+    store = PhotoStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.save(io.BytesIO(b'GIF89a not really'))
+    assert os.listdir(str(tmp_path / 'tmp')) == []
+    assert store.mimetype(os.path.join(str(tmp_path), 'tmp')) is None
+    digest = store.save(io.BytesIO(image_bytes('JPEG')))
+    assert store.mimetype(store.original_path(digest)) == 'image/jpeg'
+    store.executor.shutdown(wait=True)
@@ -0,0 +1,133 @@
+import random
+import struct
+
+import pytest
+
+from models import Point
+from spatial_engines import LocalSpatialEngine
+from spatial_index import SpatialIndex, distance_sphere
+
+random.seed(3)
+# a dense city, a sparse country, and points around the antimeridian and a pole
+POINTS = {}
+for item_id in range(1, 3001):
+    area = item_id % 3
+    if area == 0:
+        lat, lng = 52.5 + random.uniform(-0.1, 0.1), 13.4 + random.uniform(-0.1, 0.1)
+    elif area == 1:
+        lat, lng = random.uniform(-60, 60), random.uniform(-180, 180)
+    else:
+        lat, lng = random.uniform(80, 90), random.choice((-1, 1)) * random.uniform(170, 180)
+    POINTS[item_id] = (lat, lng)
+
+QUERIES = [(52.5, 13.4, 500), (52.5, 13.4, 5000), (52.55, 13.3, 20000), (0, 0, 3000000),
+           (85, 179.9, 500000), (89.9, 0, 200000), (-10, -179, 2000000)]
+
+
+def brute_force(points, lat, lng, radius):
+    return sorted((distance_sphere(lat, lng, point_lat, point_lng), item_id)
+                  for item_id, (point_lat, point_lng) in points.items()
+                  if distance_sphere(lat, lng, point_lat, point_lng) <= radius)
+
+
+def assert_same_hits(hits, expected):
+    assert [item_id for _, item_id in hits] == [item_id for _, item_id in expected]
+    assert [distance for distance, _ in hits] == pytest.approx([distance for distance, _ in expected], abs=1e-6)
+
+
+@pytest.fixture(scope='module')
+def index():
+    index = SpatialIndex()
+    for item_id, (lat, lng) in POINTS.items():
+        index.insert(item_id, lat, lng)
+    return index
+
+
+@pytest.mark.parametrize('lat,lng,radius', QUERIES)
+def test_radius_queries_match_brute_force(index, lat, lng, radius):
+    assert_same_hits(index.query_radius(lat, lng, radius), brute_force(POINTS, lat, lng, radius))
+
+
+@pytest.mark.parametrize('lat,lng,radius', QUERIES)
+def test_keyset_pages_add_up_to_the_whole_result(index, lat, lng, radius):
+    pages = []
+    after = None
+    while True:
+        page = index.query_radius(lat, lng, radius, limit=7, after=after)
+        if not page:
+            break
+        pages.extend(page)
+        after = page[-1]
+    assert_same_hits(pages, brute_force(POINTS, lat, lng, radius))
+
+
+@pytest.mark.parametrize('south,west,north,east', [(52.45, 13.35, 52.55, 13.45), (80, 175, 90, -175), (-60, -180, 60, 180)])
+def test_box_queries_match_brute_force(index, south, west, north, east):
+    def inside(lat, lng):
+        return south <= lat <= north and (west <= lng <= east if west <= east else lng >= west or lng <= east)
+    expected = sorted(item_id for item_id, (lat, lng) in POINTS.items() if inside(lat, lng))
+    assert sorted(index.query_box(south, west, north, east)) == expected
+
+
+def test_moves_and_removes():
+    index = SpatialIndex()
+    for item_id, (lat, lng) in POINTS.items():
+        index.insert(item_id, lat, lng)
+    points = dict(POINTS)
+    for item_id in range(1, 3001, 5):
+        index.remove(item_id)
+        del points[item_id]
+    for item_id in range(2, 3001, 5):
+        points[item_id] = (52.5 + random.uniform(-0.1, 0.1), 13.4 + random.uniform(-0.1, 0.1))
+        index.insert(item_id, *points[item_id])
+    assert len(index) == len(points)
+    for lat, lng, radius in QUERIES:
+        assert_same_hits(index.query_radius(lat, lng, radius), brute_force(points, lat, lng, radius))
+
+
+class Table:
+    __tablename__ = 'table'
+
+
+def test_local_engine_updates_match_brute_force():
+    engine = LocalSpatialEngine()
+    engine.load(Table, [(item_id, Point(lat, lng)) for item_id, (lat, lng) in POINTS.items()])
+    points = dict(POINTS)
+    moved = {item_id: (52.5 + random.uniform(-0.1, 0.1), 13.4 + random.uniform(-0.1, 0.1))
+             for item_id in range(2, 3001, 5)}
+    moved[5000] = (52.5, 13.4)
+    removed = set(range(1, 3001, 5))
+    engine.update(Table, [(item_id, Point(lat, lng)) for item_id, (lat, lng) in moved.items()], removed)
+    points.update(moved)
+    for item_id in removed:
+        del points[item_id]
+
+    for lat, lng, radius in QUERIES:
+        hits = engine.query_radius(Table, lat, lng, radius)
+        assert_same_hits(hits, brute_force(points, lat, lng, radius))
+        if len(hits) > 2:
+            assert engine.query_radius(Table, lat, lng, radius, limit=5, after=hits[2]) == hits[3:8]
+
+
+def test_local_engine_keeps_the_text_index_current():
+    engine = LocalSpatialEngine()
+    engine.load(Table, [(1, Point(0, 0), 'Rex', 'black dog'), (2, Point(0, 0), 'Tom', 'grey cat')])
+    search = engine.text_search(Table)
+    assert set(search('dog')) == {1}
+    engine.update(Table, [(2, Point(0, 0), 'Tom', 'grey dog'), (3, Point(0, 0), 'Kitty', 'cat')], {1})
+    assert set(search('dog')) == {2}
+    assert set(search('cat')) == {3}
+
+
+@pytest.mark.parametrize('byte_order,pack', [(1, '<BIdd'), (0, '>BIdd')])
+def test_wkb_points_decode(byte_order, pack):
+    assert Point.from_wkb(struct.pack(pack, byte_order, 1, 13.4, 52.5)) == Point(52.5, 13.4)
+
+
+def test_points_round_trip_through_the_db(app):
+    from models import db, SampleLocation, Geometry
+
+    location = SampleLocation(describe='Tor', geom=Geometry.point_representation(52.516247, 13.377711))
+    location.insert()
+    db.session.expire_all()
+    assert SampleLocation.query.get(location.id).geom == Point(52.516247, 13.377711)
@@ -0,0 +1,65 @@
+import json
+import random
+
+import pytest
+
+from models import SampleLocation, Geometry
+
+CENTRE = {'lat': 52.5, 'lng': 13.4, 'radius': 2000}
+
+
+@pytest.fixture
+def locations(app):
+    rng = random.Random(9)
+    for number in range(40):
+        SampleLocation(describe='spot %d' % number, geom=Geometry.point_representation(
+            52.5 + rng.uniform(-0.03, 0.03), 13.4 + rng.uniform(-0.03, 0.03))).insert()
+
+
+def paged(client, page_size):
+    results, cursor = [], None
+    while True:
+        args = dict(CENTRE, page_size=page_size, **({'cursor': cursor} if cursor else {}))
+        page = client.get('/api/get_items_in_radius', query_string=args).get_json()
+        results.extend(page['results'])
+        cursor = page['next']
+        if cursor is None:
+            return results
+
+
+def ndjson(response):
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_streamed_results_are_the_pages_one_after_the_other(app, locations):
+    client = app.test_client()
+    pages = paged(client, page_size=7)
+    assert 0 < len(pages) < 40
+
+    streamed = ndjson(client.get('/api/get_items_in_radius', query_string=dict(CENTRE, stream='ndjson')))
+    assert [item['id'] for item in streamed] == [item['id'] for item in pages]
+    assert [item['distance'] for item in streamed] == pytest.approx([item['distance'] for item in pages])
+
+    response = client.get('/api/get_items_in_radius', query_string=dict(CENTRE, stream='json'))
+    assert response.mimetype == 'application/json'
+    document = response.get_json()
+    assert document['success'] is True
+    assert document['results'] == streamed
+
+    assert client.get('/api/get_items_in_radius', query_string=dict(CENTRE, stream='xml')).status_code == 400
+
+
+def test_export(app, locations):
+    client = app.test_client()
+    exported = ndjson(client.get('/api/export'))
+    assert [item['id'] for item in exported] == sorted(location.id for location in SampleLocation.query)
+
+    within = ndjson(client.get('/api/export', query_string=CENTRE))
+    streamed = ndjson(client.get('/api/get_items_in_radius', query_string=dict(CENTRE, stream='ndjson')))
+    assert within == streamed
+
+    assert client.get('/api/export?format=json').get_json()['results'] == exported
+    assert client.get('/api/export?layer=users').status_code == 400
+    assert client.get('/api/export?radius=1000&lat=north').status_code == 400
@@ -0,0 +1,31 @@
+from text_index import InvertedIndex, tokenize
+
+
+def test_tokenize_drops_case_and_short_words():
+    assert tokenize('A big Black DOG, 3 legs') == ['big', 'black', 'dog', 'legs']
+
+
+def test_rarer_words_and_shorter_documents_rank_first():
+    index = InvertedIndex()
+    index.add(1, 'Rex', 'black dog')
+    index.add(2, 'Max', 'black dog with a long white tail and a collar')
+    index.add(3, 'Tom', 'black cat')
+    scores = index.search('dog')
+    assert set(scores) == {1, 2}
+    assert scores[1] > scores[2]
+    scores = index.search('black cat')
+    assert max(scores, key=scores.get) == 3
+
+
+def test_changes_and_removes_leave_no_postings_behind():
+    index = InvertedIndex()
+    index.add(1, 'Rex', 'black dog')
+    index.add(2, 'Tom', 'grey cat')
+    index.add(1, 'Rex', 'brown dog')
+    assert index.search('black') == {}
+    assert set(index.search('brown')) == {1}
+    index.remove(1)
+    index.remove(1)
+    assert len(index) == 1
+    assert index.search('dog') == {}
+    assert set(index._postings) == {'tom', 'grey', 'cat'}
@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+from models import SampleLocation, Pet, Geometry
+from tiles import encode_binary
+
+
+def add_location(lat, lng):
+    SampleLocation(describe='spot', geom=Geometry.point_representation(lat, lng)).insert()
+
+
+def test_full_layers_are_flagged_as_truncated(app):
+    app.config['TILE_MAX_ITEMS'] = 2
+    client = app.test_client()
+    # tile 10/550/335 holds Berlin
+    add_location(52.50, 13.40)
+    add_location(52.51, 13.41)
+    tile = client.get('/api/tiles/10/550/335').get_json()
+    assert len(tile['locations']) == 2
+    assert tile['truncated'] == []
+
+    add_location(52.52, 13.42)
+    tile = client.get('/api/tiles/10/550/335').get_json()
+    assert len(tile['locations']) == 2
+    assert tile['truncated'] == ['locations']
+
+    response = client.get('/api/tiles/10/550/335?format=bin')
+    assert response.headers['X-Tile-Truncated'] == 'locations'
+    assert response.data == encode_binary([tile['locations'], []])
+
+
+def test_inactive_pets_do_not_fill_tiles(app, user):
+    app.config['TILE_MAX_ITEMS'] = 2
+    for number, days_ago in enumerate((Pet.active_days + 1, Pet.active_days + 2, 1, 2)):
+        Pet(petname='pet %d' % number, status_lostorfound='Found', description='pet %d' % number,
+            date_lostorfound=datetime.utcnow() - timedelta(days=days_ago),
+            geom=Geometry.point_representation(52.5 + number * 0.001, 13.4), pet_custodian=user.id).insert()
+    tile = app.test_client().get('/api/tiles/10/550/335').get_json()
+    assert [pet['petname'] for pet in tile['pets']] == ['pet 2', 'pet 3']
+    assert tile['truncated'] == []
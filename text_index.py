@@ -0,0 +1,84 @@
+import math
+import re
+import threading
+
+# BM25 parameters, the usual defaults
+K1 = 1.2
+B = 0.75
+
+# tokens shorter than this are not indexed, as innodb_ft_min_token_size does on MySQL
+MIN_TOKEN_SIZE = 2
+
+_token = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lowercased words of a text"""
+    return [token for token in _token.findall((text or '').lower()) if len(token) >= MIN_TOKEN_SIZE]
+
+
+class InvertedIndex:
+    """In-memory inverted index over short documents, meant to live once per worker process.
+
+    Each term maps to its posting list, {id: term frequency}. A query only reads
+    the posting lists of its terms (any term matches, as MATCH ... AGAINST in
+    natural language mode) and ranks the documents with BM25.
+
+    Documents are added, changed and removed one by one (see
+    spatial_engines.LocalSpatialEngine.update): each one remembers its terms,
+    so removing it only touches their posting lists.
+    """
+
+    def __init__(self):
+        self._postings = {}  # term -> {id: frequency}
+        self._lengths = {}  # id -> number of tokens
+        self._terms = {}  # id -> set of its terms
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, item_id, *texts):
+        tokens = [token for text in texts for token in tokenize(text)]
+        with self._lock:
+            self._remove(item_id)
+            for token in tokens:
+                postings = self._postings.setdefault(token, {})
+                postings[item_id] = postings.get(item_id, 0) + 1
+            self._terms[item_id] = set(tokens)
+            self._lengths[item_id] = len(tokens)
+            self._total_length += len(tokens)
+
+    def remove(self, item_id):
+        with self._lock:
+            self._remove(item_id)
+
+    def _remove(self, item_id):
+        length = self._lengths.pop(item_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for term in self._terms.pop(item_id):
+            del self._postings[term][item_id]
+            if not self._postings[term]:
+                del self._postings[term]
+
+    def search(self, text):
+        """Return {id: score} of the documents having any of the words of text"""
+        terms = set(tokenize(text))
+        with self._lock:
+            count = len(self._lengths)
+            if not count:
+                return {}
+            average_length = self._total_length / count
+            scores = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for item_id, frequency in postings.items():
+                    norm = K1 * (1 - B + B * self._lengths[item_id] / average_length) if average_length else K1
+                    scores[item_id] = scores.get(item_id, 0.0) + idf * frequency * (K1 + 1) / (frequency + norm)
+            return scores
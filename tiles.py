@@ -0,0 +1,40 @@
+import math
+import struct
+
+# Tiles follow the usual web mercator z/x/y scheme (as Google Maps and OSM):
+# at zoom z the world is 2^z x 2^z tiles, x growing eastwards and y southwards
+
+# binary encoding of a tile: MAGIC, then for each layer a uint32 count followed
+# by count (uint32 id, int32 lat * 1e7, int32 lng * 1e7) records, all little endian
+MAGIC = b'AFT1'
+COORDINATE_SCALE = 10 ** 7
+_count = struct.Struct('<I')
+_record = struct.Struct('<Iii')
+
+
+def tile_bounds(z, x, y):
+    """Return (south, west, north, east) of a tile"""
+    n = 2 ** z
+    west = x / n * 360.0 - 180.0
+    east = (x + 1) / n * 360.0 - 180.0
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+
+def is_valid_tile(z, x, y, max_zoom=22):
+    return 0 <= z <= max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def encode_binary(layers):
+    """Pack layers (lists of item dicts with 'id' and 'location') as fixed point int32"""
+    chunks = [MAGIC]
+    for items in layers:
+        chunks.append(_count.pack(len(items)))
+        for item in items:
+            chunks.append(_record.pack(
+                item['id'],
+                int(round(item['location']['lat'] * COORDINATE_SCALE)),
+                int(round(item['location']['lng'] * COORDINATE_SCALE))))
+    return b''.join(chunks)
+